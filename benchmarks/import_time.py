@@ -0,0 +1,70 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""Import-time budget of cmost, exits non-zero when a check fails.
+
+    python benchmarks/import_time.py [--budget 0.25] [--repeat 5]
+
+Each statement runs in a fresh interpreter; the best of `--repeat` runs is
+compared with its budget (seconds, on top of importing numpy), and the
+heavy dependencies it must not load are checked in `sys.modules`.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import argparse
+import subprocess
+
+# statement, budget factor, modules it must not import
+CHECKS = (("import cmost",0.2,("numpy","astropy","scipy","aiohttp","aiofiles","matplotlib"))
+          ,("from cmost import read_header",1.0,("astropy","scipy","aiohttp","aiofiles","matplotlib"))
+          ,("import cmost.processing",1.0,("astropy","scipy","aiohttp","aiofiles"))
+          ,("import cmost.cli",1.0,("astropy","scipy","aiohttp","aiofiles"))
+          ,("import cmost.pipeline",1.0,("scipy","aiohttp","aiofiles")))
+
+_PROBE = """
+import sys,json,time
+{setup}
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds":seconds,"modules":sorted(sys.modules)}}))
+"""
+
+
+def measure(statement:str,repeat:int,setup:str = "")->tuple[float,set]:
+    best,modules = float("inf"),set()
+    probe = _PROBE.format(setup=setup,statement=statement)
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable,"-c",probe],check=True
+                                ,capture_output=True,text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        best = min(best,result["seconds"])
+        modules = set(result["modules"])
+    return best,modules
+
+
+def main(argv:list[str] = None)->int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget",type=float,default=0.25,help="seconds")
+    parser.add_argument("--repeat",type=int,default=5)
+    args = parser.parse_args(argv)
+
+    failures = 0
+    for statement,factor,forbidden in CHECKS:
+        # numpy is imported up front unless the check is that it is not imported
+        setup = "" if "numpy" in forbidden else "import numpy"
+        seconds,modules = measure(statement,args.repeat,setup)
+        budget = args.budget * factor
+        loaded = [name for name in forbidden if name in modules]
+        ok = seconds <= budget and not loaded
+        failures += not ok
+        line = f"{'ok  ' if ok else 'FAIL'} {statement:<36}{seconds * 1000:>9.1f} ms (budget {budget * 1000:.0f} ms)"
+        if loaded:
+            line += f", loaded {', '.join(loaded)}"
+        print(line)
+    return 1 if failures else 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
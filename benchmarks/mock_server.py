@@ -0,0 +1,121 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""Local stand-in for the LAMOST openapi used by `download_fits`.
+
+    python benchmarks/mock_server.py [port]
+
+serves a synthetic FITS file for every obsid until interrupted; point the
+downloader at it with `base_url="http://127.0.0.1:<port>/openapi"`.
+"""
+from __future__ import annotations
+
+import sys
+import random
+import asyncio
+import threading
+
+from io import BytesIO
+from aiohttp import web
+from contextlib import contextmanager
+
+__all__ = ["MockLamostServer","serve_in_thread"]
+
+
+class MockLamostServer:
+    """Answers `/openapi/<dr>/<sub>/<resolution>/spectrum/fits?obsid=...`
+    with `payload` after `latency` seconds; a share `error_rate` of the
+    requests get a 503 instead, and a share `broken_rate` of the responses
+    is cut off halfway."""
+    def __init__(self,payload:bytes = None
+                     ,latency:float = 0.0
+                     ,error_rate:float = 0.0
+                     ,broken_rate:float = 0.0
+                     ,host:str = "127.0.0.1"
+                     ,port:int = 0
+                     ,seed:int = 0):
+        if payload is None:
+            from synthetic import make_hdu
+            buffer = BytesIO()
+            make_hdu(1000).writeto(buffer)
+            payload = buffer.getvalue()
+        self.payload = payload
+        self.latency = latency
+        self.error_rate = error_rate
+        self.broken_rate = broken_rate
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.runner = None
+
+    @property
+    def base_url(self)->str:
+        return f"http://{self.host}:{self.port}/openapi"
+
+    async def handle(self,request:web.Request)->web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            return web.Response(status=503)
+        obsid = request.query.get("obsid")
+        if not obsid:
+            return web.Response(status=400)
+        headers = {"Content-Disposition":f"attachment; filename=spec-{obsid}.fits"}
+        if self.random.random() < self.broken_rate:
+            response = web.StreamResponse(headers=headers)
+            response.content_length = len(self.payload)
+            await response.prepare(request)
+            await response.write(self.payload[:len(self.payload) // 2])
+            request.transport.close()
+            return response
+        return web.Response(body=self.payload,headers=headers)
+
+    async def start(self)->str:
+        app = web.Application()
+        app.router.add_get("/openapi/{dr}/{sub}/{resolution}/spectrum/fits",self.handle)
+        self.runner = web.AppRunner(app,access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner,self.host,self.port).start()
+        # `port=0` picks a free port
+        self.port = self.runner.addresses[0][1]
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self,*args):
+        await self.stop()
+
+
+@contextmanager
+def serve_in_thread(server:MockLamostServer):
+    # runs the server on its own loop, so blocking callers like
+    # `download_fits` can use it; yields the base url
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever,daemon=True)
+    thread.start()
+    try:
+        yield asyncio.run_coroutine_threadsafe(server.start(),loop).result()
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(),loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+if __name__=="__main__":
+    async def main(port:int):
+        async with MockLamostServer(port=port) as server:
+            print(f"serving on {server.base_url}")
+            await asyncio.Event().wait()
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8000))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,329 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""Timings and peak memory of the main cmost paths on synthetic LAMOST data.
+
+    python benchmarks/run.py --sizes 1 1000 100000 --output after.json --compare before.json
+
+Every benchmark runs at each size (number of spectra or files). Batch
+benchmarks go through the spectra `--chunk-size` at a time as `Pipeline`
+does, file benchmarks cycle over `--max-files` synthetic files. A size is
+skipped when the previous size predicts it would take over `--time-limit`
+seconds. Peak memory is measured with `tracemalloc` in a separate run of
+one chunk. `--download` times `download_fits` against a local mock server.
+Benchmarks of APIs the installed cmost does not have (an older release)
+are reported as unavailable, so two releases can be compared.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy
+
+import cmost
+from cmost import io,processing,fitting,lick,download
+from synthetic import make_arrays,write_files
+from mock_server import MockLamostServer,serve_in_thread
+
+BENCHMARKS = []
+
+
+def benchmark(name:str,kind:str):
+    # kind "files": `func(paths)`, "pool": `func(paths,workers,executor)`,
+    # "batch": `func(spectrum_batch)` per chunk, "spectrum": `func(fits_data)`
+    def decorator(func):
+        BENCHMARKS.append((name,kind,func))
+        return func
+    return decorator
+
+
+@benchmark("io.read_fits","files")
+def bench_read_fits(paths):
+    for path in paths:
+        io.read_fits(path)
+
+@benchmark("io.read_fits[lazy].flux","files")
+def bench_read_fits_lazy(paths):
+    for path in paths:
+        io.read_fits(path,lazy=True).flux
+
+@benchmark("io.read_header","files")
+def bench_read_header(paths):
+    for path in paths:
+        io.read_header(path)
+
+@benchmark("io.read_headers","pool")
+def bench_read_headers(paths,workers,executor):
+    io.read_headers(paths,workers=workers,executor=executor)
+
+@benchmark("io.read_fits_many[as_batch]","pool")
+def bench_read_fits_many(paths,workers,executor):
+    io.read_fits_many(paths,workers=workers,executor=executor,as_batch=True)
+
+@benchmark("processing.minmax_function","batch")
+def bench_minmax(batch):
+    processing.minmax_function(batch.flux,(0,1))
+
+@benchmark("processing.interpolate_linear","batch")
+def bench_interpolate_linear(batch):
+    processing.interpolate_linear(batch.wavelength,batch.flux,_target_grid(batch.wavelength))
+
+@benchmark("processing.rebin_flux_conserving","batch")
+def bench_rebin_flux_conserving(batch):
+    processing.rebin_flux_conserving(batch.wavelength,batch.flux,_target_grid(batch.wavelength))
+
+@benchmark("processing.align_wavelength","batch")
+def bench_align_wavelength(batch):
+    processing.align_wavelength(batch.wavelength,batch.flux,_target_grid(batch.wavelength))
+
+@benchmark("processing.align_wavelength[cubic]","spectrum")
+def bench_align_wavelength_cubic(fits_data):
+    processing.align_wavelength(fits_data.wavelength,fits_data.flux
+                                ,_target_grid(fits_data.wavelength),kind="cubic")
+
+@benchmark("processing.Resampler.mask+ivar","batch")
+def bench_resampler_extras(batch):
+    resampler = processing.Resampler(batch.wavelength,_target_grid(batch.wavelength),"flux_conserving")
+    resampler(batch.flux)
+    resampler.mask(batch.andmask)
+    resampler.ivar(batch.ivar)
+
+@benchmark("processing.remove_redshift","batch")
+def bench_remove_redshift(batch):
+    processing.remove_redshift(batch.wavelength,batch.flux,batch.header["z"])
+
+@benchmark("processing.remove_redshift[flux_conserving]","batch")
+def bench_remove_redshift_fc(batch):
+    processing.remove_redshift(batch.wavelength,batch.flux,batch.header["z"],kind="flux_conserving")
+
+@benchmark("processing.median_filter","batch")
+def bench_median_filter(batch):
+    processing.median_filter(batch.flux,7)
+
+@benchmark("processing.moving_median[masked]","batch")
+def bench_moving_median(batch):
+    processing.moving_median(batch.flux,51,mask=batch.andmask)
+
+@benchmark("fitting.SwFitting5d","spectrum")
+def bench_swfitting5d(fits_data):
+    fitting.SwFitting5d(fits_data)
+
+@benchmark("fitting.fit_SwFitting5d_batch","batch")
+def bench_swfitting5d_batch(batch):
+    fitting.fit_SwFitting5d_batch(batch)
+
+@benchmark("lick.compute_LickLineIndices","spectrum")
+def bench_lick(fits_data):
+    lick.compute_LickLineIndices(fits_data)
+
+@benchmark("lick.compute_LickLineIndices_batch","batch")
+def bench_lick_batch(batch):
+    lick.compute_LickLineIndices_batch(batch)
+
+
+class _Chunk:
+    # the arrays of a batch benchmark when `SpectrumBatch` is not available
+    def __init__(self,arrays:dict):
+        self.arrays = arrays
+        for name,value in arrays.items():
+            setattr(self,name,value)
+
+    def __len__(self):
+        return len(self.flux)
+
+    def __getitem__(self,key):
+        return _Chunk({name:value if name=="wavelength" else value[key]
+                       for name,value in self.arrays.items()})
+
+
+def _make_batch(arrays:dict):
+    try:
+        return io.SpectrumBatch(arrays["wavelength"],arrays["flux"],arrays["header"]
+                                ,ivar=arrays["ivar"],andmask=arrays["andmask"]
+                                ,orimask=arrays["orimask"])
+    except (AttributeError,TypeError):
+        return _Chunk(arrays)
+
+
+def _make_spectrum(arrays:dict,row:int):
+    header = arrays["header"]
+    header = io.Header(header.dtype.names,header[row].tolist())
+    try:
+        return io.FitsData(arrays["wavelength"],arrays["flux"][row],header
+                           ,andmask=arrays["andmask"][row],orimask=arrays["orimask"][row]
+                           ,ivar=arrays["ivar"][row])
+    except TypeError:
+        return io.FitsData(arrays["wavelength"],arrays["flux"][row],header)
+
+
+def _target_grid(wavelength:numpy.ndarray)->numpy.ndarray:
+    return numpy.linspace(wavelength[0] + 10,wavelength[-1] - 10,3000)
+
+
+def _run(kind:str,func:callable,size:int,data:dict):
+    if kind in ("files","pool"):
+        files = data["paths"]
+        paths = [files[i % len(files)] for i in range(size)]
+        if kind=="pool":
+            func(paths,data["workers"],data["executor"])
+        else:
+            func(paths)
+    elif kind=="batch":
+        chunk = data["batch"]
+        for start in range(0,size,len(chunk)):
+            func(chunk[:min(len(chunk),size - start)])
+    else:
+        spectra = data["spectra"]
+        for i in range(size):
+            func(spectra[i % len(spectra)])
+
+
+def _peak_memory(kind:str,func:callable,size:int,data:dict)->tuple[int,int]:
+    # peak traced bytes of one chunk or one pass over the files (or `size`
+    # items if smaller); allocations in worker processes are not traced
+    items = min(size,len(data["paths"]) if kind in ("files","pool") else len(data["batch"]))
+    tracemalloc.start()
+    try:
+        _run(kind,func,items,data)
+        return tracemalloc.get_traced_memory()[1],items
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(args,data:dict)->list[dict]:
+    results = []
+    for name,kind,func in BENCHMARKS:
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        try:
+            _run(kind,func,1,data) # warm up imports and caches
+        except Exception as e:
+            # e.g. an API missing from the installed cmost
+            result = {"name":name,"unavailable":repr(e)}
+            results.append(result)
+            _print_result(result)
+            continue
+        per_item = None
+        for size in sorted(args.sizes):
+            if per_item is not None and per_item * size > args.time_limit:
+                result = {"name":name,"size":size,"skipped":f"estimated {per_item * size:.0f}s"}
+            else:
+                start = time.perf_counter()
+                _run(kind,func,size,data)
+                seconds = time.perf_counter() - start
+                per_item = seconds / size
+                peak,items = _peak_memory(kind,func,size,data)
+                result = {"name":name,"size":size,"seconds":seconds
+                          ,"per_second":size / seconds if seconds > 0 else float("inf")
+                          ,"peak_bytes":peak,"memory_items":items}
+            results.append(result)
+            _print_result(result)
+    return results
+
+
+def run_download(args,tmp:str)->dict:
+    server = MockLamostServer(latency=args.latency,error_rate=args.error_rate)
+    metrics = []
+    def collect(event,info,run_metrics):
+        if not metrics:
+            metrics.append(run_metrics)
+    save_dir = os.path.join(tmp,"download")
+    obsids = [str(i) for i in range(args.download)]
+    with serve_in_thread(server) as base_url:
+        start = time.perf_counter()
+        try:
+            download.download_fits(obsids,"9","2.0",sem_number=args.sem_number,save_dir=save_dir
+                                   ,base_url=base_url,callbacks=[collect])
+        except TypeError as e:
+            # no `base_url` before the mock server was supported
+            result = {"name":"download.download_fits","unavailable":repr(e)}
+            _print_result(result)
+            return result
+        except Exception as e:
+            print(f"download_fits: {e!r}")
+        seconds = time.perf_counter() - start
+    result = {"name":"download.download_fits","size":args.download,"seconds":seconds
+              ,"per_second":args.download / seconds}
+    if metrics:
+        summary = metrics[0].summary()
+        result.update({"bytes_per_second":summary["bytes_per_second"]
+                       ,"latency_p50":summary["latency_p50"],"latency_p99":summary["latency_p99"]
+                       ,"retries":summary["retries"],"http_status":{str(key):value for key,value
+                                                                    in summary["http_status"].items()}})
+    _print_result(result)
+    return result
+
+
+def _print_result(result:dict):
+    if "unavailable" in result:
+        print(f"{result['name']:<48}  unavailable ({result['unavailable']})")
+        return
+    if "skipped" in result:
+        print(f"{result['name']:<48}{result['size']:>8}  skipped ({result['skipped']})")
+        return
+    line = f"{result['name']:<48}{result['size']:>8}{result['seconds']:>11.4f}s{result['per_second']:>12.1f}/s"
+    if "peak_bytes" in result:
+        line += f"{result['peak_bytes'] / 2 ** 20:>10.1f} MiB"
+    if "bytes_per_second" in result:
+        line += f"{result['bytes_per_second'] / 2 ** 20:>10.1f} MiB/s"
+    print(line)
+
+
+def compare(results:list[dict],previous:list[dict]):
+    old = {(result["name"],result["size"]):result for result in previous if "seconds" in result}
+    print("\nratio of seconds to the previous run (< 1 is faster)")
+    for result in results:
+        before = old.get((result["name"],result.get("size")))
+        if before is not None and "seconds" in result and before["seconds"] > 0:
+            print(f"{result['name']:<48}{result['size']:>8}{result['seconds'] / before['seconds']:>10.2f}")
+
+
+def main(argv:list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes",type=int,nargs="+",default=[1,1000,100000])
+    parser.add_argument("--chunk-size",type=int,default=1000)
+    parser.add_argument("--max-files",type=int,default=200)
+    parser.add_argument("--time-limit",type=float,default=120.0)
+    parser.add_argument("--only",nargs="*",help="run the benchmarks whose name contains one of these")
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--executor",choices=("process","thread"),default="process")
+    parser.add_argument("--download",type=int,default=200,help="files to download from the mock server, 0 to skip")
+    parser.add_argument("--sem-number",type=int,default=5)
+    parser.add_argument("--latency",type=float,default=0.01)
+    parser.add_argument("--error-rate",type=float,default=0.0)
+    parser.add_argument("--output",help="write the results as JSON")
+    parser.add_argument("--compare",help="JSON results of a previous run")
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix="cmost-bench-")
+    try:
+        arrays = make_arrays(args.chunk_size)
+        data = {"paths":write_files(os.path.join(tmp,"files"),args.max_files)
+                ,"batch":_make_batch(arrays)
+                ,"spectra":[_make_spectrum(arrays,i) for i in range(min(args.chunk_size,100))]
+                ,"workers":args.workers,"executor":args.executor}
+        results = run_benchmarks(args,data)
+        if args.download > 0:
+            results.append(run_download(args,tmp))
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+
+    report = {"cmost":cmost.__version__,"numpy":numpy.__version__
+              ,"python":platform.python_version(),"platform":platform.platform()
+              ,"cpu_count":os.cpu_count(),"results":results}
+    if args.output:
+        with open(args.output,"w",encoding="utf-8") as file:
+            json.dump(report,file,indent=2)
+    if args.compare:
+        with open(args.compare,"r",encoding="utf-8") as file:
+            compare(results,json.load(file)["results"])
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""Synthetic LAMOST spectra and FITS files for the benchmarks.
+
+    python benchmarks/synthetic.py <directory> <count>
+
+writes `count` files alternating between the pre-DR8 layout (data in
+`hdu[0]`, wavelength from `COEFF0`/`COEFF1`) and the DR8+ layout (one row
+table in `hdu[1]`), every third one gzip compressed.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import numpy
+
+from astropy.io import fits
+
+__all__ = ["make_spectra","make_arrays","make_hdu","write_fits","write_files","make_batch"]
+
+COEFF0 = 3.5682 # log10 of the first wavelength, about 3700 A
+COEFF1 = 1e-4
+# a multiple of the default `window_num` of `SwFitting5d`
+NPIX = 3900
+# rest wavelength and depth of a few absorption lines (Hb, Mg b, Fe5270, Fe5335, Na D, Ha)
+LINES = ((4861.3,0.35),(5175.4,0.25),(5270.0,0.1),(5335.1,0.1),(5892.9,0.2),(6562.8,0.4))
+
+
+def wavelength_grid(npix:int = NPIX)->numpy.ndarray:
+    return 10 ** (COEFF0 + numpy.arange(npix) * COEFF1)
+
+
+def make_spectra(n:int
+                 ,npix:int = NPIX
+                 ,z:numpy.ndarray = None
+                 ,seed:int = 0)->dict:
+    # `(n,npix)` arrays of smooth continua with absorption lines at redshift
+    # `z` (default uniform in [0,0.01)), noise and a few flagged pixels
+    rng = numpy.random.default_rng(seed)
+    wavelength = wavelength_grid(npix)
+    z = rng.uniform(0,0.01,n) if z is None else numpy.broadcast_to(z,(n,))
+    scale = rng.uniform(50,500,(n,1))
+    slope = rng.uniform(-0.5,0.5,(n,1))
+    x = (wavelength - wavelength[0]) / (wavelength[-1] - wavelength[0])
+    flux = scale * (1 + slope * x + 0.1 * numpy.sin(6 * x + rng.uniform(0,6,(n,1))))
+    for center,depth in LINES:
+        observed = center * (1 + z[:,None])
+        flux *= 1 - depth * numpy.exp(-0.5 * ((wavelength - observed) / 4.0) ** 2)
+    sigma = flux / rng.uniform(10,50,(n,1))
+    flux += rng.normal(0,1,(n,npix)) * sigma
+    ivar = 1 / sigma ** 2
+    andmask = numpy.zeros((n,npix),dtype=numpy.int32)
+    orimask = numpy.zeros((n,npix),dtype=numpy.int32)
+    start = rng.integers(0,npix - 5,n)
+    andmask[numpy.arange(n)[:,None],start[:,None] + numpy.arange(5)] = 1
+    orimask[andmask>0] = 1
+    return {"wavelength":wavelength,"flux":flux,"ivar":ivar
+            ,"andmask":andmask,"orimask":orimask,"z":z}
+
+
+def make_hdu(obsid:int
+             ,dr:int = 9
+             ,z:float = 0.0
+             ,npix:int = NPIX
+             ,seed:int = 0)->fits.HDUList:
+    spectrum = make_spectra(1,npix,z,seed)
+    rows = [spectrum[name][0] for name in ("flux","ivar")] \
+        + [numpy.broadcast_to(spectrum["wavelength"],(npix,))] \
+        + [spectrum[name][0] for name in ("andmask","orimask")]
+
+    header = fits.Header()
+    for key,value in dict(OBSID=obsid,RA=10.5,DEC=-3.2,Z=z,Z_ERR=1e-4
+                          ,SNRU=3.0,SNRG=20.0,SNRR=30.0,SNRI=25.0,SNRZ=10.0
+                          ,DATA_V=f"LAMOST DR{dr}",FILENAME=f"spec-{obsid}.fits"
+                          ,CLASS="STAR",SUBCLASS="G5").items():
+        header[key] = value
+    if dr < 8:
+        header["COEFF0"] = COEFF0
+        header["COEFF1"] = COEFF1
+        data = numpy.vstack(rows).astype(numpy.float32)
+        return fits.HDUList([fits.PrimaryHDU(data,header=header)])
+
+    columns = [fits.Column(name=name,format=f"{npix}E",array=row[None].astype(numpy.float32))
+               for name,row in zip(("FLUX","IVAR","WAVELENGTH"),rows[:3])]
+    columns += [fits.Column(name=name,format=f"{npix}J",array=row[None])
+                for name,row in zip(("ANDMASK","ORMASK"),rows[3:])]
+    return fits.HDUList([fits.PrimaryHDU(header=header),fits.BinTableHDU.from_columns(columns)])
+
+
+def write_fits(path:str,obsid:int,dr:int = 9,z:float = 0.0,npix:int = NPIX,seed:int = 0)->str:
+    # a `.gz` suffix is compressed by astropy
+    make_hdu(obsid,dr,z,npix,seed).writeto(path,overwrite=True)
+    return str(path)
+
+
+def write_files(directory:str,n:int,npix:int = NPIX)->list[str]:
+    os.makedirs(directory,exist_ok=True)
+    paths = []
+    for i in range(n):
+        suffix = ".fits.gz" if i % 3==2 else ".fits"
+        paths.append(write_fits(os.path.join(directory,f"spec-{1000 + i}{suffix}")
+                                ,1000 + i,dr=5 if i % 2 else 9,z=0.001 * (i % 10),npix=npix,seed=i))
+    return paths
+
+
+def make_arrays(n:int,npix:int = NPIX,seed:int = 0)->dict:
+    # `make_spectra` plus a `header` table (obsid,z), plain numpy only so
+    # that any version of cmost can be benchmarked
+    spectrum = make_spectra(n,npix,seed=seed)
+    header = numpy.empty(n,dtype=[("obsid",numpy.int64),("z",float)])
+    header["obsid"] = numpy.arange(n) + 1000
+    header["z"] = spectrum["z"]
+    spectrum["header"] = header
+    return spectrum
+
+
+def make_batch(n:int,npix:int = NPIX,seed:int = 0):
+    from cmost.io import SpectrumBatch
+    arrays = make_arrays(n,npix,seed)
+    return SpectrumBatch(arrays["wavelength"],arrays["flux"],arrays["header"]
+                         ,ivar=arrays["ivar"],andmask=arrays["andmask"]
+                         ,orimask=arrays["orimask"])
+
+
+if __name__=="__main__":
+    if len(sys.argv)!=3:
+        sys.exit(__doc__)
+    print("\n".join(write_files(sys.argv[1],int(sys.argv[2]))))
@@ -1,8 +1,29 @@
-from .download import *
-from .io import *
-from . import lick
-from . import fitting
+import importlib
 
-__all__ =  io.__all__ + download.__all__
+# submodules and their heavy dependencies (astropy, scipy, aiohttp) are only
+# imported on first attribute access, see `__getattr__`
+_SUBMODULES = ("io","processing","download","lick","fitting","store","index","pipeline","instrument","cli")
+_ATTRIBUTES = {"read_fits":"io","read_header":"io","read_headers":"io"
+               ,"read_fits_many":"io","SpectrumBatch":"io"
+               ,"download_fits":"download","iter_download_fits":"download"
+               ,"iter_parse_fits":"download"}
 
-__version__ = '0.0.1'
\ No newline at end of file
+__all__ = ["read_fits","read_header","read_headers","read_fits_many","SpectrumBatch"
+           ,"download_fits","iter_download_fits","iter_parse_fits"]
+
+__version__ = '0.0.1'
+
+
+def __getattr__(name:str):
+    if name in _SUBMODULES:
+        value = importlib.import_module(f".{name}",__name__)
+    elif name in _ATTRIBUTES:
+        value = getattr(importlib.import_module(f".{_ATTRIBUTES[name]}",__name__),name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_ATTRIBUTES))
@@ -0,0 +1,276 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""The `cmost` command line tool.
+
+    cmost download obsids.txt --dr 9 --sub 2.0 --output ./dr9_v2.0 --workers 8
+    cmost headers "spectra/*.fits.gz" --keys obsid ra dec z --output headers.parquet
+    cmost preprocess spectra/ --align 3700 9100 2 --median-filter 7 --normalize 10 --output flux.npy
+    cmost lick spectra/ --remove-redshift --align 3700 7000 2 --errors --output lick.csv
+
+The output format follows the extension of `--output`: `.npy`, `.csv`,
+`.tsv` or `.parquet`. `--profile` prints the time spent in every stage.
+"""
+from __future__ import annotations
+
+import sys
+import time
+import argparse
+import itertools
+import numpy
+
+from typing import Iterator
+
+__all__ = ["main"]
+
+
+def main(argv:list[str] = None)->int:
+    args = _parser().parse_args(argv)
+    profile = dict() if args.profile else None
+    start = time.perf_counter()
+    code = args.func(args,profile)
+    if profile is not None:
+        _print_profile(profile,time.perf_counter() - start)
+    return code
+
+
+def _parser()->argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--workers",type=int,default=None
+                        ,help="parallel workers (default: one per CPU, concurrent requests for download)")
+    common.add_argument("--chunk-size",type=int,default=256
+                        ,help="files per chunk (queued obsids for download)")
+    common.add_argument("--output","-o",default=None
+                        ,help="output file (.npy, .csv, .tsv or .parquet), directory for download")
+    common.add_argument("--profile",action="store_true",help="print the time spent in every stage")
+
+    parser = argparse.ArgumentParser(prog="cmost",description="Batch tools for LAMOST FITS files.")
+    commands = parser.add_subparsers(dest="command",required=True)
+
+    download = commands.add_parser("download",parents=[common]
+                                   ,help="download the obsids listed in a file, resumable")
+    download.add_argument("obsids",help="file with one obsid per line ('#' starts a comment)")
+    download.add_argument("--dr",required=True,help="data release, e.g. 9")
+    download.add_argument("--sub",required=True,help="sub version, e.g. 2.0")
+    download.add_argument("--token",default=None)
+    download.add_argument("--dev",action="store_true",help="use the development server")
+    download.add_argument("--med",action="store_true",help="medium resolution spectra")
+    download.add_argument("--retries",type=int,default=3)
+    download.add_argument("--manifest",default=None,help="default: <output>/manifest.jsonl")
+    download.add_argument("--adaptive",type=int,default=None,metavar="MAX"
+                          ,help="adapt the concurrency between 1 and MAX requests")
+    download.add_argument("--base-url",default=None,help="mirror of the LAMOST openapi")
+    download.add_argument("--quiet",action="store_true",help="no line per file")
+    download.set_defaults(func=_download)
+
+    headers = commands.add_parser("headers",parents=[common],help="table of the primary headers")
+    headers.add_argument("paths",nargs="+",help="files, directories or glob patterns")
+    headers.add_argument("--keys",nargs="+",default=None,help="header keys to keep (default: all)")
+    headers.add_argument("--executor",choices=("process","thread"),default="process")
+    headers.set_defaults(func=_headers)
+
+    preprocess = commands.add_parser("preprocess",parents=[common]
+                                     ,help="process spectra, stages run in the given order")
+    _add_stage_options(preprocess)
+    preprocess.set_defaults(func=_preprocess)
+
+    lick = commands.add_parser("lick",parents=[common]
+                               ,help="Lick indices, after the optional processing stages")
+    _add_stage_options(lick)
+    lick.add_argument("--keys",nargs="+",default=["obsid"],help="header keys copied to the table")
+    lick.add_argument("--errors",action="store_true",help="add `<index>_err` columns from the ivar")
+    lick.add_argument("--mask",action="store_true",help="indices using an andmask pixel are nan")
+    lick.set_defaults(func=_lick)
+    return parser
+
+
+class _Stage(argparse.Action):
+    # stages are collected in command line order
+    def __call__(self,parser,namespace,values,option_string = None):
+        stages = list(getattr(namespace,"stages",None) or [])
+        stages.append((self.dest,values))
+        namespace.stages = stages
+
+
+def _add_stage_options(parser:argparse.ArgumentParser):
+    parser.add_argument("paths",nargs="+",help="files, directories or glob patterns")
+    parser.add_argument("--executor",choices=("process","thread"),default="process")
+    parser.add_argument("--kind",default="linear",help="resampling of --align and --remove-redshift")
+    parser.add_argument("--minmax",action=_Stage,nargs=2,type=float,metavar=("LOW","HIGH"))
+    parser.add_argument("--align",action=_Stage,nargs=3,type=float,metavar=("START","STOP","STEP")
+                        ,help="resample onto numpy.arange(START,STOP,STEP)")
+    parser.add_argument("--remove-redshift",action=_Stage,nargs="?",const=None,type=float
+                        ,metavar="STEP",help="shift to the rest frame, on the current grid or one of STEP")
+    parser.add_argument("--median-filter",action=_Stage,type=int,metavar="SIZE",help="odd window size")
+    parser.add_argument("--normalize",action=_Stage,nargs="?",const=None,type=int,metavar="WINDOW_NUM"
+                        ,help="divide by the SwFitting5d continuum fitted in WINDOW_NUM windows (default 10)"
+                              ", which must divide the pixel number")
+    parser.set_defaults(stages=[])
+
+
+def _pipeline(args):
+    from .pipeline import Pipeline
+    pipeline = Pipeline()
+    # the current grid, once a stage has fixed it, to check the options up front
+    grid = None
+    for name,value in args.stages:
+        if name=="minmax":
+            pipeline = pipeline.minmax(tuple(value))
+        elif name=="align":
+            grid = numpy.arange(*value)
+            pipeline = pipeline.align(grid,kind=args.kind)
+        elif name=="remove_redshift":
+            rest_grid = _rest_grid(pipeline,value)
+            grid = grid if rest_grid is None else rest_grid
+            pipeline = pipeline.remove_redshift(kind=args.kind,wavelength_grid=rest_grid)
+        elif name=="median_filter":
+            if value<1 or value % 2==0:
+                raise SystemExit(f"cmost: error: --median-filter SIZE must be a positive odd integer, got {value}")
+            pipeline = pipeline.median_filter(value)
+        elif name=="normalize":
+            window_num = 10 if value is None else value
+            if window_num<1:
+                raise SystemExit(f"cmost: error: --normalize WINDOW_NUM must be positive, got {window_num}")
+            if grid is not None and len(grid) % window_num!=0:
+                raise SystemExit(f"cmost: error: --normalize fits the continuum in {window_num} windows, "
+                                 f"which does not divide the {len(grid)} pixels of the grid; "
+                                 f"pass --normalize WINDOW_NUM with a divisor of {len(grid)}")
+            pipeline = pipeline.normalize_continuum(window_num=window_num)
+    return pipeline
+
+
+def _rest_grid(pipeline,step:float)->numpy.ndarray:
+    # the aligned grid resampled at `step` (the observed grid if None)
+    if step is None:
+        return None
+    aligned = [args[0] for name,args,_ in pipeline.stages if name=="align"]
+    if not aligned:
+        raise SystemExit("cmost: error: --remove-redshift STEP needs an earlier --align")
+    return numpy.arange(aligned[-1][0],aligned[-1][-1],step)
+
+
+def _sink(path:str):
+    from .pipeline import NpySink,CSVSink,ParquetSink
+    if path is None:
+        raise SystemExit("cmost: error: --output is required")
+    lower = path.lower()
+    if lower.endswith(".npy"):
+        return NpySink(path)
+    if lower.endswith(".csv"):
+        return CSVSink(path)
+    if lower.endswith(".tsv"):
+        return CSVSink(path,delimiter="\t")
+    if lower.endswith(".parquet"):
+        return ParquetSink(path)
+    raise SystemExit(f"cmost: error: unknown output format {path!r}, use .npy, .csv, .tsv or .parquet")
+
+
+def _paths(paths:list[str])->Iterator[str]:
+    from .io import resolve_paths
+    return itertools.chain.from_iterable(resolve_paths(path) for path in paths)
+
+
+def _report(failed:dict)->int:
+    for path,error in failed.items():
+        print(f"cmost: failed {path}: {error!r}",file=sys.stderr)
+    if failed:
+        print(f"cmost: {len(failed)} failed",file=sys.stderr)
+        return 1
+    return 0
+
+
+def _headers(args,profile:dict)->int:
+    from .io import read_headers
+    sink = _sink(args.output)
+    start = time.perf_counter()
+    table,failed = read_headers(list(_paths(args.paths)),keys=args.keys,workers=args.workers
+                                ,executor=args.executor,chunk_size=args.chunk_size)
+    if profile is not None:
+        profile["read_headers"] = time.perf_counter() - start
+    start = time.perf_counter()
+    with sink:
+        if len(table):
+            sink.write(table)
+    if profile is not None:
+        profile["write"] = time.perf_counter() - start
+    return _report(failed)
+
+
+def _preprocess(args,profile:dict)->int:
+    sink = _sink(args.output)
+    failed = _pipeline(args).run(_paths(args.paths),sink,args.chunk_size,args.workers
+                                 ,args.executor,profile)
+    return _report(failed)
+
+
+def _lick(args,profile:dict)->int:
+    sink = _sink(args.output)
+    options = {"return_errors":args.errors}
+    if args.mask:
+        options["mask"] = True
+    pipeline = _pipeline(args).lick(keys=args.keys,**options)
+    failed = pipeline.run(_paths(args.paths),sink,args.chunk_size,args.workers
+                          ,args.executor,profile)
+    return _report(failed)
+
+
+def _read_obsids(path:str)->Iterator[str]:
+    # read lazily, the list can be a full data release
+    with open(path,"r",encoding="utf-8") as file:
+        for line in file:
+            obsid = line.split("#")[0].strip()
+            if obsid:
+                yield obsid
+
+
+def _download(args,profile:dict)->int:
+    import asyncio
+    from .download import iter_download_fits,print_progress,AdaptiveLimiter
+
+    metrics = []
+    def collect(event,info,run_metrics):
+        if not metrics:
+            metrics.append(run_metrics)
+    callbacks = [collect] if args.quiet else [print_progress,collect]
+    workers = 5 if args.workers is None else args.workers
+    limiter = None
+    if args.adaptive is not None:
+        limiter = AdaptiveLimiter(initial=min(workers,args.adaptive),maximum=args.adaptive)
+
+    async def run()->dict:
+        counts = dict()
+        async for obsid,_,status in iter_download_fits(_read_obsids(args.obsids),args.dr,args.sub
+                                                       ,is_dev=args.dev,TOKEN=args.token,is_med=args.med
+                                                       ,sem_number=workers,max_retrys=args.retries
+                                                       ,save_dir=args.output,resume=True
+                                                       ,manifest_path=args.manifest
+                                                       ,queue_size=args.chunk_size
+                                                       ,base_url=args.base_url,callbacks=callbacks
+                                                       ,limiter=limiter):
+            counts[status] = counts.get(status,0) + 1
+            if status=="failed":
+                print(f"cmost: failed {obsid}",file=sys.stderr)
+        return counts
+
+    start = time.perf_counter()
+    counts = asyncio.run(run())
+    print(" ".join(f"{status}={count}" for status,count in sorted(counts.items())),file=sys.stderr)
+    if profile is not None:
+        profile["download"] = time.perf_counter() - start
+        if metrics:
+            summary = metrics[0].summary()
+            print(f"cmost: {summary['requests']} requests, {summary['bytes_per_second'] / 2 ** 20:.2f} MiB/s"
+                  f", latency p50 {summary['latency_p50']:.3f}s p99 {summary['latency_p99']:.3f}s"
+                  f", {summary['retries']} retries, status {summary['http_status']}",file=sys.stderr)
+    return 1 if counts.get("failed") else 0
+
+
+def _print_profile(profile:dict,total:float):
+    # stage times are summed over the workers, so they can exceed the wall time
+    print(f"{'stage':<24}{'seconds':>12}",file=sys.stderr)
+    for name,seconds in profile.items():
+        print(f"{name:<24}{seconds:>12.3f}",file=sys.stderr)
+    print(f"{'total (wall)':<24}{total:>12.3f}",file=sys.stderr)
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -3,15 +3,27 @@
 
 from __future__ import annotations
 
+import os
+import gzip
+import json
+import time
+import logging
+import random
 import asyncio
 import aiofiles
 import aiohttp
 import aiohttp.http_exceptions
 
+from io import BytesIO
 from pathlib import Path
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+from typing import AsyncIterable,AsyncIterator,Iterable
+
+__all__ = ['download_fits','iter_download_fits','iter_parse_fits']
+
+_logger = logging.getLogger(__name__)
 
-__all__ = ['download_fits']
 
 def asyncio_decorator(func):
     @wraps(func)
@@ -31,6 +43,230 @@ def asyncio_decorator(func):
     return wrapper
 
 
+class DownloadManifest:
+    """Persistent record of a bulk download, one JSON line per event.
+
+    Every line is `{"obsid":...,"status":...,"path":...,"error":...}` with
+    status "pending" (download started), "done" or "failed"; the last line
+    of an obsid wins. Lines are flushed as they are written, so the manifest
+    survives a killed job and the next run only fetches what is left.
+    """
+    def __init__(self,path:str):
+        self.path = Path(path)
+        self.records = dict()
+        if self.path.exists():
+            with open(self.path,"r",encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # a line cut short by a crash
+                    self.records[str(record["obsid"])] = record
+        self.file = open(self.path,"a",encoding="utf-8")
+
+    def mark(self,obsid:str,status:str,path:str = None,error:str = None):
+        record = {"obsid":str(obsid),"status":status,"path":path,"error":error}
+        self.records[str(obsid)] = record
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def status(self,obsid:str)->str:
+        record = self.records.get(str(obsid))
+        return None if record is None else record["status"]
+
+    def is_done(self,obsid:str)->bool:
+        # done and still on disk
+        record = self.records.get(str(obsid))
+        return record is not None and record["status"]=="done" \
+            and record["path"] is not None and os.path.exists(record["path"])
+
+    def obsids(self,status:str)->list[str]:
+        return [obsid for obsid,record in self.records.items() if record["status"]==status]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __repr__(self):
+        counts = dict()
+        for record in self.records.values():
+            counts[record["status"]] = counts.get(record["status"],0) + 1
+        return f"DownloadManifest(path={str(self.path)!r},{counts})"
+
+
+def backoff_delay(retry:int,base:float = 1.0,cap:float = 30.0)->float:
+    # exponential backoff with full jitter
+    return random.uniform(0,min(cap,base * 2 ** retry))
+
+
+def print_progress(event:str,info:dict,metrics:DownloadMetrics):
+    # the default callback, one line per downloaded file
+    if event=="done":
+        total = info["total"] if info["total"] else "?"
+        print(f"<{info['name']} has dowloaded,current progress:{info['completed']}/{total}>")
+
+
+class DownloadMetrics:
+    """Throughput, latency and error counters of a download run.
+
+    `FitsDownloader` updates it after every HTTP request; `summary()` gives
+    bytes/s, latency percentiles (from a fixed histogram, so the memory does
+    not grow with the number of requests), retries and the counts of every
+    HTTP status (exceptions without a status are counted by their name).
+    """
+    # upper edges in seconds, the last bucket is everything above
+    latency_buckets = (0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.http_status = dict()
+        self.results = dict()
+        self.latency_histogram = [0] * (len(self.latency_buckets) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def record_request(self,status:int|str,latency:float,nbytes:int = 0):
+        self.requests += 1
+        self.bytes += nbytes
+        self.http_status[status] = self.http_status.get(status,0) + 1
+        index = len(self.latency_buckets)
+        for i,edge in enumerate(self.latency_buckets):
+            if latency <= edge:
+                index = i
+                break
+        self.latency_histogram[index] += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max,latency)
+
+    def record_retry(self):
+        self.retries += 1
+
+    def record_result(self,status:str):
+        self.results[status] = self.results.get(status,0) + 1
+
+    @property
+    def elapsed(self)->float:
+        return time.perf_counter() - self.started
+
+    @property
+    def bytes_per_second(self)->float:
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def error_rate(self)->float:
+        if not self.requests:
+            return 0.0
+        ok = sum(count for status,count in self.http_status.items()
+                 if isinstance(status,int) and status < 400)
+        return 1.0 - ok / self.requests
+
+    def latency_quantile(self,q:float)->float:
+        # upper edge of the bucket holding the `q` quantile
+        if not 0 <= q <= 1:
+            raise ValueError("`q` must be in [0,1]")
+        if not self.requests:
+            return 0.0
+        rank = q * self.requests
+        cumulative = 0
+        for i,count in enumerate(self.latency_histogram):
+            cumulative += count
+            if count and cumulative >= rank:
+                if i == len(self.latency_buckets):
+                    return self.latency_max
+                return min(self.latency_buckets[i],self.latency_max)
+        return self.latency_max
+
+    def summary(self)->dict:
+        return {"elapsed":self.elapsed
+                ,"requests":self.requests
+                ,"bytes":self.bytes
+                ,"bytes_per_second":self.bytes_per_second
+                ,"retries":self.retries
+                ,"error_rate":self.error_rate
+                ,"http_status":dict(self.http_status)
+                ,"results":dict(self.results)
+                ,"latency_mean":self.latency_sum / self.requests if self.requests else 0.0
+                ,"latency_p50":self.latency_quantile(0.5)
+                ,"latency_p90":self.latency_quantile(0.9)
+                ,"latency_p99":self.latency_quantile(0.99)
+                ,"latency_max":self.latency_max}
+
+    def __repr__(self):
+        return (f"DownloadMetrics(requests={self.requests},bytes={self.bytes}"
+                f",bytes_per_second={self.bytes_per_second:.0f},retries={self.retries}"
+                f",http_status={self.http_status})")
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of requests in flight, used like a semaphore.
+
+    Every request that succeeds within `latency_target` (any latency if it
+    is None) raises the limit by `increase/limit`, i.e. about `increase` per
+    round of requests; an error, a 429/5xx or a slow response multiplies it
+    by `decrease`. The limit is lowered at most once per round, so a burst
+    of failures of the requests already in flight counts once.
+    """
+    def __init__(self,initial:int = 5
+                     ,minimum:int = 1
+                     ,maximum:int = 32
+                     ,increase:float = 1.0
+                     ,decrease:float = 0.5
+                     ,latency_target:float = None):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("`minimum`,`initial` and `maximum` must satisfy 1 <= minimum <= initial <= maximum")
+        if not 0 < decrease < 1:
+            raise ValueError("`decrease` must be in (0,1)")
+        if increase <= 0:
+            raise ValueError("`increase` must be positive")
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._since_decrease = maximum # the first congestion signal always counts
+        self._condition = None
+
+    async def __aenter__(self):
+        if self._condition is None:
+            # created inside the running loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda:self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self,*args):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def feedback(self,latency:float,ok:bool):
+        self._since_decrease += 1
+        slow = self.latency_target is not None and latency > self.latency_target
+        if ok and not slow:
+            self.limit = min(float(self.maximum),self.limit + self.increase / self.limit)
+        elif self._since_decrease >= int(self.limit):
+            self.limit = max(float(self.minimum),self.limit * self.decrease)
+            self._since_decrease = 0
+
+    def __repr__(self):
+        return f"AdaptiveLimiter(limit={self.limit:.2f},in_flight={self.in_flight},maximum={self.maximum})"
+
+
 class FitsDownloader:
     def __init__(self,dr_version:str
                     ,sub_version:str
@@ -40,7 +276,11 @@ class FitsDownloader:
                     ,is_med:bool
                     ,sem_number:int
                     ,max_retrys:int
-                    ,save_dir:str):
+                    ,save_dir:str
+                    ,manifest:DownloadManifest = None
+                    ,base_url:str = None
+                    ,callbacks:Iterable[callable] = None
+                    ,limiter:AdaptiveLimiter = None):
         
         self.dr_version = dr_version
         self.sub_version = sub_version
@@ -49,7 +289,16 @@ class FitsDownloader:
         self.is_med = is_med
         self.max_retrys = max_retrys
         self.save_dir = save_dir
-        self.sem = asyncio.Semaphore(sem_number)
+        self.sem_number = sem_number
+        # `sem` bounds the requests in flight; with an adaptive limiter there
+        # are enough workers to reach its maximum
+        self.sem = asyncio.Semaphore(sem_number) if limiter is None else limiter
+        self.concurrency = sem_number if limiter is None else limiter.maximum
+        self.manifest = manifest
+        self.base_url = base_url
+        self.callbacks = [print_progress] if callbacks is None else list(callbacks)
+        self.metrics = DownloadMetrics()
+        self.failed = dict()
         self.band()
 
     
@@ -62,58 +311,304 @@ class FitsDownloader:
 
         """
         resolution = 'mrs' if self.is_med else 'lrs'
-        base_url = 'https://www2.lamost.org/openapi' if self.is_dev else "https://www.lamost.org/openapi"
+        if self.base_url is not None:
+            # e.g. a mirror or a local stand-in server
+            base_url = self.base_url.rstrip("/")
+        else:
+            base_url = 'https://www2.lamost.org/openapi' if self.is_dev else "https://www.lamost.org/openapi"
         url = f"{base_url}/{self.dr_version}/{self.sub_version}/{resolution}/spectrum/fits"
         self.url = url
     
 
+    async def fetch(self,obsid:str,session:aiohttp.ClientSession)->tuple:
+        # one obsid with retries, never raises: `(obsid,path,status)` with
+        # status "done", "skipped" (already on disk) or "failed"
+        obsid,path,status,_ = await self._download(obsid,session,save=True,keep=False)
+        return obsid,path,status
+
+    async def _download(self,obsid:str
+                        ,session:aiohttp.ClientSession
+                        ,save:bool
+                        ,keep:bool)->tuple:
+        # `(obsid,path,status,data)`: the file is streamed to disk if `save`,
+        # and its bytes are returned as `data` if `keep`
+        if self.manifest is not None:
+            if self.manifest.is_done(obsid):
+                self.task_completed += 1
+                path = self.manifest.records[obsid]["path"]
+                data = None
+                if keep:
+                    async with aiofiles.open(path,"rb") as f:
+                        data = await f.read()
+                self._finish(obsid,"skipped",path=path)
+                return obsid,path,"skipped",data
+            self.manifest.mark(obsid,"pending")
+
+        for retry in range(self.max_retrys):
+            try:
+                async with self.sem:
+                    start = time.perf_counter()
+                    try:
+                        status,fits_name,fits_path,data,nbytes = await self._request(obsid,session,save,keep)
+                    except Exception as e:
+                        self._observe(obsid,retry,getattr(e,"status",None) or type(e).__name__
+                                      ,time.perf_counter() - start,0)
+                        raise
+                    self._observe(obsid,retry,status,time.perf_counter() - start,nbytes)
+            except Exception as e:
+                if retry == self.max_retrys - 1:
+                    self.failed[obsid] = e
+                    if self.manifest is not None:
+                        # recorded and skipped, the next run retries it
+                        self.manifest.mark(obsid,"failed",error=repr(e))
+                    self._finish(obsid,"failed",error=e)
+                    return obsid,None,"failed",None
+                delay = backoff_delay(retry)
+                self.metrics.record_retry()
+                self._emit("retry",{"obsid":obsid,"retry":retry + 1,"delay":delay,"error":e})
+                await asyncio.sleep(delay)
+                continue
+
+            self.task_completed += 1
+            if self.manifest is not None:
+                self.manifest.mark(obsid,"done",fits_path)
+            self._finish(obsid,"done",path=fits_path,name=fits_name)
+            return obsid,fits_path,"done",data
+
+    async def _request(self,obsid:str
+                       ,session:aiohttp.ClientSession
+                       ,save:bool
+                       ,keep:bool)->tuple:
+        # one HTTP request: `(status,fits_name,fits_path,data,nbytes)`
+        fits_path,data,nbytes = None,None,0
+        async with session.get(self.url,params={"obsid":obsid,"token":self.TOKEN}) as response:
+            response.raise_for_status()
+            fits_name = response.headers["Content-Disposition"].split("=")[1]
+            if keep:
+                data = await response.read()
+                nbytes = len(data)
+            if save:
+                fits_path = Path(self.save_dir).joinpath(fits_name)
+                # written under a temporary name and renamed once complete,
+                # so an interrupted download never leaves a truncated FITS file
+                part_path = fits_path.with_name(fits_name + ".part")
+                try:
+                    async with aiofiles.open(part_path,"wb") as f:
+                        if keep:
+                            await f.write(data)
+                        else:
+                            # 8192 is the default chunk size
+                            async for chunk in response.content.iter_chunked(8192):
+                                if chunk:
+                                    nbytes += len(chunk)
+                                    await f.write(chunk)
+                    os.replace(part_path,fits_path)
+                except BaseException:
+                    # nor a `.part` file, whether the attempt failed or was cancelled
+                    part_path.unlink(missing_ok=True)
+                    raise
+                fits_path = str(fits_path)
+            return response.status,fits_name,fits_path,data,nbytes
+
+    def _observe(self,obsid:str,retry:int,status:int|str,latency:float,nbytes:int):
+        self.metrics.record_request(status,latency,nbytes)
+        if isinstance(self.sem,AdaptiveLimiter):
+            # a missing obsid (404) is not a sign of an overloaded server
+            congested = not isinstance(status,int) or status==429 or status >= 500
+            self.sem.feedback(latency,not congested)
+        self._emit("request",{"obsid":obsid,"attempt":retry + 1,"status":status
+                              ,"latency":latency,"bytes":nbytes})
+
+    def _finish(self,obsid:str,status:str,path:str = None,name:str = None,error:Exception = None):
+        self.metrics.record_result(status)
+        self._emit(status,{"obsid":obsid,"path":path,"name":name,"error":error
+                           ,"completed":self.task_completed,"total":self.task_total})
+
+    def _emit(self,event:str,info:dict):
+        # `callback(event,info,metrics)` with event "request", "retry",
+        # "done", "skipped" or "failed"; a callback that raises is logged and
+        # must not stop the worker running the download
+        for callback in self.callbacks:
+            try:
+                callback(event,info,self.metrics)
+            except Exception:
+                _logger.exception("download callback %r failed on %r",callback,event)
+
     async def download_single_fits(self,
             obsid:int
             ,session:aiohttp.ClientSession
         )->None:
-            
-            for retry in range(self.max_retrys):
-                try:
-                    async with self.sem:
-                        async with session.get(self.url,params={"obsid":obsid,"token":self.TOKEN}) as response:
-                            fits_name = response.headers["Content-Disposition"].split("=")[1]
-                            fits_path = Path(self.save_dir).joinpath(fits_name)
-                            async with aiofiles.open(fits_path,"wb+") as f:
-                                # 8192 is the default chunk size
-                                async for chunk in response.content.iter_chunked(8192):
-                                    if chunk:
-                                        await f.write(chunk)
-                            
-                            self.task_completed += 1
-                            print(f"<{fits_name} has dowloaded,current progress:{self.task_completed}/{self.task_total}>")
-                            return
-                        
-                except Exception as e:
-                    await asyncio.sleep(1 + 0.5 * retry)
-                    if retry == self.max_retrys - 1:
-                         raise aiohttp.http_exceptions.HttpProcessingError(code=500
-                                                                           ,message="Download failed") from e
-           
+            obsid,_,status = await self.fetch(str(obsid),session)
+            if status=="failed" and self.manifest is None:
+                raise aiohttp.http_exceptions.HttpProcessingError(code=500
+                                                                  ,message="Download failed") from self.failed[obsid]
+
+    def connector(self)->aiohttp.TCPConnector:
+        # every request goes to the same host: keep the connections alive and
+        # reuse them instead of opening one per file
+        return aiohttp.TCPConnector(limit=self.concurrency
+                                    ,limit_per_host=self.concurrency
+                                    ,keepalive_timeout=60
+                                    ,ttl_dns_cache=300)
+
+    def iter_download(self,
+            obsids:Iterable|AsyncIterable
+            ,queue_size:int = None
+    )->AsyncIterator[tuple]:
+        """Download `obsids` with `concurrency` workers, yielding `(obsid,path,status)`.
+
+        `obsids` is any iterable or async iterable and is consumed lazily
+        through a bounded queue, so memory does not grow with its length.
+        Results come in completion order while the other downloads go on.
+        """
+        return self._run_queue(obsids,self.fetch,queue_size)
+
+    async def iter_parse(self,
+            obsids:Iterable|AsyncIterable
+            ,transform:callable = None
+            ,save:bool = False
+            ,workers:int = None
+            ,executor:str = "thread"
+            ,queue_size:int = None
+    )->AsyncIterator[tuple]:
+        """Download `obsids` into memory and parse them, yielding `(obsid,result,status)`.
+
+        Every response is kept as bytes and parsed with `fits.open(BytesIO)`
+        on a pool of `workers` threads or processes while the next downloads
+        go on. `result` is the `FitsData`, or `transform(fits_data)` (it must be
+        picklable for `executor="process"`). Files are also written to
+        `save_dir` if `save`.
+        """
+        if executor not in ("process","thread"):
+            raise ValueError("`executor` must be 'process' or 'thread'")
+        loop = asyncio.get_running_loop()
+        pool_cls = ProcessPoolExecutor if executor=="process" else ThreadPoolExecutor
+        pool = pool_cls(max_workers=workers)
+
+        async def handle(obsid:str,session:aiohttp.ClientSession)->tuple:
+            obsid,_,status,data = await self._download(obsid,session,save=save,keep=True)
+            if status=="failed":
+                return obsid,None,status
+            try:
+                result = await loop.run_in_executor(pool,_parse_fits_bytes,data,transform)
+            except Exception as e:
+                self.failed[obsid] = e
+                return obsid,None,"failed"
+            return obsid,result,status
+
+        try:
+            async for result in self._run_queue(obsids,handle,queue_size):
+                yield result
+        finally:
+            # every parse has been awaited unless the loop was left early;
+            # waiting for the pool here would block the event loop
+            pool.shutdown(wait=False,cancel_futures=True)
+
+    async def _run_queue(self,
+            obsids:Iterable|AsyncIterable
+            ,handle:callable
+            ,queue_size:int = None
+    )->AsyncIterator[tuple]:
+        # `concurrency` workers run `handle(obsid,session)` over a bounded queue
+        queue_size = 2 * self.concurrency if queue_size is None else queue_size
+        if hasattr(obsids,"__len__"):
+            self.task_total = len(obsids)
+        obsid_queue = asyncio.Queue(maxsize=queue_size)
+        result_queue = asyncio.Queue(maxsize=queue_size)
+
+        # the sentinels are posted even if `obsids` or `handle` raise (the
+        # error reaches the caller below), but not once a task is cancelled:
+        # nobody reads the queues any more
+        async def produce():
+            cancelled = False
+            try:
+                async for obsid in _aiter(obsids):
+                    await obsid_queue.put(str(obsid))
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    for _ in range(self.concurrency):
+                        await obsid_queue.put(None)
+
+        async def work(session:aiohttp.ClientSession):
+            cancelled = False
+            try:
+                while True:
+                    obsid = await obsid_queue.get()
+                    if obsid is None:
+                        break
+                    await result_queue.put(await handle(obsid,session))
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    await result_queue.put(None)
+
+        async with aiohttp.ClientSession(connector=self.connector()) as session:
+            tasks = [asyncio.ensure_future(produce())]
+            tasks += [asyncio.ensure_future(work(session)) for _ in range(self.concurrency)]
+            watched = set(tasks)
+            getter = None
+            try:
+                running = self.concurrency
+                while running:
+                    if getter is None:
+                        getter = asyncio.ensure_future(result_queue.get())
+                    # a task that fails is noticed without waiting for a result
+                    done,_ = await asyncio.wait({getter,*watched},return_when=asyncio.FIRST_COMPLETED)
+                    for task in done - {getter}:
+                        watched.discard(task)
+                        if task.exception() is not None:
+                            raise task.exception()
+                    if getter not in done:
+                        continue
+                    result,getter = getter.result(),None
+                    if result is None:
+                        running -= 1
+                        continue
+                    yield result
+                await asyncio.gather(*tasks)
+            finally:
+                if getter is not None:
+                    getter.cancel()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks,return_exceptions=True)
     
     @asyncio_decorator
     async def async_download_fits(self,
-            obsids_list:list[str]
+            obsids_list:Iterable|AsyncIterable
     ):       
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for obsid in obsids_list:
-                obsid = str(obsid)
-                task = self.download_single_fits(obsid=obsid
-                                            ,session=session)
-                tasks.append(task)
-            self.task_total = len(tasks)
-            
-            for future in asyncio.as_completed(tasks):
-                await future
+        async for obsid,_,status in self.iter_download(obsids_list):
+            if status=="failed" and self.manifest is None:
+                raise aiohttp.http_exceptions.HttpProcessingError(code=500
+                                                                  ,message="Download failed") from self.failed[obsid]
+
+
+def _parse_fits_bytes(data:bytes,transform:callable = None):
+    from astropy.io import fits # lazy load
+    from .io import FitsData
+    if data[:2]==b"\x1f\x8b":
+        # astropy only decompresses files it opens by name
+        data = gzip.decompress(data)
+    with fits.open(BytesIO(data)) as hdu:
+        fits_data = FitsData.from_hdu(hdu)
+    return fits_data if transform is None else transform(fits_data)
 
 
+async def _aiter(iterable:Iterable|AsyncIterable)->AsyncIterator:
+    if hasattr(iterable,"__aiter__"):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
 
-def download_fits(obsids_list:list[str]
+def download_fits(obsids_list:Iterable[str]|AsyncIterable[str]
                   ,dr_version:str
                   ,sub_version:str
                   ,is_dev:bool = False
@@ -121,12 +616,128 @@ def download_fits(obsids_list:list[str]
                   ,is_med:bool = False
                   ,sem_number:int = 5
                   ,max_retrys:int = 3
-                  ,save_dir:str = None):
-    
+                  ,save_dir:str = None
+                  ,resume:bool = False
+                  ,manifest_path:str = None
+                  ,base_url:str = None
+                  ,callbacks:Iterable[callable] = None
+                  ,limiter:AdaptiveLimiter = None):
+    # With `resume`, progress is kept in a JSONL manifest (default
+    # `<save_dir>/manifest.jsonl`): obsids already downloaded are skipped and
+    # failed ones are recorded instead of stopping the whole job.
+    # `callbacks` replace the default progress line (see `FitsDownloader._emit`),
+    # `limiter` (an `AdaptiveLimiter`) replaces the fixed `sem_number` and
+    # `base_url` points the requests at a mirror or a local test server
+    fits_downloader = _make_downloader(dr_version,sub_version,is_dev,TOKEN,is_med
+                                       ,sem_number,max_retrys,save_dir,resume,manifest_path
+                                       ,base_url=base_url,callbacks=callbacks,limiter=limiter)
+    manifest = fits_downloader.manifest
+    try:
+        res = fits_downloader.async_download_fits(obsids_list=obsids_list)
+    except BaseException:
+        if manifest is not None:
+            manifest.close()
+        raise
+    if manifest is not None:
+        # inside a running loop `res` is the task, the manifest lives as long as it
+        if isinstance(res,asyncio.Task):
+            res.add_done_callback(lambda _:manifest.close())
+        else:
+            manifest.close()
+    return res
+
+
+async def iter_download_fits(obsids:Iterable[str]|AsyncIterable[str]
+                             ,dr_version:str
+                             ,sub_version:str
+                             ,is_dev:bool = False
+                             ,TOKEN:str = None
+                             ,is_med:bool = False
+                             ,sem_number:int = 5
+                             ,max_retrys:int = 3
+                             ,save_dir:str = None
+                             ,resume:bool = False
+                             ,manifest_path:str = None
+                             ,queue_size:int = None
+                             ,base_url:str = None
+                             ,callbacks:Iterable[callable] = None
+                             ,limiter:AdaptiveLimiter = None)->AsyncIterator[tuple]:
+    """Download `obsids` and yield `(obsid,path,status)` as each one finishes.
+
+    Same options as `download_fits`; `obsids` can be a generator or an async
+    iterable of any length and is read through a bounded queue. Failed
+    downloads are yielded with status "failed" instead of raising.
+
+    ```
+    async for obsid,path,status in iter_download_fits(catalog_obsids(),"9","2.0"):
+        ...
+    ```
+    Wrap it in `contextlib.aclosing` to stop the workers right away when
+    leaving the loop early.
+    """
+    fits_downloader = _make_downloader(dr_version,sub_version,is_dev,TOKEN,is_med
+                                       ,sem_number,max_retrys,save_dir,resume,manifest_path
+                                       ,base_url=base_url,callbacks=callbacks,limiter=limiter)
+    try:
+        async for result in fits_downloader.iter_download(obsids,queue_size):
+            yield result
+    finally:
+        if fits_downloader.manifest is not None:
+            fits_downloader.manifest.close()
+
+
+async def iter_parse_fits(obsids:Iterable[str]|AsyncIterable[str]
+                          ,dr_version:str
+                          ,sub_version:str
+                          ,is_dev:bool = False
+                          ,TOKEN:str = None
+                          ,is_med:bool = False
+                          ,sem_number:int = 5
+                          ,max_retrys:int = 3
+                          ,transform:callable = None
+                          ,save_dir:str = None
+                          ,workers:int = None
+                          ,executor:str = "thread"
+                          ,queue_size:int = None
+                          ,base_url:str = None
+                          ,callbacks:Iterable[callable] = None
+                          ,limiter:AdaptiveLimiter = None)->AsyncIterator[tuple]:
+    """Download `obsids` and yield `(obsid,result,status)` without temporary files.
+
+    Each FITS file is parsed from memory into a `FitsData` (or
+    `transform(fits_data)`, e.g. Lick indices) on a thread or process pool
+    while the next downloads go on. The files are only written to disk if
+    `save_dir` is given.
+    """
+    fits_downloader = _make_downloader(dr_version,sub_version,is_dev,TOKEN,is_med
+                                       ,sem_number,max_retrys,save_dir,False,None
+                                       ,make_dir=save_dir is not None
+                                       ,base_url=base_url,callbacks=callbacks,limiter=limiter)
+    async for result in fits_downloader.iter_parse(obsids,transform,save_dir is not None
+                                                   ,workers,executor,queue_size):
+        yield result
+
+
+def _make_downloader(dr_version:str
+                     ,sub_version:str
+                     ,is_dev:bool
+                     ,TOKEN:str
+                     ,is_med:bool
+                     ,sem_number:int
+                     ,max_retrys:int
+                     ,save_dir:str
+                     ,resume:bool
+                     ,manifest_path:str
+                     ,make_dir:bool = True
+                     ,base_url:str = None
+                     ,callbacks:Iterable[callable] = None
+                     ,limiter:AdaptiveLimiter = None)->FitsDownloader:
     dr_version = f"dr{dr_version}" if "dr" not in dr_version else dr_version
     sub_version = f"v{sub_version}" if "v" not in sub_version else sub_version
     
-    if save_dir is None:
+    if not make_dir:
+        pass
+    elif save_dir is None:
         save_dir = f"./{dr_version}_{sub_version}"
         Path(save_dir).mkdir(exist_ok=True)
     else:
@@ -135,14 +746,20 @@ def download_fits(obsids_list:list[str]
             pass
         else:
             Path(save_dir).mkdir(exist_ok=True)
-    
-    fits_downloader = FitsDownloader(dr_version=dr_version
-                                     ,sub_version=sub_version
-                                     ,is_dev=is_dev
-                                     ,TOKEN=TOKEN
-                                     ,is_med=is_med
-                                     ,sem_number=sem_number
-                                     ,max_retrys=max_retrys
-                                     ,save_dir=save_dir)
-    
-    fits_downloader.async_download_fits(obsids_list=obsids_list)
\ No newline at end of file
+
+    manifest = None
+    if resume or manifest_path is not None:
+        manifest = DownloadManifest(manifest_path if manifest_path else Path(save_dir) / "manifest.jsonl")
+
+    return FitsDownloader(dr_version=dr_version
+                          ,sub_version=sub_version
+                          ,is_dev=is_dev
+                          ,TOKEN=TOKEN
+                          ,is_med=is_med
+                          ,sem_number=sem_number
+                          ,max_retrys=max_retrys
+                          ,save_dir=save_dir
+                          ,manifest=manifest
+                          ,base_url=base_url
+                          ,callbacks=callbacks
+                          ,limiter=limiter)
@@ -3,10 +3,17 @@
 
 from __future__ import annotations
 
+import os
+import hashlib
 import numpy
 
-from scipy.ndimage import median_filter
-from .io import FitsData
+from math import comb
+from pathlib import Path
+from .io import FitsData,SpectrumBatch
+from .processing import moving_median
+from .instrument import instrumented
+
+__all__ = ["SwFitting5d","fit_SwFitting5d_batch","normalize_continuum","ContinuumCache"]
 
 
 class SwFitting5d:
@@ -42,46 +49,14 @@ class SwFitting5d:
         self.band()
     
     
+    @instrumented
     def band(self):
-
-        try:
-            wavelength_set = numpy.reshape(self.wavelength,(self.window_num,-1))
-            flux_set = numpy.reshape(self.flux,(self.window_num,-1))
-        except Exception as e:
-            raise ValueError("the length of `wavelength` or `flux` "
-                            f"{len(self.wavelength)} div `window_num` {self.window_num} is not Integer") from e
-        # print(wavelength_set.shape,flux_set.shape)
-        
-        ws,fs = [],[]
-        for i in range(self.window_num):
-            w,f = choose_point(wavelength_set[i]
-                               ,flux_set[i],self.mean_filter_size,self.c)
-            ws.append(w)
-            fs.append(f)
-        
-        ws = numpy.concatenate(ws,axis=0)
-        fs = numpy.concatenate(fs,axis=0)
-        index = numpy.argsort(ws)
-        # index = range(len(ws))
-        # index = sorted(index,key=lambda i:ws[i])
-        ws = ws[index]
-        fs = fs[index]
-
-        for _ in range(self.max_iterate_nums):
-            F = numpy.polyfit(ws,fs,5)
-            fc = numpy.polyval(F,ws)
-            fn = fs / fc
-            a = numpy.mean(fn)
-            b = numpy.std(fn)
-            index = numpy.where((fn >= a - 3 * b) & (fn <= a + 3 * b))[0]
-            ws = ws[index]
-            fs = fs[index]
-
-            if index.shape[0] == 0:
-                break
-        # self.wavelength = ws
-        self.coef = F
-        # return self
+        self.coef = fit_SwFitting5d_batch(wavelength=self.wavelength
+                                          ,flux=self.flux[None,:]
+                                          ,window_num=self.window_num
+                                          ,mean_filter_size=self.mean_filter_size
+                                          ,c=self.c
+                                          ,max_iterate_nums=self.max_iterate_nums)[0]
     
     def __call__(self
                  ,fits_data:FitsData
@@ -107,6 +82,275 @@ class SwFitting5d:
 
 
 
+@instrumented
+def fit_SwFitting5d_batch(spectra:SpectrumBatch = None
+                          ,*
+                          ,wavelength:numpy.ndarray = None
+                          ,flux:numpy.ndarray = None
+                          ,window_num:int = 10
+                          ,mean_filter_size:int = 50
+                          ,c:int = 5
+                          ,max_iterate_nums:int = 10
+                          ,chunk_size:int = 128)->numpy.ndarray:
+    """Statistical window continuum fit of many spectra at once.
+
+    Same algorithm as `SwFitting5d`, but the windows of all spectra are
+    median filtered, ranked and selected as one array, and the sigma-clipped
+    degree-5 fits are solved as a stack of least squares problems. `wavelength`
+    is either shared (npix,) or per spectrum (N,npix). Returns the polynomial
+    coefficients (N,6), highest degree first as in `numpy.polyfit`.
+    """
+    if (wavelength is None or flux is None) and spectra is None:
+        raise ValueError("must provide either `wavelength` and `flux` or `spectra`")
+
+    if spectra is not None and (wavelength is not None or flux is not None):
+        raise ValueError("must provide either `wavelength` and `flux` or `spectra`")
+
+    if spectra is not None:
+        wavelength = spectra.wavelength
+        flux = spectra.flux
+
+    flux = numpy.atleast_2d(numpy.asarray(flux,dtype=float))
+    wavelength = numpy.asarray(wavelength,dtype=float)
+    if flux.shape[-1] % window_num!=0:
+        raise ValueError("the length of `wavelength` or `flux` "
+                        f"{flux.shape[-1]} div `window_num` {window_num} is not Integer")
+
+    coef = numpy.empty((len(flux),6))
+    for start in range(0,len(flux),chunk_size):
+        end = start + chunk_size
+        mask = choose_point_batch(flux[start:end],window_num,mean_filter_size,c)
+        chunk_wavelength = wavelength if wavelength.ndim==1 else wavelength[start:end]
+        coef[start:end] = _clipped_polyfit(chunk_wavelength,flux[start:end]
+                                           ,mask,max_iterate_nums)
+    return coef
+
+
+class ContinuumCache:
+    """Continuum fit coefficients, in memory and optionally in `directory`.
+
+    Keys combine the obsid, the fit method and parameters and a digest of the
+    wavelength and flux, so a spectrum that went through a different
+    preprocessing never hits a stale fit. With a `directory` every fit is
+    also saved as `<key>.npy` and is found again by later processes.
+    """
+    def __init__(self,directory:str = None):
+        self.directory = None if directory is None else Path(directory)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True,exist_ok=True)
+        self.memory = dict()
+
+    @staticmethod
+    def key(obsid,method:str,params:dict
+            ,wavelength:numpy.ndarray,flux:numpy.ndarray)->str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((method,sorted(params.items()))).encode())
+        digest.update(numpy.ascontiguousarray(wavelength,dtype=float).tobytes())
+        digest.update(numpy.ascontiguousarray(flux,dtype=float).tobytes())
+        return f"{obsid}-{digest.hexdigest()}"
+
+    def get(self,key:str)->numpy.ndarray:
+        coef = self.memory.get(key)
+        if coef is None and self.directory is not None:
+            path = self.directory / f"{key}.npy"
+            if path.exists():
+                coef = numpy.load(path)
+                self.memory[key] = coef
+        return coef
+
+    def set(self,key:str,coef:numpy.ndarray):
+        self.memory[key] = coef
+        if self.directory is not None:
+            path = self.directory / f"{key}.npy"
+            tmp_path = self.directory / f".{key}.{os.getpid()}.tmp.npy"
+            numpy.save(tmp_path,coef)
+            os.replace(tmp_path,path)
+
+    def __len__(self):
+        return len(self.memory)
+
+
+default_continuum_cache = ContinuumCache()
+
+_CONTINUUM_METHODS = {"sw5d":fit_SwFitting5d_batch}
+# defaults are merged into the parameters so that equivalent calls share cache keys
+_CONTINUUM_DEFAULTS = {"sw5d":{"window_num":10,"mean_filter_size":50,"c":5,"max_iterate_nums":10}}
+
+
+@instrumented
+def normalize_continuum(spectra:FitsData|SpectrumBatch
+                        ,method:str = "sw5d"
+                        ,cache:ContinuumCache|bool = None
+                        ,**params)->FitsData|SpectrumBatch:
+    """Divide the spectra by their fitted continuum.
+
+    `params` go to the fit (`window_num`, `mean_filter_size`, `c`,
+    `max_iterate_nums` for "sw5d"). `cache` is a `ContinuumCache`, or `True`
+    for the in-memory `default_continuum_cache`. The result carries the
+    fit as `continuum_coef` and `continuum`.
+    """
+    if method not in _CONTINUUM_METHODS:
+        raise ValueError(f"unknown continuum method {method!r}, "
+                         f"available: {list(_CONTINUUM_METHODS)}")
+    if cache is True:
+        cache = default_continuum_cache
+    elif cache is False:
+        cache = None
+    params = {**_CONTINUUM_DEFAULTS[method],**params}
+
+    is_batch = isinstance(spectra,SpectrumBatch)
+    flux = numpy.atleast_2d(numpy.asarray(spectra.flux,dtype=float))
+    wavelength = numpy.asarray(spectra.wavelength,dtype=float)
+    coef = numpy.empty((len(flux),6))
+    missing = numpy.arange(len(flux))
+
+    keys = None
+    if cache is not None:
+        obsids = _get_obsids(spectra,len(flux))
+        keys = [ContinuumCache.key(obsid,method,params
+                                   ,wavelength if wavelength.ndim==1 else wavelength[i]
+                                   ,flux[i])
+                for i,obsid in enumerate(obsids)]
+        cached = [cache.get(key) for key in keys]
+        missing = numpy.asarray([i for i,value in enumerate(cached) if value is None],dtype=int)
+        for i,value in enumerate(cached):
+            if value is not None:
+                coef[i] = value
+
+    if len(missing)>0:
+        missing_wavelength = wavelength if wavelength.ndim==1 else wavelength[missing]
+        coef[missing] = _CONTINUUM_METHODS[method](wavelength=missing_wavelength
+                                                  ,flux=flux[missing],**params)
+        if cache is not None:
+            for i in missing:
+                cache.set(keys[i],coef[i])
+
+    continuum = _polyval_rows(coef,wavelength)
+    if not is_batch:
+        coef,continuum,flux = coef[0],continuum[0],flux[0]
+    # the masks are kept, the inverse variance scales with the continuum squared
+    extras = {"andmask":spectra.andmask,"orimask":spectra.orimask
+              ,"ivar":None if spectra.ivar is None else spectra.ivar * continuum ** 2}
+    if is_batch:
+        res = SpectrumBatch(spectra.wavelength,flux / continuum,spectra.header,**extras)
+    else:
+        res = FitsData(spectra.wavelength,flux / continuum,spectra.header,**extras)
+    res.continuum_coef = coef
+    res.continuum = continuum
+    return res
+
+
+def _get_obsids(spectra:FitsData|SpectrumBatch,size:int)->list:
+    header = spectra.header
+    if header is None:
+        return [None] * size
+    if isinstance(spectra,SpectrumBatch):
+        if "obsid" in (header.dtype.names or ()):
+            return header["obsid"].tolist()
+        return [None] * size
+    return [header.get("obsid")]
+
+
+def _polyval_rows(coef:numpy.ndarray,wavelength:numpy.ndarray)->numpy.ndarray:
+    # `numpy.polyval` of every row of `coef` on a shared or per-row wavelength
+    res = numpy.zeros(numpy.broadcast_shapes((len(coef),1),wavelength.shape))
+    for k in range(coef.shape[-1]):
+        res = res * wavelength + coef[:,k:k + 1]
+    return res
+
+
+@instrumented
+def choose_point_batch(flux:numpy.ndarray
+                       ,window_num:int
+                       ,mean_filter_size:int
+                       ,c:float)->numpy.ndarray:
+    # `choose_point` for every window of every spectrum, as a mask (N,npix)
+    spectrum_num,pixel_num = flux.shape
+    window_size = pixel_num // window_num
+    flux_set = flux.reshape(spectrum_num,window_num,window_size)
+
+    m = moving_median(flux_set,mean_filter_size)
+    snr = numpy.sum(numpy.abs(flux_set - m),axis=-1) / numpy.sum(m,axis=-1)
+    U = compute_Ulimit(snr,c) * 1e-2 # the uints is `%`
+    L = compute_Llimit(snr,c) * 1e-2 # the uints is `%`
+    index_start = (L * window_size).astype(int)
+    index_end = (U * window_size).astype(int)
+
+    rank = numpy.arange(window_size)
+    chosen = (rank>=index_start[...,None]) & (rank<=index_end[...,None])
+    mask = numpy.empty_like(chosen)
+    numpy.put_along_axis(mask,numpy.argsort(flux_set,axis=-1),chosen,axis=-1)
+    return mask.reshape(spectrum_num,pixel_num)
+
+
+@instrumented
+def _clipped_polyfit(wavelength:numpy.ndarray
+                     ,flux:numpy.ndarray
+                     ,mask:numpy.ndarray
+                     ,max_iterate_nums:int
+                     ,deg:int = 5)->numpy.ndarray:
+    # the fits are done in `t = (wavelength - center) / half_width`, which keeps
+    # the normal equations well conditioned, and converted back at the end
+    lower,upper = numpy.min(wavelength),numpy.max(wavelength)
+    center = (upper + lower) / 2
+    half_width = (upper - lower) / 2 if upper>lower else 1.0
+    # powers of `t` up to `2*deg`: (npix,2*deg+1) if shared, else (N,npix,2*deg+1)
+    powers = ((wavelength - center) / half_width)[...,None] ** numpy.arange(2 * deg + 1)
+    shared = powers.ndim==2
+
+    coef = numpy.zeros((len(flux),deg + 1))
+    active = numpy.arange(len(flux))
+    for _ in range(max_iterate_nums):
+        if len(active)==0:
+            break
+        f,m = flux[active],mask[active]
+        p = powers if shared else powers[active]
+        F = _masked_polyfit(p,f,m,deg)
+        coef[active] = F
+        if shared:
+            fc = F @ p[:,:deg + 1].T
+        else:
+            fc = numpy.einsum("npk,nk->np",p[...,:deg + 1],F)
+        fn = f / fc
+        count = numpy.sum(m,axis=-1,keepdims=True)
+        a = numpy.sum(numpy.where(m,fn,0),axis=-1,keepdims=True) / count
+        b = numpy.sqrt(numpy.sum(numpy.where(m,(fn - a) ** 2,0),axis=-1,keepdims=True) / count)
+        m = m & (fn >= a - 3 * b) & (fn <= a + 3 * b)
+        mask[active] = m
+        # like the single spectrum loop, stop fitting a spectrum once no point survives
+        active = active[numpy.any(m,axis=-1)]
+    return _to_polyfit_coef(coef,center,half_width)
+
+
+def _masked_polyfit(powers:numpy.ndarray
+                    ,flux:numpy.ndarray
+                    ,mask:numpy.ndarray
+                    ,deg:int)->numpy.ndarray:
+    # least squares over the masked points of every row, from the moments
+    # `sum(t**k)`, returns ascending coefficients in `t` (N,deg+1)
+    weight = mask.astype(float)
+    if powers.ndim==2:
+        moments = weight @ powers
+        rhs = (weight * flux) @ powers[:,:deg + 1]
+    else:
+        moments = numpy.einsum("np,npk->nk",weight,powers)
+        rhs = numpy.einsum("np,npk->nk",weight * flux,powers[...,:deg + 1])
+    k = numpy.arange(deg + 1)
+    gram = moments[:,k[:,None] + k[None,:]]
+    return (numpy.linalg.pinv(gram) @ rhs[...,None])[...,0]
+
+
+def _to_polyfit_coef(coef:numpy.ndarray,center:float,half_width:float)->numpy.ndarray:
+    # expand `sum(a_k * ((x - center) / half_width) ** k)` into powers of `x`,
+    # highest degree first as `numpy.polyfit` returns them
+    deg = coef.shape[-1] - 1
+    transform = numpy.zeros((deg + 1,deg + 1))
+    for k in range(deg + 1):
+        for j in range(k + 1):
+            transform[k,j] = comb(k,j) * (-center) ** (k - j) / half_width ** k
+    return (coef @ transform)[:,::-1]
+
+
 # FIXME: This function may has some problems
 def Heaviside_function(s,c):
     return 0.5  * (1 + (2.0 / numpy.pi) * numpy.arctan(s / c))
@@ -129,13 +373,14 @@ def compute_SNR(f:numpy.ndarray,m:numpy.ndarray):
     return snr
 
 
+@instrumented
 def choose_point(wavelength:numpy.ndarray
                  ,flux:numpy.ndarray
                  ,mean_filter_size:int
                  ,c:float):
     # wavelength = wavelength.copy()
     # flux = flux.copy()
-    m = median_filter(flux,size=mean_filter_size)
+    m = moving_median(flux,mean_filter_size)
     snr = compute_SNR(flux,m)
     U = compute_Ulimit(snr,c) * 1e-2 # the uints is `%`
     L = compute_Llimit(snr,c) * 1e-2 # the uints is `%`
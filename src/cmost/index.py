@@ -0,0 +1,308 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+
+from __future__ import annotations
+
+import json
+import numpy
+
+from pathlib import Path
+
+from .instrument import instrumented
+
+__all__ = ["SpectrumIndex"]
+
+# An index is a directory, like a `SpectrumStore`:
+#
+#   meta.json       options and shapes
+#   mean.npy        mean of the prepared fluxes (M,)
+#   components.npy  projection onto the reduced space (D,M)
+#   centroids.npy   k-means centroids of the inverted lists (L,D)
+#   offsets.npy     list `l` is rows `offsets[l]:offsets[l+1]` of `vectors`
+#   vectors.npy     projected spectra sorted by list (N,D), memory-mapped on `open`
+#   obsids.npy      obsid of every row of `vectors` (N,)
+#   wavelength.npy  common wavelength grid, if known
+
+_INDEX_VERSION = 1
+
+
+class SpectrumIndex:
+    """Approximate nearest neighbours of spectra on a common wavelength grid.
+
+    Fluxes are scaled to unit norm (with `normalize`), projected onto `dim`
+    PCA components (or a random Gaussian projection) and split into inverted
+    lists by k-means. A query scans the `n_probe` lists whose centroids are
+    the nearest, so distances are Euclidean in the projected space.
+    """
+    def __init__(self,mean:numpy.ndarray
+                 ,components:numpy.ndarray
+                 ,centroids:numpy.ndarray
+                 ,offsets:numpy.ndarray
+                 ,vectors:numpy.ndarray
+                 ,obsids:numpy.ndarray
+                 ,normalize:bool = True
+                 ,wavelength:numpy.ndarray = None):
+        self.mean = mean
+        self.components = components
+        self.centroids = centroids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.obsids = obsids
+        self.normalize = normalize
+        self.wavelength = wavelength
+
+    @classmethod
+    @instrumented
+    def build(cls,flux:numpy.ndarray
+              ,obsids:numpy.ndarray = None
+              ,dim:int = 32
+              ,n_lists:int = None
+              ,projection:str = "pca"
+              ,normalize:bool = True
+              ,sample_size:int = 20000
+              ,iterations:int = 20
+              ,batch_size:int = 4096
+              ,seed:int = 0
+              ,wavelength:numpy.ndarray = None)->SpectrumIndex:
+        """Index the rows of the aligned `flux` matrix `(N,M)`.
+
+        `flux` can be a memory-mapped array (e.g. `SpectrumStore.flux`): the
+        projection and the centroids are fitted on `sample_size` random rows
+        and the rest is read `batch_size` rows at a time. `n_lists` defaults
+        to `sqrt(N)`. `obsids` default to the row numbers.
+        """
+        if projection not in ("pca","random"):
+            raise ValueError("`projection` must be 'pca' or 'random'")
+        if getattr(flux,"ndim",None)!=2:
+            raise ValueError("`flux` must be a 2-D array (spectra,pixels)")
+        size,pixel_num = flux.shape
+        if size==0:
+            raise ValueError("`flux` is empty")
+        obsids = numpy.arange(size,dtype=numpy.int64) if obsids is None else numpy.asarray(obsids,dtype=numpy.int64)
+        if len(obsids)!=size:
+            raise ValueError("`obsids` and `flux` have different lengths")
+        if wavelength is not None and len(wavelength)!=pixel_num:
+            raise ValueError("`wavelength` and `flux` have different pixel numbers")
+
+        rng = numpy.random.default_rng(seed)
+        rows = numpy.sort(rng.choice(size,min(size,sample_size),replace=False))
+        sample = _prepare(flux[rows],normalize)
+        mean = sample.mean(axis=0)
+        dim = min(dim,pixel_num) if projection=="random" else min(dim,pixel_num,len(sample))
+        if projection=="pca":
+            components = _pca_components(sample - mean,dim,rng)
+        else:
+            components = rng.standard_normal((dim,pixel_num)) / numpy.sqrt(dim)
+        components = numpy.ascontiguousarray(components,dtype=numpy.float32)
+
+        n_lists = int(numpy.sqrt(size)) if n_lists is None else n_lists
+        n_lists = max(1,min(n_lists,len(sample)))
+        centroids = _kmeans((sample - mean) @ components.T,n_lists,iterations,rng)
+
+        vectors = numpy.empty((size,dim),dtype=numpy.float32)
+        for start in range(0,size,batch_size):
+            vectors[start:start+batch_size] = (_prepare(flux[start:start+batch_size],normalize) - mean) @ components.T
+        labels = _nearest(vectors,centroids,batch_size)
+        order = numpy.argsort(labels,kind="stable")
+        offsets = numpy.zeros(n_lists+1,dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(labels,minlength=n_lists))
+        return cls(mean,components,centroids,offsets,vectors[order],obsids[order]
+                   ,normalize,None if wavelength is None else numpy.asarray(wavelength,dtype=float))
+
+    @classmethod
+    def from_store(cls,store,**options)->SpectrumIndex:
+        # `store` is a `SpectrumStore`, its aligned fluxes stay memory-mapped
+        return cls.build(store.flux,store.obsids,wavelength=store.wavelength,**options)
+
+    @classmethod
+    def from_batch(cls,batch,**options)->SpectrumIndex:
+        # `batch` is a `SpectrumBatch` on a common grid, with an `obsid` header column
+        return cls.build(batch.flux,batch.header["obsid"],wavelength=batch.wavelength,**options)
+
+    def __len__(self):
+        return len(self.obsids)
+
+    @property
+    def dim(self)->int:
+        return self.components.shape[0]
+
+    @property
+    def n_lists(self)->int:
+        return len(self.centroids)
+
+    def project(self,flux:numpy.ndarray)->numpy.ndarray:
+        return (_prepare(flux,self.normalize) - self.mean) @ self.components.T
+
+    @instrumented
+    def search(self,flux:numpy.ndarray
+               ,k:int = 10
+               ,n_probe:int = 8
+               ,batch_size:int = 1024)->tuple[numpy.ndarray,numpy.ndarray]:
+        """The `k` nearest spectra of every query.
+
+        `flux` is one spectrum `(M,)`, a matrix `(Q,M)` on the grid of the
+        index, or an object with a `flux` attribute (`FitsData`,
+        `SpectrumBatch`). Returns `(obsids,distances)` of shape `(Q,k)`
+        (`(k,)` for one spectrum), nearest first. Missing neighbours, when
+        the probed lists hold fewer than `k` spectra, have obsid -1 and an
+        infinite distance.
+        """
+        flux = getattr(flux,"flux",flux)
+        flux = numpy.asarray(flux)
+        single = flux.ndim==1
+        flux = numpy.atleast_2d(flux)
+        if flux.shape[1]!=self.components.shape[1]:
+            raise ValueError(f"`flux` has {flux.shape[1]} pixels, the index {self.components.shape[1]}")
+        if k<1:
+            raise ValueError("`k` must be positive")
+
+        obsids = numpy.empty((len(flux),k),dtype=numpy.int64)
+        distances = numpy.empty((len(flux),k),dtype=numpy.float32)
+        for start in range(0,len(flux),batch_size):
+            stop = start + batch_size
+            obsids[start:stop],distances[start:stop] = self._search_batch(self.project(flux[start:stop]),k
+                                                                          ,min(n_probe,self.n_lists))
+        if single:
+            return obsids[0],distances[0]
+        return obsids,distances
+
+    def _search_batch(self,queries:numpy.ndarray,k:int,n_probe:int)->tuple[numpy.ndarray,numpy.ndarray]:
+        # the queries are grouped by probed list, so that each list is
+        # compared with all of its queries at once
+        best = numpy.full((len(queries),k),numpy.inf,dtype=numpy.float32)
+        best_rows = numpy.full((len(queries),k),-1,dtype=numpy.int64)
+        probed = _smallest(_sq_distances(queries,self.centroids),n_probe).ravel()
+        query_ids = numpy.repeat(numpy.arange(len(queries)),n_probe)
+        order = numpy.argsort(probed,kind="stable")
+        probed,query_ids = probed[order],query_ids[order]
+        bounds = numpy.flatnonzero(numpy.diff(probed)) + 1
+        for list_id,ids in zip(probed[numpy.r_[0,bounds]].tolist(),numpy.split(query_ids,bounds)):
+            start,end = self.offsets[list_id],self.offsets[list_id+1]
+            if start==end:
+                continue
+            candidates = numpy.hstack([best[ids],_sq_distances(queries[ids],self.vectors[start:end])])
+            rows = numpy.hstack([best_rows[ids],numpy.broadcast_to(numpy.arange(start,end),(len(ids),end-start))])
+            top = _smallest(candidates,k)
+            best[ids] = numpy.take_along_axis(candidates,top,axis=1)
+            best_rows[ids] = numpy.take_along_axis(rows,top,axis=1)
+
+        order = numpy.argsort(best,axis=1,kind="stable")
+        best = numpy.take_along_axis(best,order,axis=1)
+        best_rows = numpy.take_along_axis(best_rows,order,axis=1)
+        obsids = numpy.where(best_rows>=0,self.obsids[numpy.maximum(best_rows,0)],-1)
+        return obsids,numpy.sqrt(numpy.maximum(best,0))
+
+    def save(self,path:str):
+        path = Path(path)
+        path.mkdir(parents=True,exist_ok=True)
+        (path / "meta.json").unlink(missing_ok=True)
+        for name in ("mean","components","centroids","offsets","vectors","obsids"):
+            numpy.save(path / f"{name}.npy",numpy.asarray(getattr(self,name)))
+        if self.wavelength is not None:
+            numpy.save(path / "wavelength.npy",self.wavelength)
+        meta = {"version":_INDEX_VERSION
+                ,"size":len(self)
+                ,"dim":self.dim
+                ,"n_lists":self.n_lists
+                ,"normalize":self.normalize
+                ,"wavelength":self.wavelength is not None}
+        # `meta.json` is written last, an index without it is incomplete
+        with open(path / "meta.json","w",encoding="utf-8") as file:
+            json.dump(meta,file,indent=2)
+
+    @classmethod
+    def open(cls,path:str,mmap:bool = True)->SpectrumIndex:
+        # with `mmap` the vectors and obsids stay on disk, only the probed lists are read
+        path = Path(path)
+        with open(path / "meta.json","r",encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta.get("version")!=_INDEX_VERSION:
+            raise ValueError(f"unsupported index version {meta.get('version')}")
+        mmap_mode = "r" if mmap else None
+        return cls(numpy.load(path / "mean.npy")
+                   ,numpy.load(path / "components.npy")
+                   ,numpy.load(path / "centroids.npy")
+                   ,numpy.load(path / "offsets.npy")
+                   ,numpy.load(path / "vectors.npy",mmap_mode=mmap_mode)
+                   ,numpy.load(path / "obsids.npy",mmap_mode=mmap_mode)
+                   ,meta["normalize"]
+                   ,numpy.load(path / "wavelength.npy") if meta["wavelength"] else None)
+
+    def __repr__(self):
+        return f"SpectrumIndex(size={len(self)},dim={self.dim},n_lists={self.n_lists})"
+
+
+def _prepare(flux:numpy.ndarray,normalize:bool)->numpy.ndarray:
+    # float32, `nan` pixels set to 0, and each spectrum scaled to unit norm
+    flux = numpy.nan_to_num(numpy.asarray(flux,dtype=numpy.float32),nan=0.0,posinf=0.0,neginf=0.0)
+    if normalize:
+        norm = numpy.linalg.norm(flux,axis=-1,keepdims=True)
+        flux = flux / numpy.where(norm>0,norm,1)
+    return flux
+
+
+def _pca_components(centered:numpy.ndarray
+                    ,dim:int
+                    ,rng:numpy.random.Generator
+                    ,oversampling:int = 10
+                    ,power_iterations:int = 4)->numpy.ndarray:
+    # leading right singular vectors by a randomized SVD (Halko et al. 2011),
+    # a full SVD of the sample costs O(sample_size*pixel_num**2)
+    rank = dim + oversampling
+    if rank>=min(centered.shape):
+        return numpy.linalg.svd(centered,full_matrices=False)[2][:dim]
+    basis = centered @ rng.standard_normal((centered.shape[1],rank)).astype(centered.dtype)
+    for _ in range(power_iterations):
+        basis = numpy.linalg.qr(basis)[0]
+        basis = centered @ (centered.T @ basis)
+    basis = numpy.linalg.qr(basis)[0]
+    return numpy.linalg.svd(basis.T @ centered,full_matrices=False)[2][:dim]
+
+
+def _sq_distances(a:numpy.ndarray,b:numpy.ndarray)->numpy.ndarray:
+    # squared Euclidean distances between the rows of `a` and of `b`
+    res = a @ b.T
+    res *= -2
+    res += numpy.einsum("ij,ij->i",a,a)[:,None]
+    res += numpy.einsum("ij,ij->i",b,b)[None,:]
+    return res
+
+
+def _smallest(values:numpy.ndarray,k:int)->numpy.ndarray:
+    # column indices of the `k` smallest values of every row, unordered
+    if k>=values.shape[1]:
+        return numpy.broadcast_to(numpy.arange(values.shape[1]),values.shape).copy()
+    return numpy.argpartition(values,k-1,axis=1)[:,:k]
+
+
+def _nearest(vectors:numpy.ndarray,centroids:numpy.ndarray,batch_size:int = 4096)->numpy.ndarray:
+    labels = numpy.empty(len(vectors),dtype=numpy.int64)
+    for start in range(0,len(vectors),batch_size):
+        labels[start:start+batch_size] = numpy.argmin(_sq_distances(vectors[start:start+batch_size],centroids),axis=1)
+    return labels
+
+
+def _kmeans(vectors:numpy.ndarray
+            ,n_clusters:int
+            ,iterations:int
+            ,rng:numpy.random.Generator)->numpy.ndarray:
+    # Lloyd's iterations from random rows; empty clusters restart from the
+    # rows farthest from their centroid
+    vectors = numpy.asarray(vectors,dtype=numpy.float32)
+    centroids = vectors[rng.choice(len(vectors),n_clusters,replace=False)].copy()
+    labels = None
+    for _ in range(iterations):
+        new_labels = _nearest(vectors,centroids)
+        if labels is not None and numpy.array_equal(labels,new_labels):
+            break
+        labels = new_labels
+        counts = numpy.bincount(labels,minlength=n_clusters)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums,labels,vectors)
+        filled = counts>0
+        centroids[filled] = sums[filled] / counts[filled,None]
+        empty = numpy.flatnonzero(~filled)
+        if len(empty):
+            errors = numpy.sum((vectors - centroids[labels]) ** 2,axis=1)
+            centroids[empty] = vectors[numpy.argsort(errors)[::-1][:len(empty)]]
+    return centroids
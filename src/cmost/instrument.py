@@ -0,0 +1,193 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+"""Opt-in call counts and timings of the public functions of cmost.
+
+```
+from cmost import instrument
+
+with instrument.profile() as stats:
+    spectra,failed = cmost.read_fits_many("spectra/*.fits",as_batch=True)
+    compute_LickLineIndices_batch(spectra)
+print(instrument.format_table(stats))
+```
+
+Every instrumented function records its number of calls, cumulative wall
+and CPU time (inclusive of the instrumented functions it calls) and the
+number of array elements it was given. Calls made in the worker processes
+of `read_fits_many`, `read_headers`, `Pipeline` and
+`compute_LickLineIndices_batch` are sent back and merged. While disabled
+each call costs one flag check.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import numpy
+
+from functools import partial,wraps
+from contextlib import contextmanager
+
+__all__ = ["enable","disable","is_enabled","reset","profile","instrumented"
+           ,"stats","merge","to_table","format_table","to_json","report"]
+
+_enabled = False
+# name -> [calls,wall,cpu,elements]
+_stats = dict()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled()->bool:
+    return _enabled
+
+
+def reset():
+    _stats.clear()
+
+
+@contextmanager
+def profile(reset_stats:bool = True):
+    """Enable the instrumentation inside the block.
+
+    The yielded dict is filled with `stats()` when the block exits.
+    """
+    was_enabled = _enabled
+    if reset_stats:
+        reset()
+    enable()
+    res = dict()
+    try:
+        yield res
+    finally:
+        if not was_enabled:
+            disable()
+        res.update(stats())
+
+
+def instrumented(func:callable = None,*,name:str = None)->callable:
+    # `@instrumented` or `@instrumented(name=...)`, the default name is
+    # `module.qualname` without the `cmost.` prefix
+    if func is None:
+        return lambda func:instrumented(func,name=name)
+    if name is None:
+        name = f"{func.__module__.rpartition('.')[2]}.{func.__qualname__}"
+
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+        if not _enabled:
+            return func(*args,**kwargs)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            record = _stats.get(name)
+            if record is None:
+                record = _stats[name] = [0,0.0,0.0,0]
+            record[0] += 1
+            record[1] += wall
+            record[2] += cpu
+            record[3] += _elements(args) + _elements(kwargs.values())
+    return wrapper
+
+
+def _elements(values)->int:
+    # arrays, and the flux of batches and spectra already in memory
+    size = 0
+    for value in values:
+        if isinstance(value,numpy.ndarray):
+            size += value.size
+        else:
+            flux = getattr(value,"__dict__",{}).get("flux",getattr(value,"_flux",None))
+            if isinstance(flux,numpy.ndarray):
+                size += flux.size
+    return size
+
+
+def stats()->dict:
+    """`{name:{"calls","wall","cpu","elements"}}` recorded so far."""
+    return {name:{"calls":calls,"wall":wall,"cpu":cpu,"elements":elements}
+            for name,(calls,wall,cpu,elements) in _stats.items()}
+
+
+def merge(other:dict):
+    """Add the `stats()` of another process."""
+    for name,values in other.items():
+        record = _stats.get(name)
+        if record is None:
+            record = _stats[name] = [0,0.0,0.0,0]
+        record[0] += values["calls"]
+        record[1] += values["wall"]
+        record[2] += values["cpu"]
+        record[3] += values["elements"]
+
+
+def _collect(func:callable,*args)->tuple:
+    # runs in a worker process: `(func(*args),stats of this call)`; the
+    # stats inherited from a forked parent are dropped first
+    enable()
+    reset()
+    try:
+        return func(*args),stats()
+    finally:
+        reset()
+
+
+def _for_workers(func:callable,executor:str)->tuple[callable,bool]:
+    # `(func,collect)`: with `collect`, `func` returns `(result,stats)` and
+    # the results go through `_from_workers`
+    if _enabled and executor=="process":
+        return partial(_collect,func),True
+    return func,False
+
+
+def _from_workers(res,collect:bool):
+    if not collect:
+        return res
+    res,worker_stats = res
+    merge(worker_stats)
+    return res
+
+
+def to_table(stats_:dict = None)->numpy.ndarray:
+    """Structured array `(name,calls,wall,cpu,elements)`, slowest first."""
+    stats_ = stats() if stats_ is None else stats_
+    table = numpy.empty(len(stats_),dtype=[("name",f"U{max([len(name) for name in stats_],default=1)}")
+                                           ,("calls",numpy.int64),("wall",float)
+                                           ,("cpu",float),("elements",numpy.int64)])
+    for i,(name,values) in enumerate(stats_.items()):
+        table[i] = (name,values["calls"],values["wall"],values["cpu"],values["elements"])
+    return table[numpy.argsort(-table["wall"],kind="stable")]
+
+
+def format_table(stats_:dict = None)->str:
+    table = to_table(stats_)
+    width = max([len(name) for name in table["name"]] + [8])
+    lines = [f"{'function':<{width}}{'calls':>10}{'wall (s)':>12}{'cpu (s)':>12}{'per call (ms)':>15}{'elements':>14}"]
+    for name,calls,wall,cpu,elements in table.tolist():
+        lines.append(f"{name:<{width}}{calls:>10}{wall:>12.4f}{cpu:>12.4f}"
+                     f"{1000 * wall / max(calls,1):>15.3f}{elements:>14}")
+    return "\n".join(lines)
+
+
+def to_json(path:str = None,stats_:dict = None)->str:
+    text = json.dumps(stats() if stats_ is None else stats_,indent=2)
+    if path is not None:
+        with open(path,"w",encoding="utf-8") as file:
+            file.write(text)
+    return text
+
+
+def report(file = None):
+    print(format_table(),file=sys.stderr if file is None else file)
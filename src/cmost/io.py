@@ -3,22 +3,112 @@
 
 from __future__ import annotations
 
-__all__ = ["read_fits","read_header"]
+__all__ = ["read_fits","read_header","read_headers","read_fits_many","SpectrumBatch"]
 
+import os
 import re
+import glob
+import gzip
+import contextlib
 import numpy
 
-from astropy.io import fits
-from .processing import minmax_function,align_wavelength,remove_redshift,median_filter
+from collections import deque
+from collections.abc import MutableMapping
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+from typing import Iterable,Iterator
+
+from . import instrument
+from .instrument import instrumented
+from .processing import minmax_function,align_wavelength,remove_redshift,median_filter,Resampler,redshift_resampler
 
 class FitsData:
+    # no per-instance `__dict__`, see `compact` for the float32 storage
+    __slots__ = ("_wavelength","_flux","_andmask","_orimask","_ivar","_loader","header"
+                 ,"continuum","continuum_coef")
+
     def __init__(self,wavelength:numpy.ndarray
-                    ,flux:numpy.ndarray,header = None):
+                    ,flux:numpy.ndarray,header = None
+                    ,*
+                    ,andmask:numpy.ndarray = None
+                    ,orimask:numpy.ndarray = None
+                    ,ivar:numpy.ndarray = None
+                    ,loader:_LazyFitsLoader = None):
         
-        self.wavelength = wavelength
-        self.flux = flux
+        self._wavelength = wavelength
+        self._flux = flux
+        self._andmask = andmask
+        self._orimask = orimask
+        self._ivar = ivar
+        self._loader = loader
         self.header = header
 
+    # In lazy mode (`read_fits(...,lazy=True)`) the arrays are `None` until
+    # their first access, then they are read from the memory-mapped file.
+    @property
+    def wavelength(self)->numpy.ndarray:
+        if self._wavelength is None and self._loader is not None:
+            self._wavelength = self._loader.load("wavelength")
+        return self._wavelength
+
+    @wavelength.setter
+    def wavelength(self,value:numpy.ndarray):
+        self._wavelength = value
+
+    @property
+    def flux(self)->numpy.ndarray:
+        if self._flux is None and self._loader is not None:
+            self._flux = self._loader.load("flux")
+        return self._flux
+
+    @flux.setter
+    def flux(self,value:numpy.ndarray):
+        self._flux = value
+
+    @property
+    def andmask(self)->numpy.ndarray:
+        if self._andmask is None and self._loader is not None:
+            self._andmask = self._loader.load("andmask")
+            self._update_bad_points()
+        return self._andmask
+
+    @property
+    def orimask(self)->numpy.ndarray:
+        if self._orimask is None and self._loader is not None:
+            self._orimask = self._loader.load("orimask")
+            self._update_bad_points()
+        return self._orimask
+
+    @property
+    def ivar(self)->numpy.ndarray:
+        # inverse variance of `flux`
+        if self._ivar is None and self._loader is not None:
+            self._ivar = self._loader.load("ivar")
+        return self._ivar
+
+    @property
+    def is_lazy(self)->bool:
+        # `True` while some of the arrays are still on disk
+        return self._loader is not None and not self._loader.is_complete
+
+    def _update_bad_points(self):
+        if self._andmask is None or self._orimask is None:
+            return
+        if numpy.sum(self._orimask)>0 or numpy.sum(self._andmask)>0:
+            self.header["exists_bad_points"] = 1
+        else:
+            self.header["exists_bad_points"] = 0
+
+    def close(self):
+        if self._loader is not None:
+            self._loader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
     
     def __getitem__(self,key):
         if key=='Wavelength':
@@ -26,36 +116,85 @@ class FitsData:
         elif key=='Flux':
             return self.flux
         else:
+            if key=="exists_bad_points" and self._loader is not None:
+                # lazy spectra set it once both masks are read
+                self.andmask,self.orimask
             return self.header[key]
     
 
-    def minmax(self,range_:tuple = (0,1))->FitsData:
-        new_flux = minmax_function(self.flux,range_)
+    # the processing methods carry `andmask`,`orimask` and `ivar` along:
+    # resampling ORs the masks of the pixels used and propagates the variance,
+    # `masked=True` keeps the pixels flagged in `andmask` out of the computation
+
+    def minmax(self,range_:tuple = (0,1),masked:bool = False)->FitsData:
+        mask = self.andmask if masked else None
+        new_ivar = None
+        if self.ivar is None:
+            new_flux = minmax_function(self.flux,range_,mask)
+        else:
+            new_flux,new_ivar = minmax_function(self.flux,range_,mask,self.ivar)
         return FitsData(self.wavelength
-                        ,new_flux,self.header)
+                        ,new_flux,self.header
+                        ,andmask=self.andmask,orimask=self.orimask,ivar=new_ivar)
     
     
-    def align(self,aligned_wavelength:numpy.ndarray)->FitsData: 
+    def align(self,aligned_wavelength:numpy.ndarray
+              ,kind:str = "linear"
+              ,resampler:Resampler = None)->FitsData: 
+        # a `Resampler` built once for (source grid,`aligned_wavelength`) skips the planning
+        if resampler is None and kind in ("linear","flux_conserving"):
+            resampler = Resampler(self.wavelength,aligned_wavelength,kind)
+        if resampler is not None:
+            return self._resampled(resampler,aligned_wavelength)
         new_flux = align_wavelength(self.wavelength
-                                    ,self.flux,aligned_wavelength)
+                                    ,self.flux,aligned_wavelength
+                                    ,kind=kind)
         new_wavelength = aligned_wavelength
+        extras = _linear_extras(lambda:Resampler(self.wavelength,aligned_wavelength,"linear")
+                                ,self.andmask,self.orimask,self.ivar)
         return FitsData(
-            new_wavelength,new_flux,self.header
+            new_wavelength,new_flux,self.header,**extras
         )
     
 
-    def remove_redshift(self)->FitsData:
+    def remove_redshift(self
+                        ,kind:str = "linear"
+                        ,wavelength_grid:numpy.ndarray = None)->FitsData:
         Z = self.header['z']
+        new_wavelength = self.wavelength if wavelength_grid is None else wavelength_grid
+        if kind in ("linear","flux_conserving"):
+            resampler = redshift_resampler(self.wavelength,Z,wavelength_grid,kind)
+            return self._resampled(resampler,new_wavelength)
         new_flux = remove_redshift(self.wavelength
-                                    ,self.flux,Z)
-        return FitsData(self.wavelength
-                        ,new_flux,self.header)
+                                    ,self.flux,Z
+                                    ,kind=kind,wavelength_grid=wavelength_grid)
+        extras = _linear_extras(lambda:redshift_resampler(self.wavelength,Z,wavelength_grid,"linear")
+                                ,self.andmask,self.orimask,self.ivar)
+        return FitsData(new_wavelength
+                        ,new_flux,self.header,**extras)
     
-    def median_filter(self,size:int=7)->FitsData:
-        new_flux = median_filter(self.flux,size)
+    def median_filter(self,size:int=7,masked:bool = False)->FitsData:
+        new_flux = median_filter(self.flux,size,self.andmask if masked else None)
         return FitsData(self.wavelength
-                        ,new_flux,self.header)
+                        ,new_flux,self.header
+                        ,andmask=self.andmask,orimask=self.orimask,ivar=self.ivar)
+
+    def _resampled(self,resampler:Resampler,new_wavelength:numpy.ndarray)->FitsData:
+        return FitsData(new_wavelength,resampler(self.flux),self.header
+                        ,**_resample_extras(resampler,self.andmask,self.orimask,self.ivar))
     
+    def normalize_continuum(self,method:str = "sw5d",cache = None,**params)->FitsData:
+        # see `cmost.fitting.normalize_continuum`
+        from .fitting import normalize_continuum
+        return normalize_continuum(self,method,cache,**params)
+
+    def compact(self)->FitsData:
+        """A copy with float32 arrays, int32 masks and the header in a `HeaderTable`.
+
+        Use `compact_spectra` to share one table between many spectra.
+        """
+        return next(compact_spectra([self]))
+
     def visualize(self,ax=None):
         if ax:
             plot_spectrum(self.wavelength,self.flux,ax,is_show=False)
@@ -63,45 +202,294 @@ class FitsData:
             plot_spectrum(self.wavelength,self.flux,is_show=True)
     
     @classmethod
-    def from_hdu(cls,hdu):
+    @instrumented
+    def from_hdu(cls,hdu,compact:bool = False):
         header = Header.from_hdu(hdu)
-        match = re.search(r'DR(\d{1,2})', header["data_v"])
-        dr_version = int(match.group(1))
+        dr_version = get_dr_version(header)
+        float_dtype,int_dtype = _array_dtypes(compact)
 
         data = hdu[0].data if dr_version<8 else hdu[1].data[0]
 
         if dr_version<8:
-            # This part refers to the `read_lrs_fits` function in the `LAMOST` class of the `pylamost`` library
-            # Specifically, see:
-            #   https://github.com/fandongwei/pylamost
-            coeff0 = header['coeff0']
-            coeff1 = header['coeff1']
-            pixel_num = header['naxis1']
-            wavelength = 10 ** (coeff0+numpy.arange(pixel_num)*coeff1)
+            wavelength = numpy.asarray(wavelength_from_header(header),dtype=float_dtype)
         else:
-            wavelength = numpy.asarray(data[2],dtype=float)
+            wavelength = numpy.asarray(data[2],dtype=float_dtype)
 
-        flux = numpy.asarray(data[0],dtype=float)
-        andmask = numpy.asarray(data[3],dtype=int)
-        orimask = numpy.asarray(data[4],dtype=int)
+        flux = numpy.asarray(data[0],dtype=float_dtype)
+        ivar = numpy.asarray(data[1],dtype=float_dtype)
+        andmask = numpy.asarray(data[3],dtype=int_dtype)
+        orimask = numpy.asarray(data[4],dtype=int_dtype)
 
         if numpy.sum(orimask)>0 or numpy.sum(andmask)>0:
             header["exists_bad_points"] = 1
         else:
             header["exists_bad_points"] = 0
         
-        if abs(float(header["z"]))>=1:
-            header["unusual_redshift"] = 1
-        else:
-            header["unusual_redshift"] = 0
+        _update_unusual_redshift(header)
+        if compact:
+            header = HeaderTable.from_headers([header])[0]
+
+        return cls(wavelength,flux,header,andmask=andmask,orimask=orimask,ivar=ivar)
 
-        return cls(wavelength,flux,header)
+    @classmethod
+    @instrumented
+    def from_file_lazy(cls,fits_path:str,compact:bool = False):
+        # only the primary header is parsed here, the data stays on disk
+        header = read_header(fits_path)
+        _update_unusual_redshift(header)
+        if compact:
+            header = HeaderTable.from_headers([header])[0]
+        return cls(None,None,header,loader=_LazyFitsLoader(fits_path,header,compact))
 
         
     def __repr__(self):
         return f"FitsData(filename={self.header['filename']})"
     
     
+def _resample_extras(resampler:Resampler
+                     ,andmask:numpy.ndarray
+                     ,orimask:numpy.ndarray
+                     ,ivar:numpy.ndarray)->dict:
+    return {"andmask":None if andmask is None else resampler.mask(andmask)
+            ,"orimask":None if orimask is None else resampler.mask(orimask)
+            ,"ivar":None if ivar is None else resampler.ivar(ivar)}
+
+
+def _linear_extras(make_resampler:callable
+                   ,andmask:numpy.ndarray
+                   ,orimask:numpy.ndarray
+                   ,ivar:numpy.ndarray)->dict:
+    # the `interp1d` kinds only resample the flux, the masks and ivar follow
+    # the linear plan between the same grids
+    if andmask is None and orimask is None and ivar is None:
+        return {}
+    return _resample_extras(make_resampler(),andmask,orimask,ivar)
+
+
+def get_dr_version(header:Header)->int:
+    match = re.search(r'DR(\d{1,2})', header["data_v"])
+    return int(match.group(1))
+
+
+def wavelength_from_header(header:Header)->numpy.ndarray:
+    # This part refers to the `read_lrs_fits` function in the `LAMOST` class of the `pylamost`` library
+    # Specifically, see:
+    #   https://github.com/fandongwei/pylamost
+    coeff0 = header['coeff0']
+    coeff1 = header['coeff1']
+    pixel_num = header['naxis1']
+    return 10 ** (coeff0+numpy.arange(pixel_num)*coeff1)
+
+
+def _array_dtypes(compact:bool)->tuple:
+    # (flux, ivar and wavelength dtype, mask dtype)
+    return (numpy.float32,numpy.int32) if compact else (float,int)
+
+
+def _update_unusual_redshift(header:Header):
+    if abs(float(header["z"]))>=1:
+        header["unusual_redshift"] = 1
+    else:
+        header["unusual_redshift"] = 0
+
+
+class _LazyFitsLoader:
+    # rows of the LAMOST data array (`hdu[0].data` before DR8, `hdu[1].data[0]` after)
+    rows = {"flux":(0,float),"ivar":(1,float),"wavelength":(2,float)
+            ,"andmask":(3,int),"orimask":(4,int)}
+
+    def __init__(self,fits_path:str,header:Header,compact:bool = False):
+        self.fits_path = fits_path
+        self.header = header
+        self.compact = compact
+        self.dr_version = get_dr_version(header)
+        self.hdu = None
+        self.loaded = set()
+
+    @property
+    def is_complete(self)->bool:
+        return len(self.loaded)==len(self.rows)
+
+    @instrumented
+    def load(self,name:str)->numpy.ndarray:
+        row,kind = self.rows[name]
+        float_dtype,int_dtype = _array_dtypes(self.compact)
+        dtype = int_dtype if kind is int else float_dtype
+        if name=="wavelength" and self.dr_version<8:
+            res = numpy.asarray(wavelength_from_header(self.header),dtype=dtype)
+        else:
+            if self.hdu is None:
+                from astropy.io import fits # lazy load
+                self.hdu = fits.open(self.fits_path,memmap=True)
+            try:
+                data = self.hdu[0].data if self.dr_version<8 else self.hdu[1].data[0]
+                res = numpy.array(data[row],dtype=dtype)
+            finally:
+                # `res` is a copy: no file handle stays open between accesses,
+                # even when only some of the arrays are ever used
+                self.close()
+
+        self.loaded.add(name)
+        return res
+
+    def close(self):
+        if self.hdu is not None:
+            self.hdu.close()
+            self.hdu = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["hdu"] = None
+        return state
+
+
+class SpectrumBatch:
+    """N spectra stored as contiguous 2-D arrays.
+
+    `wavelength` is either a grid shared by every spectrum (npix,) or one grid
+    per spectrum (N,npix), `flux` is (N,npix) and `header` is a structured
+    array with one row per spectrum, `ivar`,`andmask` and `orimask` (N,npix)
+    are optional. The processing methods mirror those of `FitsData` but run
+    as single array operations over the whole batch.
+    """
+    def __init__(self,wavelength:numpy.ndarray
+                    ,flux:numpy.ndarray,header:numpy.ndarray = None
+                    ,*
+                    ,ivar:numpy.ndarray = None
+                    ,andmask:numpy.ndarray = None
+                    ,orimask:numpy.ndarray = None):
+
+        self.wavelength = numpy.asarray(wavelength)
+        self.flux = numpy.atleast_2d(flux)
+        self.header = header
+        self.ivar = None if ivar is None else numpy.atleast_2d(ivar)
+        self.andmask = None if andmask is None else numpy.atleast_2d(andmask)
+        self.orimask = None if orimask is None else numpy.atleast_2d(orimask)
+
+    def __len__(self):
+        return self.flux.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self,key):
+        if isinstance(key,str):
+            if key=='Wavelength':
+                return self.wavelength
+            elif key=='Flux':
+                return self.flux
+            else:
+                return self.header[key]
+
+        extras = {name:None if getattr(self,name) is None else getattr(self,name)[key]
+                  for name in ("andmask","orimask","ivar")}
+        wavelength = self.wavelength if self.wavelength.ndim==1 else self.wavelength[key]
+        if isinstance(key,(int,numpy.integer)):
+            header = None if self.header is None else Header.from_row(self.header[key])
+            return FitsData(wavelength,self.flux[key],header,**extras)
+
+        header = None if self.header is None else self.header[key]
+        return SpectrumBatch(wavelength,self.flux[key],header,**extras)
+
+    def minmax(self,range_:tuple = (0,1),masked:bool = False)->SpectrumBatch:
+        mask = self.andmask if masked else None
+        new_ivar = None
+        if self.ivar is None:
+            new_flux = minmax_function(self.flux,range_,mask)
+        else:
+            new_flux,new_ivar = minmax_function(self.flux,range_,mask,self.ivar)
+        return SpectrumBatch(self.wavelength
+                             ,new_flux,self.header
+                             ,ivar=new_ivar,andmask=self.andmask,orimask=self.orimask)
+
+    def align(self,aligned_wavelength:numpy.ndarray
+              ,kind:str = "linear"
+              ,resampler:Resampler = None)->SpectrumBatch:
+        if resampler is None and kind in ("linear","flux_conserving"):
+            resampler = Resampler(self.wavelength,aligned_wavelength,kind)
+        if resampler is not None:
+            return self._resampled(resampler,numpy.asarray(aligned_wavelength))
+        new_flux = align_wavelength(self.wavelength
+                                    ,self.flux,aligned_wavelength
+                                    ,kind=kind)
+        new_wavelength = numpy.asarray(aligned_wavelength)
+        extras = _linear_extras(lambda:Resampler(self.wavelength,aligned_wavelength,"linear")
+                                ,self.andmask,self.orimask,self.ivar)
+        return SpectrumBatch(
+            new_wavelength,new_flux,self.header,**extras
+        )
+
+    def remove_redshift(self
+                        ,kind:str = "linear"
+                        ,wavelength_grid:numpy.ndarray = None)->SpectrumBatch:
+        # one redshift per row from the header table; `kind="flux_conserving"`
+        # rebins every spectrum onto the common rest frame `wavelength_grid`
+        Z = numpy.asarray(self.header['z'],dtype=float)
+        new_wavelength = self.wavelength if wavelength_grid is None else wavelength_grid
+        if kind in ("linear","flux_conserving"):
+            resampler = redshift_resampler(self.wavelength,Z,wavelength_grid,kind)
+            return self._resampled(resampler,new_wavelength)
+        new_flux = remove_redshift(self.wavelength
+                                    ,self.flux,Z
+                                    ,kind=kind,wavelength_grid=wavelength_grid)
+        extras = _linear_extras(lambda:redshift_resampler(self.wavelength,Z,wavelength_grid,"linear")
+                                ,self.andmask,self.orimask,self.ivar)
+        return SpectrumBatch(new_wavelength
+                             ,new_flux,self.header,**extras)
+
+    def median_filter(self,size:int=7,masked:bool = False)->SpectrumBatch:
+        new_flux = median_filter(self.flux,size,self.andmask if masked else None)
+        return SpectrumBatch(self.wavelength
+                             ,new_flux,self.header
+                             ,ivar=self.ivar,andmask=self.andmask,orimask=self.orimask)
+
+    def _resampled(self,resampler:Resampler,new_wavelength:numpy.ndarray)->SpectrumBatch:
+        return SpectrumBatch(new_wavelength,resampler(self.flux),self.header
+                             ,**_resample_extras(resampler,self.andmask,self.orimask,self.ivar))
+
+    def normalize_continuum(self,method:str = "sw5d",cache = None,**params)->SpectrumBatch:
+        # see `cmost.fitting.normalize_continuum`
+        from .fitting import normalize_continuum
+        return normalize_continuum(self,method,cache,**params)
+
+    @classmethod
+    @instrumented
+    def from_fits_data(cls,fits_data_list:list[FitsData])->SpectrumBatch:
+        fits_data_list = list(fits_data_list)
+        if len(fits_data_list)==0:
+            raise ValueError("`fits_data_list` is empty")
+
+        pixel_nums = {len(fits_data.flux) for fits_data in fits_data_list}
+        if len(pixel_nums)>1:
+            raise ValueError("all spectra must have the same number of pixels, "
+                             "align them to a common wavelength first")
+
+        flux = numpy.stack([numpy.asarray(fits_data.flux,dtype=float)
+                            for fits_data in fits_data_list])
+        wavelength = numpy.stack([numpy.asarray(fits_data.wavelength,dtype=float)
+                                  for fits_data in fits_data_list])
+        if numpy.all(wavelength==wavelength[0]):
+            wavelength = wavelength[0]
+
+        if any(fits_data.header is None for fits_data in fits_data_list):
+            header = None
+        else:
+            header = Header.to_table([fits_data.header for fits_data in fits_data_list])
+
+        extras = dict()
+        for name,dtype in (("ivar",float),("andmask",int),("orimask",int)):
+            if any(getattr(fits_data,name) is None for fits_data in fits_data_list):
+                extras[name] = None
+            else:
+                extras[name] = numpy.stack([numpy.asarray(getattr(fits_data,name),dtype=dtype)
+                                            for fits_data in fits_data_list])
+        return cls(wavelength,flux,header,**extras)
+
+    def __repr__(self):
+        return f"SpectrumBatch(size={len(self)},pixel_num={self.flux.shape[-1]})"
+
+
 class Header(dict):
     def __init__(self,keys,values):
         super().__init__(zip(keys,values))
@@ -116,6 +504,7 @@ class Header(dict):
         return f"Header({super().__repr__()})"
     
     @classmethod
+    @instrumented
     def from_hdu(cls,hdu):
         keys = []
         values = []
@@ -126,8 +515,399 @@ class Header(dict):
             keys.append(key.lower())
             values.append(value)
         return cls(keys,values)
+
+    @classmethod
+    @instrumented
+    def from_file(cls,fits_path:str,keys:Iterable[str] = None)->Header:
+        wanted = None if keys is None else {key.lower() for key in keys}
+        res_keys = []
+        res_values = []
+        with _open_raw(fits_path) as file:
+            for key,value in _iter_primary_cards(file):
+                if "COMMENT" in key or len(key)<1:
+                    continue
+                key = key.lower()
+                if wanted is None:
+                    res_keys.append(key)
+                    res_values.append(value)
+                elif key in wanted:
+                    res_keys.append(key)
+                    res_values.append(value)
+                    wanted.discard(key)
+                    if len(wanted)==0:
+                        break
+        return cls(res_keys,res_values)
+
+    @classmethod
+    def from_row(cls,row:numpy.void)->Header:
+        keys = row.dtype.names
+        values = [row[key].item() for key in keys]
+        return cls(keys,values)
+
+    @staticmethod
+    @instrumented
+    def to_table(headers:list[Header])->numpy.ndarray:
+        """Gather the headers into a structured array with one column per key.
+
+        Column types are inferred from the values, keys missing from some
+        headers are filled with `nan` (numeric) or `''` (text).
+        """
+        keys = list(dict.fromkeys(key for header in headers for key in header))
+
+        dtype = []
+        columns = []
+        for key in keys:
+            values = [header.get(key) for header in headers]
+            present = [value for value in values if value is not None]
+            if all(isinstance(value,(bool,numpy.bool_)) for value in present) and len(present)==len(values):
+                column = numpy.asarray(values,dtype=bool)
+            elif all(isinstance(value,(int,numpy.integer)) for value in present) and len(present)==len(values):
+                column = numpy.asarray(values,dtype=numpy.int64)
+            elif all(isinstance(value,(int,float,numpy.integer,numpy.floating)) for value in present):
+                column = numpy.asarray([numpy.nan if value is None else value
+                                        for value in values],dtype=float)
+            else:
+                column = numpy.asarray(['' if value is None else str(value)
+                                        for value in values],dtype=str)
+            dtype.append((key,column.dtype))
+            columns.append(column)
+
+        table = numpy.empty(len(headers),dtype=dtype)
+        for key,column in zip(keys,columns):
+            table[key] = column
+        return table
     
 
+# typed columns for the common cards of the LAMOST primary header (and the
+# flags cmost adds), see `HeaderTable`
+HEADER_SCHEMA = (("simple",bool),("bitpix",numpy.int32),("naxis",numpy.int32)
+                 ,("naxis1",numpy.int32),("naxis2",numpy.int32),("extend",bool)
+                 ,("filename","S48"),("obsid",numpy.int64),("author","S24"),("n_exten",numpy.int32)
+                 ,("origin","S16"),("date","S24"),("telescop","S16")
+                 ,("longitud",float),("latitude",float),("focus",float)
+                 ,("campro","S16"),("camver","S16"),("date-obs","S24"),("date-beg","S24")
+                 ,("date-end","S24"),("lmjd",numpy.int32),("mjd",numpy.int32),("planid","S32")
+                 ,("ra",float),("dec",float),("desig","S24"),("designation","S24")
+                 ,("fiberid",numpy.int32),("spid",numpy.int32),("cell_id","S8")
+                 ,("x_value",float),("y_value",float),("objname","S24"),("objtype","S16")
+                 ,("objsourc","S16"),("tsource","S16"),("tfrom","S16"),("tcomment","S32")
+                 ,("fibertyp","S8"),("magtype","S8")
+                 ,("mag1",float),("mag2",float),("mag3",float),("mag4",float)
+                 ,("mag5",float),("mag6",float),("mag7",float)
+                 ,("obs_type","S8"),("obscomm","S16"),("radecsys","S8"),("equinox",float)
+                 ,("ra_obs",float),("dec_obs",float),("totalexp",float),("nexp",numpy.int32)
+                 ,("expid01","S32"),("expid02","S32"),("expid03","S32")
+                 ,("seeing",float),("moonpha",float),("temp_air",float),("temp_fp",float)
+                 ,("dewpoint",float),("dust",float),("humidity",float),("windd",float)
+                 ,("winds",float),("skylevel",float),("crpix1",numpy.int32),("crval1",float)
+                 ,("cd1_1",float),("dc-flag",numpy.int32),("coeff0",float),("coeff1",float)
+                 ,("vacuum",bool),("wfittype","S16"),("verspipe","S16")
+                 ,("snru",float),("snrg",float),("snrr",float),("snri",float),("snrz",float)
+                 ,("class","S8"),("subclass","S16"),("z",float),("z_err",float)
+                 ,("zflag","S16"),("data_v","S16")
+                 ,("exists_bad_points",numpy.int8),("unusual_redshift",numpy.int8))
+
+_SCHEMA_INDEX = {key:i for i,(key,_) in enumerate(HEADER_SCHEMA)}
+# one presence bit per column
+_SCHEMA_DTYPE = numpy.dtype(list(HEADER_SCHEMA) + [("_present",numpy.uint8,((len(HEADER_SCHEMA) + 7) // 8,))])
+
+
+def _field_check(dtype:numpy.dtype)->tuple:
+    # (python type of the values, their bounds or maximal length)
+    dtype = numpy.dtype(dtype)
+    if dtype.kind=="b":
+        return bool,None
+    if dtype.kind=="i":
+        return int,(int(numpy.iinfo(dtype).min),int(numpy.iinfo(dtype).max))
+    if dtype.kind=="f":
+        return float,None
+    return str,dtype.itemsize
+
+_SCHEMA_CHECKS = tuple(_field_check(dtype) for _,dtype in HEADER_SCHEMA)
+
+
+def _fits_field(value,index:int)->bool:
+    # `value` is stored in column `index` and read back unchanged, other
+    # values (numpy scalars included) go to the overflow
+    type_,limit = _SCHEMA_CHECKS[index]
+    if type(value) is not type_:
+        return False
+    if type_ is int:
+        return limit[0]<=value<=limit[1]
+    if type_ is str:
+        return len(value)<=limit and value.isascii() and not value.endswith("\x00")
+    return True
+
+
+def _from_field(value):
+    value = value.item()
+    return value.decode("ascii") if isinstance(value,bytes) else value
+
+
+class HeaderTable:
+    """Primary headers of many spectra in one record array.
+
+    The cards of `HEADER_SCHEMA` are stored in typed columns of `records`.
+    The other cards, and values that do not fit the type of their column,
+    go to a per-row dict in `overflow` (`None` for rows without any).
+    `table[i]` is a `HeaderView` behaving like the `Header` of row `i`.
+    """
+    __slots__ = ("records","overflow")
+
+    def __init__(self,records:numpy.ndarray,overflow:list[dict]):
+        self.records = records
+        self.overflow = overflow
+
+    @classmethod
+    @instrumented
+    def from_headers(cls,headers:Iterable[Header])->HeaderTable:
+        headers = list(headers)
+        records = numpy.zeros(len(headers),dtype=_SCHEMA_DTYPE)
+        columns = [[records[key][0].item() if len(headers) else None] * len(headers)
+                   for key,_ in HEADER_SCHEMA]
+        present = numpy.zeros((len(headers),len(HEADER_SCHEMA)),dtype=bool)
+        overflow = [None] * len(headers)
+        for row,header in enumerate(headers):
+            indices = []
+            for key,value in header.items():
+                index = _SCHEMA_INDEX.get(key)
+                if index is not None and _fits_field(value,index):
+                    columns[index][row] = value
+                    indices.append(index)
+                else:
+                    if overflow[row] is None:
+                        overflow[row] = dict()
+                    overflow[row][key] = value
+            present[row,indices] = True
+
+        for (key,_),column in zip(HEADER_SCHEMA,columns):
+            records[key] = column
+        records["_present"] = numpy.packbits(present,axis=1,bitorder="little")
+        return cls(records,overflow)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self,row:int)->HeaderView:
+        if row<0:
+            row += len(self)
+        if not 0<=row<len(self):
+            raise IndexError(row)
+        return HeaderView(self,row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield HeaderView(self,row)
+
+    def __repr__(self):
+        return f"HeaderTable(size={len(self)})"
+
+
+class HeaderView(MutableMapping):
+    """Row `row` of a `HeaderTable`, used like a `Header`."""
+    __slots__ = ("table","row")
+
+    def __init__(self,table:HeaderTable,row:int):
+        self.table = table
+        self.row = row
+
+    def _is_present(self,index:int)->bool:
+        return bool(self.table.records["_present"][self.row,index >> 3] & (1 << (index & 7)))
+
+    def _set_present(self,index:int,value:bool):
+        present = self.table.records["_present"]
+        if value:
+            present[self.row,index >> 3] |= 1 << (index & 7)
+        else:
+            present[self.row,index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    def __getitem__(self,key):
+        index = _SCHEMA_INDEX.get(key)
+        if index is not None and self._is_present(index):
+            return _from_field(self.table.records[key][self.row])
+        overflow = self.table.overflow[self.row]
+        if overflow is None:
+            raise KeyError(key)
+        return overflow[key]
+
+    def __setitem__(self,key,value):
+        index = _SCHEMA_INDEX.get(key)
+        overflow = self.table.overflow[self.row]
+        if index is not None and _fits_field(value,index):
+            self.table.records[key][self.row] = value
+            self._set_present(index,True)
+            if overflow is not None:
+                overflow.pop(key,None)
+            return
+        if index is not None:
+            self._set_present(index,False)
+        if overflow is None:
+            overflow = self.table.overflow[self.row] = dict()
+        overflow[key] = value
+
+    def __delitem__(self,key):
+        index = _SCHEMA_INDEX.get(key)
+        if index is not None and self._is_present(index):
+            self._set_present(index,False)
+            return
+        overflow = self.table.overflow[self.row]
+        if overflow is None:
+            raise KeyError(key)
+        del overflow[key]
+
+    def __iter__(self):
+        present = numpy.unpackbits(self.table.records["_present"][self.row]
+                                   ,count=len(HEADER_SCHEMA),bitorder="little")
+        for index in numpy.flatnonzero(present).tolist():
+            yield HEADER_SCHEMA[index][0]
+        overflow = self.table.overflow[self.row]
+        if overflow is not None:
+            yield from overflow
+
+    def __len__(self):
+        overflow = self.table.overflow[self.row]
+        return (int(numpy.unpackbits(self.table.records["_present"][self.row]).sum())
+                + (0 if overflow is None else len(overflow)))
+
+    def copy(self)->Header:
+        return Header(self.keys(),self.values())
+
+    def __repr__(self):
+        return f"HeaderView({dict(self.items())!r})"
+
+
+def compact_spectra(spectra:Iterable[FitsData],block_size:int = 1024)->Iterator[FitsData]:
+    """Yield the spectra with float32 arrays, int32 masks and compact headers.
+
+    The headers of every `block_size` spectra share one `HeaderTable`, which
+    cuts the per-spectrum overhead of keeping millions of spectra in memory.
+    Lazy spectra are loaded.
+    """
+    float_dtype,int_dtype = _array_dtypes(True)
+    for block in _chunked(spectra,block_size):
+        headers = [fits_data.header for fits_data in block]
+        if all(header is not None for header in headers):
+            headers = HeaderTable.from_headers(headers)
+        for fits_data,header in zip(block,headers):
+            yield FitsData(_as_dtype(fits_data.wavelength,float_dtype)
+                           ,_as_dtype(fits_data.flux,float_dtype),header
+                           ,andmask=_as_dtype(fits_data.andmask,int_dtype)
+                           ,orimask=_as_dtype(fits_data.orimask,int_dtype)
+                           ,ivar=_as_dtype(fits_data.ivar,float_dtype))
+
+
+def _as_dtype(array:numpy.ndarray,dtype)->numpy.ndarray:
+    return None if array is None else numpy.asarray(array,dtype=dtype)
+
+
+_FITS_BLOCK_SIZE = 2880
+_FITS_CARD_SIZE = 80
+_INT_PATTERN = re.compile(r"^[+-]?\d+$")
+
+
+def _open_raw(fits_path:str):
+    # the inputs `fits.open` accepts: binary file objects, plain, gzip, bzip2
+    # and single member zip files; streams are decompressed lazily, so only
+    # the header blocks are inflated
+    if hasattr(fits_path,"read"):
+        return contextlib.nullcontext(fits_path)
+    fits_path = os.fspath(fits_path)
+    if re.match(r"^[a-z][a-z0-9+.-]*://",fits_path,re.IGNORECASE):
+        raise ValueError(f"`fits_path` must be a local file, download {fits_path!r} first")
+    with open(fits_path,"rb") as file:
+        magic = file.read(4)
+    if magic[:2]==b"\x1f\x8b":
+        return gzip.open(fits_path,"rb")
+    if magic[:3]==b"BZh":
+        import bz2 # lazy load
+        return bz2.open(fits_path,"rb")
+    if magic==b"PK\x03\x04":
+        import zipfile # lazy load
+        with zipfile.ZipFile(fits_path) as archive:
+            names = archive.namelist()
+            if len(names)!=1:
+                raise ValueError(f"`fits_path` must be a zip file with one member, {fits_path!r} has {len(names)}")
+            # the member keeps the archive file open until it is closed
+            return archive.open(names[0])
+    return open(fits_path,"rb")
+
+
+def _iter_primary_cards(file)->Iterator[tuple]:
+    # yield `(key,value)` for every card of the primary header, stop at `END`
+    pending_key,pending_value = None,None
+    while True:
+        block = file.read(_FITS_BLOCK_SIZE)
+        if len(block)<_FITS_BLOCK_SIZE:
+            raise OSError("unexpected end of file while reading the primary header")
+        block = block.decode("ascii",errors="replace")
+        for i in range(0,_FITS_BLOCK_SIZE,_FITS_CARD_SIZE):
+            card = block[i:i+_FITS_CARD_SIZE]
+            key = card[:8].rstrip()
+
+            if key=="CONTINUE" and pending_key is not None:
+                pending_value = pending_value[:-1] + _parse_card_value(card[8:])
+                continue
+            if pending_key is not None:
+                yield pending_key,pending_value
+                pending_key,pending_value = None,None
+
+            if key=="END":
+                return
+            if key=="HIERARCH" and "=" in card:
+                key,_,rest = card[9:].partition("=")
+                yield key.strip(),_parse_card_value(rest,card)
+                continue
+            if card[8:10]!="= ":
+                # commentary cards (HISTORY, blank, ...) keep their text
+                yield key,card[8:].rstrip()
+                continue
+
+            value = _parse_card_value(card[10:],card)
+            if isinstance(value,str) and value.endswith("&"):
+                pending_key,pending_value = key,value
+            else:
+                yield key,value
+        if pending_key is not None:
+            yield pending_key,pending_value
+            pending_key,pending_value = None,None
+
+
+def _parse_card_value(text:str,card:str = None):
+    text = text.strip()
+    if text.startswith("'"):
+        # string value, `''` is an escaped quote
+        i = 1
+        chars = []
+        while i<len(text):
+            if text[i]=="'":
+                if text[i+1:i+2]=="'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(text[i])
+            i += 1
+        return "".join(chars).rstrip()
+
+    text = text.split("/",1)[0].strip()
+    if text=="T":
+        return True
+    if text=="F":
+        return False
+    if text=="":
+        return None
+    if _INT_PATTERN.match(text):
+        return int(text)
+    try:
+        return float(text.replace("D","E"))
+    except ValueError:
+        if card is None:
+            raise
+        # rare formats (complex values, ...) go through astropy
+        from astropy.io import fits # lazy load
+        return fits.Card.fromstring(card).value
+
+
 def plot_spectrum(wavelength:numpy.ndarray
                   ,flux:numpy.ndarray
                 ,ax = None
@@ -152,11 +932,184 @@ def plot_spectrum(wavelength:numpy.ndarray
         matplotlib.pyplot.show()
 
     
-def read_fits(fits_path:str)->FitsData:
+@instrumented
+def read_fits(fits_path:str,lazy:bool = False,compact:bool = False)->FitsData:
+    """Read a LAMOST FITS file.
+
+    With `lazy=True` only the primary header is read. The file is then opened
+    with `memmap=True` on each first access to `flux`, `ivar`, `wavelength`,
+    `andmask` or `orimask`, and each array is decoded only when it is used.
+    `exists_bad_points` is missing from the header until both masks have
+    been read (`fits_data["exists_bad_points"]` reads them).
+    With `compact=True` the arrays are float32 (int32 masks) and the header
+    is a `HeaderView`, see `compact_spectra`.
+    """
+    if lazy:
+        return FitsData.from_file_lazy(fits_path,compact)
+    from astropy.io import fits # lazy load
     with fits.open(fits_path) as hdu:
-        return FitsData.from_hdu(hdu)
+        return FitsData.from_hdu(hdu,compact)
     
     
-def read_header(fits_path:str)->Header:
-    with fits.open(fits_path) as hdu:
-        return Header.from_hdu(hdu)
\ No newline at end of file
+@instrumented
+def read_header(fits_path:str,keys:Iterable[str] = None)->Header:
+    """Read the primary header without touching the data.
+
+    Only the primary header blocks are parsed, up to the `END` card. If `keys`
+    is given, only those (case-insensitive) keys are returned and parsing
+    stops as soon as all of them have been seen. `fits_path` is a path (plain,
+    gzip, bzip2 or single member zip) or a binary file object positioned at
+    the start of the file. The values are those `astropy.io.fits.getheader`
+    gives: long strings joined over `CONTINUE` cards, `HIERARCH` keys without
+    the prefix, undefined values as `None`, `COMMENT` cards skipped and the
+    last `HISTORY` card kept.
+    """
+    return Header.from_file(fits_path,keys)
+
+
+@instrumented
+def read_headers(paths_or_glob:str|Iterable[str]
+                 ,keys:Iterable[str] = None
+                 ,workers:int = None
+                 ,executor:str = "process"
+                 ,chunk_size:int = 256)->tuple[numpy.ndarray,dict]:
+    """Read the primary headers of many files into one columnar table.
+
+    Returns `(table,failed)`: `table` is a structured array with one row per
+    readable file (in input order) and a `path` column, `failed` maps every
+    path that could not be read to its exception. `workers=None` starts one
+    worker per CPU.
+    """
+    if executor not in ("process","thread"):
+        raise ValueError("`executor` must be 'process' or 'thread'")
+
+    keys = None if keys is None else tuple(keys)
+    failed = dict()
+    headers = []
+    for path,header in _iter_map_chunks(partial(_read_header_chunk,keys=keys)
+                                        ,resolve_paths(paths_or_glob)
+                                        ,workers,executor,chunk_size,failed):
+        header["path"] = path
+        headers.append(header)
+    if len(headers)==0:
+        return numpy.empty(0,dtype=[("path",str)]),failed
+    return Header.to_table(headers),failed
+
+
+@instrumented
+def read_fits_many(paths_or_glob:str|Iterable[str]
+                   ,workers:int = None
+                   ,executor:str = "process"
+                   ,as_batch:bool = False
+                   ,chunk_size:int = 16
+                   ,compact:bool = False)->tuple[Iterator[FitsData]|SpectrumBatch,dict]:
+    """Read many FITS files on a pool of workers.
+
+    `paths_or_glob` is a glob pattern, a directory or an iterable of paths.
+    Returns `(spectra,failed)`: `spectra` yields `FitsData` in input order
+    (or is a `SpectrumBatch` if `as_batch`), `failed` maps every path that
+    could not be read to its exception. In iterator mode `failed` is filled
+    while the iterator is consumed; if no file can be read the batch is
+    empty. With `compact=True` the spectra of a chunk are compacted together
+    by `compact_spectra`. `workers=None` starts one worker per CPU, pass
+    `workers=1` to read in the calling process.
+    """
+    if executor not in ("process","thread"):
+        raise ValueError("`executor` must be 'process' or 'thread'")
+
+    paths = resolve_paths(paths_or_glob)
+    failed = dict()
+    spectra = (fits_data for _,fits_data in _iter_map_chunks(partial(_read_fits_chunk,compact=compact),paths
+                                                             ,workers,executor
+                                                             ,chunk_size,failed))
+    if as_batch:
+        spectra = list(spectra)
+        if len(spectra)==0:
+            return SpectrumBatch(numpy.empty(0),numpy.empty((0,0))),failed
+        return SpectrumBatch.from_fits_data(spectra),failed
+    return spectra,failed
+
+
+def resolve_paths(paths_or_glob:str|Iterable[str])->Iterable[str]:
+    if isinstance(paths_or_glob,(str,os.PathLike)):
+        path = str(paths_or_glob)
+        if os.path.isdir(path):
+            return sorted(glob.glob(os.path.join(path,"*.fits*")))
+        if glob.has_magic(path):
+            return sorted(glob.glob(path,recursive=True))
+        return [path]
+    return paths_or_glob
+
+
+def _read_fits_chunk(paths:list[str],compact:bool = False)->list[tuple]:
+    res = []
+    for path in paths:
+        try:
+            res.append((path,read_fits(path),None))
+        except Exception as e:
+            res.append((path,None,e))
+    if compact:
+        # one `HeaderTable` for the whole chunk
+        spectra = compact_spectra([fits_data for _,fits_data,error in res if error is None],max(len(res),1))
+        res = [(path,None,error) if error is not None else (path,next(spectra),None)
+               for path,_,error in res]
+    return res
+
+
+def _read_header_chunk(paths:list[str],keys:tuple[str])->list[tuple]:
+    res = []
+    for path in paths:
+        try:
+            res.append((path,read_header(path,keys),None))
+        except Exception as e:
+            res.append((path,None,e))
+    return res
+
+
+def _chunked(iterable:Iterable,size:int)->Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk)==size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_map_chunks(func:callable
+                     ,paths:Iterable[str]
+                     ,workers:int
+                     ,executor:str
+                     ,chunk_size:int
+                     ,failed:dict)->Iterator[tuple]:
+    # `func` maps a list of paths to a list of `(path,result,error)`
+    workers = os.cpu_count() if workers is None else workers
+    chunks = _chunked(paths,chunk_size)
+
+    if workers<=1:
+        for chunk in map(func,chunks):
+            yield from _unpack_chunk(chunk,failed)
+        return
+
+    pool_cls = ProcessPoolExecutor if executor=="process" else ThreadPoolExecutor
+    # worker processes send their instrumentation stats back with every chunk
+    func,collect = instrument._for_workers(func,executor)
+    with pool_cls(max_workers=workers) as pool:
+        # keep a bounded number of chunks in flight so that memory stays flat
+        # and results can be yielded in the input order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(func,chunk))
+            if len(pending)>=2*workers:
+                yield from _unpack_chunk(instrument._from_workers(pending.popleft().result(),collect),failed)
+        while pending:
+            yield from _unpack_chunk(instrument._from_workers(pending.popleft().result(),collect),failed)
+
+
+def _unpack_chunk(chunk:list[tuple],failed:dict)->Iterator[tuple]:
+    for path,result,error in chunk:
+        if error is None:
+            yield path,result
+        else:
+            failed[path] = error
@@ -9,11 +9,16 @@ import numpy
 from pathlib import Path
 from dataclasses import dataclass
 from functools import cache
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+from typing import Iterable
 
-from scipy import interpolate,integrate
-from .io import FitsData
+from scipy import interpolate,integrate,sparse
+from .io import FitsData,SpectrumBatch
+from . import instrument
+from .instrument import instrumented
 
-__all__ = ["read_LickLineIndex","compute_LickLineIndices"]
+__all__ = ["read_LickLineIndex","compute_LickLineIndices","compute_LickLineIndices_batch"
+           ,"LickLineIndexPlan"]
 
 @dataclass
 class LickLineIndex:
@@ -64,44 +69,452 @@ def read_LickLineIndex(fp:str)->list[LickLineIndex]:
 
 # print(read_LickLineIndex())
 
+def default_LickLineIndex_table()->list[LickLineIndex]:
+    return read_LickLineIndex(str(Path(__file__).parent / Path("assets") / Path("index.table")))
+
+
+class LickLineIndexPlan:
+    """All Lick indices of a table on one wavelength grid, as array operations.
+
+    Every band is reduced once to trapezoid weights on its nodes (the band
+    edges, interpolated linearly, plus the pixels strictly inside it). The
+    per-spectrum work is then one sparse product and a few reductions, for
+    any number of spectra on the same grid. Results match
+    `compute_FI_lambda_FC_lambda` + `compute_EW`/`compute_Mag`.
+    """
+    def __init__(self,wavelength:numpy.ndarray
+                 ,LickLineIndex_table:list[LickLineIndex] = None):
+        if LickLineIndex_table is None:
+            LickLineIndex_table = default_LickLineIndex_table()
+        self.wavelength = numpy.asarray(wavelength,dtype=float)
+        self.table = list(LickLineIndex_table)
+        self.names = [lick_line_index.index_name for lick_line_index in self.table]
+        self.units = numpy.asarray([lick_line_index.units for lick_line_index in self.table])
+        self.band()
+
+    @instrumented
+    def band(self):
+        index_num = len(self.table)
+        pixel_num = len(self.wavelength)
+
+        rows,cols,vals = [],[],[]
+        node_T,node_u,node_starts = [],[],[]
+        widths = numpy.empty(index_num)
+        node_num = 0
+        for i,lick_line_index in enumerate(self.table):
+            # index band: one row of the gather matrix per node
+            a,b,t,x = self._band_nodes(lick_line_index.index_band_start
+                                       ,lick_line_index.index_band_end
+                                       ,lick_line_index.index_name)
+            k = numpy.arange(node_num,node_num + len(x))
+            rows += [k,k]
+            cols += [a,b]
+            vals += [1 - t,t]
+            node_starts.append(node_num)
+            node_num += len(x)
+
+            node_T.append(_trapezoid_weights(x))
+            blue_mid = (lick_line_index.blue_continuum_start + lick_line_index.blue_continuum_end) / 2
+            red_mid = (lick_line_index.red_continuum_start + lick_line_index.red_continuum_end) / 2
+            node_u.append((x - blue_mid) / (red_mid - blue_mid))
+            widths[i] = lick_line_index.index_band_end - lick_line_index.index_band_start
+
+        # continua: one row per index holding the weights of its mean flux
+        for offset,(start_name,end_name) in ((node_num,("blue_continuum_start","blue_continuum_end"))
+                                            ,(node_num + index_num,("red_continuum_start","red_continuum_end"))):
+            for i,lick_line_index in enumerate(self.table):
+                start = getattr(lick_line_index,start_name)
+                end = getattr(lick_line_index,end_name)
+                a,b,t,x = self._band_nodes(start,end,lick_line_index.index_name)
+                w = _trapezoid_weights(x) / (end - start)
+                k = numpy.full(len(x),offset + i)
+                rows += [k,k]
+                cols += [a,b]
+                vals += [w * (1 - t),w * t]
+
+        self.node_num = node_num
+        self.matrix = sparse.csr_matrix((numpy.concatenate(vals)
+                                         ,(numpy.concatenate(rows),numpy.concatenate(cols)))
+                                        ,shape=(node_num + 2 * index_num,pixel_num))
+        self.matrix.eliminate_zeros()
+        self.node_T = numpy.concatenate(node_T)
+        self.node_u = numpy.concatenate(node_u)
+        self.node_starts = numpy.asarray(node_starts)
+        self.node_index = numpy.repeat(numpy.arange(index_num)
+                                       ,numpy.diff(numpy.append(self.node_starts,node_num)))
+        self.widths = widths
+        # which pixels every index depends on, to flag indices touching bad pixels
+        row_index = numpy.concatenate((self.node_index
+                                       ,numpy.arange(index_num),numpy.arange(index_num)))
+        coo = self.matrix.tocoo()
+        self.usage = sparse.csr_matrix((numpy.ones(len(coo.data)),(row_index[coo.row],coo.col))
+                                       ,shape=(index_num,pixel_num))
+        self._error_terms = None
+
+    def _band_nodes(self,start:float,end:float,name:str):
+        # nodes of `[start,end]` as `(1-t)*flux[a] + t*flux[b]`, same as `extract_one_spectrum`
+        wavelength = self.wavelength
+        if start<wavelength[0] or end>wavelength[-1]:
+            raise ValueError(f"the bands of `{name}` ({start},{end}) are outside "
+                             f"the wavelength range ({wavelength[0]},{wavelength[-1]})")
+        inner = numpy.arange(numpy.searchsorted(wavelength,start,side="right")
+                             ,numpy.searchsorted(wavelength,end,side="left"))
+        edge = numpy.clip(numpy.searchsorted(wavelength,[start,end]),1,len(wavelength) - 1)
+        edge_t = (numpy.asarray([start,end]) - wavelength[edge - 1]) \
+            / (wavelength[edge] - wavelength[edge - 1])
+
+        a = numpy.concatenate(([edge[0] - 1],inner,[edge[1] - 1]))
+        b = numpy.concatenate(([edge[0]],inner,[edge[1]]))
+        t = numpy.concatenate(([edge_t[0]],numpy.zeros(len(inner)),[edge_t[1]]))
+        x = numpy.concatenate(([start],wavelength[inner],[end]))
+        return a,b,t,x
+
+    def _nodes(self,flux:numpy.ndarray):
+        flux = numpy.asarray(flux,dtype=float)
+        if flux.shape[-1]!=len(self.wavelength):
+            raise ValueError(f"the length of `flux` {flux.shape[-1]} does not match "
+                             f"the wavelength grid {len(self.wavelength)}")
+        shape = flux.shape[:-1]
+        values = (self.matrix @ flux.reshape(-1,flux.shape[-1]).T).T
+        FI = values[:,:self.node_num]
+        blue = values[:,self.node_num:self.node_num + len(self.table)]
+        red = values[:,self.node_num + len(self.table):]
+        FC = blue[:,self.node_index] * (1 - self.node_u) + red[:,self.node_index] * self.node_u
+        return shape,FI,FC
+
+    @instrumented
+    def __call__(self,flux:numpy.ndarray,mask:numpy.ndarray = None)->numpy.ndarray:
+        """Indices of `flux` (...,npix), returned as an array (...,n_indices).
+
+        Indices whose bands use a pixel where `mask` is non-zero are `nan`.
+        """
+        shape,FI,FC = self._nodes(flux)
+        ratio = FI / FC
+        EW = numpy.add.reduceat(self.node_T * (1 - ratio),self.node_starts,axis=-1)
+        with numpy.errstate(divide="ignore",invalid="ignore"):
+            Mag = -2.5 * numpy.log10(numpy.add.reduceat(self.node_T * ratio,self.node_starts,axis=-1)
+                                     / self.widths)
+        res = numpy.where(self.units==0,EW,Mag).reshape(shape + (len(self.table),))
+        return self._mask_indices(res,mask)
+
+    def _mask_indices(self,res:numpy.ndarray,mask:numpy.ndarray)->numpy.ndarray:
+        if mask is None:
+            return res
+        mask = numpy.broadcast_to(numpy.asarray(mask)!=0,res.shape[:-1] + (len(self.wavelength),))
+        bad = (self.usage @ mask.reshape(-1,mask.shape[-1]).T.astype(float)).T>0
+        return numpy.where(bad.reshape(res.shape),numpy.nan,res)
+
+    @instrumented
+    def errors(self,flux:numpy.ndarray
+               ,ivar:numpy.ndarray
+               ,*
+               ,mask:numpy.ndarray = None
+               ,mode:str = "analytic"
+               ,n_realizations:int = 100
+               ,seed:int = None)->numpy.ndarray:
+        """1-sigma uncertainties of the indices, shaped like `self(flux)`.
+
+        `ivar` is the inverse variance of `flux`. `mode="analytic"` propagates
+        the pixel variances through the band integrals to first order,
+        `mode="montecarlo"` evaluates `n_realizations` noisy copies of every
+        spectrum in one pass and takes their standard deviation. Pixels with
+        `ivar<=0` have unknown variance, so indices that use them get `nan`,
+        as do the indices using a pixel flagged in `mask`.
+        """
+        flux = numpy.asarray(flux,dtype=float)
+        ivar = numpy.broadcast_to(numpy.asarray(ivar,dtype=float),flux.shape)
+        with numpy.errstate(divide="ignore"):
+            variance = numpy.where(ivar>0,1 / ivar,numpy.nan)
+
+        if mode=="analytic":
+            res = self._errors_analytic(flux,variance)
+        elif mode=="montecarlo":
+            res = self._errors_montecarlo(flux,variance,n_realizations,seed)
+        else:
+            raise ValueError("`mode` must be 'analytic' or 'montecarlo'")
+        return self._mask_indices(res,mask)
+
+    def _prepare_error_terms(self):
+        # every stored entry of `self.matrix` feeds one (index,pixel) pair of the Jacobian
+        index_num = len(self.table)
+        pixel_num = len(self.wavelength)
+        row_index = numpy.concatenate((self.node_index
+                                       ,numpy.arange(index_num),numpy.arange(index_num)))
+        coo = self.matrix.tocoo()
+        pairs,inverse = numpy.unique(row_index[coo.row] * pixel_num + coo.col
+                                     ,return_inverse=True)
+        pair_matrix = sparse.csr_matrix((numpy.ones(len(coo.data))
+                                         ,(numpy.arange(len(coo.data)),inverse.ravel()))
+                                        ,shape=(len(coo.data),len(pairs)))
+        pair_index = pairs // pixel_num
+        self._error_terms = (coo.row,coo.data,pair_matrix
+                             ,pairs % pixel_num
+                             ,numpy.searchsorted(pair_index,numpy.arange(index_num)))
+
+    def _errors_analytic(self,flux:numpy.ndarray,variance:numpy.ndarray)->numpy.ndarray:
+        if self._error_terms is None:
+            self._prepare_error_terms()
+        entry_row,entry_value,pair_matrix,pair_pixel,pair_starts = self._error_terms
+
+        shape,FI,FC = self._nodes(flux)
+        variance = variance.reshape(-1,variance.shape[-1])
+        g = self.node_T / FC
+        # EW = sum(T*(1-FI/FC)), Mag = -2.5*log10(sum(T*FI/FC)/width),
+        # both are `scale * sum(T*FI/FC)` to first order
+        with numpy.errstate(divide="ignore",invalid="ignore"):
+            S = numpy.add.reduceat(g * FI,self.node_starts,axis=-1)
+            scale = numpy.where(self.units==0,-1.0,-2.5 / (S * numpy.log(10)))
+        scale_node = scale[:,self.node_index]
+        dFI = scale_node * g
+        dFC = -scale_node * g * FI / FC
+        dblue = numpy.add.reduceat(dFC * (1 - self.node_u),self.node_starts,axis=-1)
+        dred = numpy.add.reduceat(dFC * self.node_u,self.node_starts,axis=-1)
+        derivative = numpy.concatenate((dFI,dblue,dred),axis=-1)
+
+        jacobian = (pair_matrix.T @ (derivative[:,entry_row] * entry_value).T).T
+        with numpy.errstate(invalid="ignore"):
+            terms = numpy.where(jacobian==0,0,jacobian ** 2 * variance[:,pair_pixel])
+        res = numpy.sqrt(numpy.add.reduceat(terms,pair_starts,axis=-1))
+        return res.reshape(shape + (len(self.table),))
+
+    def _errors_montecarlo(self,flux:numpy.ndarray
+                           ,variance:numpy.ndarray
+                           ,n_realizations:int
+                           ,seed:int)->numpy.ndarray:
+        rng = numpy.random.default_rng(seed)
+        shape = flux.shape[:-1]
+        pixel_num = flux.shape[-1]
+        flux = flux.reshape(-1,pixel_num)
+        sigma = numpy.sqrt(variance).reshape(-1,pixel_num)
+        res = numpy.empty((len(flux),len(self.table)))
+        # bound the (spectra,realizations,npix) block to a few million values
+        chunk_size = max(1,2 ** 22 // (n_realizations * pixel_num))
+        for start in range(0,len(flux),chunk_size):
+            end = start + chunk_size
+            noise = rng.standard_normal((len(flux[start:end]),n_realizations,pixel_num))
+            values = self(flux[start:end,None,:] + sigma[start:end,None,:] * noise)
+            res[start:end] = numpy.std(values,axis=1,ddof=1)
+        return res.reshape(shape + (len(self.table),))
+
+    def __repr__(self):
+        return f"LickLineIndexPlan(n_indices={len(self.table)},pixel_num={len(self.wavelength)})"
+
+
+def _trapezoid_weights(x:numpy.ndarray)->numpy.ndarray:
+    dx = numpy.diff(x)
+    w = numpy.zeros(len(x))
+    w[:-1] += dx / 2
+    w[1:] += dx / 2
+    return w
+
+
+@instrumented
 def compute_LickLineIndices(fits_data:FitsData = None
                             ,*
                             ,wavelength:numpy.ndarray = None
                             ,flux:numpy.ndarray = None
                             ,LickLineIndex_table:list[LickLineIndex] = None
+                            ,plan:LickLineIndexPlan = None
+                            ,ivar:numpy.ndarray = None
+                            ,mask:numpy.ndarray|bool = None
+                            ,return_errors:bool = False
+                            ,error_mode:str = "analytic"
+                            ,n_realizations:int = 100
+                            ,seed:int = None
                             )->dict:
+    # `plan` can be built once with `LickLineIndexPlan(wavelength,table)` and
+    # reused for every spectrum that shares the wavelength grid.
+    # With `return_errors` every index maps to `(value,sigma)`, see `LickLineIndexPlan.errors`.
+    # Indices using a pixel flagged in `mask` are `nan`; `mask=True` takes `fits_data.andmask`
     if (wavelength is None or flux is None) and fits_data is None:
         raise ValueError("must provide either `wavelength` and `flux` or `fits_data`")
     
     if fits_data is not None and (wavelength is not None or flux is not None):
         raise ValueError("must provide either `wavelength` and `flux` or `fits_data`")
     
-    if LickLineIndex_table is None:
-        LickLineIndex_table = read_LickLineIndex(str(Path(__file__).parent / Path("assets") / Path("index.table")))
-    
     if fits_data is not None:
         wavelength = numpy.asarray(fits_data.wavelength)
         flux = numpy.asarray(fits_data.flux)
+        if ivar is None:
+            ivar = fits_data.ivar
+        if mask is True:
+            mask = fits_data.andmask
     else:
         wavelength = numpy.asarray(wavelength)
         flux = numpy.asarray(flux)
+    if mask is True:
+        raise ValueError("`mask=True` requires `fits_data`")
 
-    res = dict()
-    for lick_line_index in LickLineIndex_table:
+    if plan is None:
+        plan = LickLineIndexPlan(wavelength,LickLineIndex_table)
 
-        (wavelength_FI_lambda
-        ,flux_FI_lambda
-        ,wavelength_FC_lambda
-        ,flux_FC_lambda) = compute_FI_lambda_FC_lambda(wavelength,flux
-                                                       ,lick_line_index)
-        if lick_line_index.units == 0:
-            res[lick_line_index.index_name] = compute_EW(wavelength_FI_lambda,flux_FI_lambda,wavelength_FC_lambda,flux_FC_lambda)
-        else:
-            res[lick_line_index.index_name] = compute_Mag(wavelength_FI_lambda,flux_FI_lambda,wavelength_FC_lambda,flux_FC_lambda)
-    return res
+    values = plan(flux,mask)
+    if not return_errors:
+        return dict(zip(plan.names,values))
+
+    if ivar is None:
+        raise ValueError("`ivar` is required to compute errors")
+    sigmas = plan.errors(flux,ivar,mask=mask,mode=error_mode
+                         ,n_realizations=n_realizations,seed=seed)
+    return dict(zip(plan.names,zip(values,sigmas)))
             
             
 
+@instrumented
+def compute_LickLineIndices_batch(spectra:SpectrumBatch|Iterable[FitsData] = None
+                                  ,*
+                                  ,wavelength:numpy.ndarray = None
+                                  ,flux:numpy.ndarray = None
+                                  ,LickLineIndex_table:list[LickLineIndex] = None
+                                  ,workers:int = None
+                                  ,executor:str = "process"
+                                  ,as_table:bool = False
+                                  ,ivar:numpy.ndarray = None
+                                  ,mask:numpy.ndarray|bool = None
+                                  ,return_errors:bool = False
+                                  ,error_mode:str = "analytic"
+                                  ,n_realizations:int = 100
+                                  ,seed:int = None)->numpy.ndarray:
+    """Lick indices of many spectra, one row per spectrum.
+
+    Either `spectra` (a `SpectrumBatch` or an iterable of `FitsData`) or
+    `flux` (N,npix) on a shared `wavelength` grid. Spectra are grouped by
+    wavelength grid and each group is computed with one `LickLineIndexPlan`.
+    When the grids differ, `workers>1` spreads the groups over a pool.
+    Returns an (N,n_indices) array, or a structured array with one field per
+    index if `as_table`. With `return_errors` a second array of the same
+    form holds the uncertainties, taken from `ivar` or the spectra's own.
+    Indices using a pixel flagged in `mask` (N,npix) are `nan`, `mask=True`
+    takes the spectra's own `andmask`.
+    """
+    if (wavelength is None or flux is None) and spectra is None:
+        raise ValueError("must provide either `wavelength` and `flux` or `spectra`")
+
+    if spectra is not None and (wavelength is not None or flux is not None):
+        raise ValueError("must provide either `wavelength` and `flux` or `spectra`")
+
+    if LickLineIndex_table is None:
+        LickLineIndex_table = default_LickLineIndex_table()
+
+    if spectra is None:
+        if mask is True:
+            raise ValueError("`mask=True` requires `spectra`")
+        flux = numpy.atleast_2d(flux)
+        groups = [(numpy.asarray(wavelength,dtype=float),flux
+                   ,None if ivar is None else numpy.broadcast_to(ivar,flux.shape)
+                   ,None if mask is None else numpy.broadcast_to(mask,flux.shape),None)]
+    elif isinstance(spectra,SpectrumBatch) and spectra.wavelength.ndim==1:
+        if mask is True:
+            mask = spectra.andmask
+        groups = [(spectra.wavelength,spectra.flux
+                   ,spectra.ivar if ivar is None else numpy.broadcast_to(ivar,spectra.flux.shape)
+                   ,None if mask is None else numpy.broadcast_to(mask,spectra.flux.shape),None)]
+    else:
+        groups = _group_by_wavelength(spectra,return_errors and ivar is None,mask is True)
+        if ivar is not None:
+            # an explicit ivar (N,npix) is given in input order, split it like the spectra
+            ivar = numpy.asarray(ivar,dtype=float)
+            groups = [group[:2] + (_split_rows(ivar,group),) + group[3:] for group in groups]
+        if mask is not None and mask is not True:
+            # so is an explicit mask
+            mask = numpy.asarray(mask)
+            groups = [group[:3] + (_split_rows(mask,group),group[4]) for group in groups]
+
+    if return_errors and any(group[2] is None for group in groups):
+        raise ValueError("`ivar` is required to compute errors")
+
+    error_options = None
+    if return_errors:
+        error_options = {"mode":error_mode,"n_realizations":n_realizations,"seed":seed}
+    size = sum(len(group[1]) for group in groups)
+    res = numpy.empty((size,len(LickLineIndex_table)))
+    errors = numpy.empty((size,len(LickLineIndex_table))) if return_errors else None
+    tasks = [(group_wavelength,group_flux,group_ivar,group_mask,LickLineIndex_table,error_options)
+             for group_wavelength,group_flux,group_ivar,group_mask,_ in groups]
+
+    workers = 1 if workers is None else workers
+    if workers<=1 or len(groups)==1:
+        results = map(_compute_group,tasks)
+        _scatter_groups(res,errors,groups,results)
+    else:
+        pool_cls = ProcessPoolExecutor if executor=="process" else ThreadPoolExecutor
+        func,collect = instrument._for_workers(_compute_group,executor)
+        with pool_cls(max_workers=workers) as pool:
+            results = pool.map(func,tasks
+                               ,chunksize=max(1,len(tasks) // (4 * workers)))
+            results = (instrument._from_workers(result,collect) for result in results)
+            _scatter_groups(res,errors,groups,results)
+
+    if as_table:
+        names = [lick_line_index.index_name for lick_line_index in LickLineIndex_table]
+        res = _to_table(res,names)
+        errors = None if errors is None else _to_table(errors,names)
+    if return_errors:
+        return res,errors
+    return res
+
+
+def _to_table(values:numpy.ndarray,names:list[str])->numpy.ndarray:
+    table = numpy.empty(len(values),dtype=[(name,float) for name in names])
+    for i,name in enumerate(names):
+        table[name] = values[:,i]
+    return table
+
+
+def _group_by_wavelength(spectra:Iterable[FitsData]
+                         ,with_ivar:bool = False
+                         ,with_mask:bool = False)->list[tuple]:
+    # `(wavelength,flux_2d,ivar_2d,mask_2d,rows)` for every distinct wavelength grid
+    groups = dict()
+    for row,fits_data in enumerate(spectra):
+        wavelength = numpy.asarray(fits_data.wavelength,dtype=float)
+        key = wavelength.tobytes()
+        if key not in groups:
+            groups[key] = (wavelength,[],[],[],[])
+        groups[key][1].append(numpy.asarray(fits_data.flux,dtype=float))
+        groups[key][2].append(fits_data.ivar if with_ivar else None)
+        groups[key][3].append(fits_data.andmask if with_mask else None)
+        groups[key][4].append(row)
+
+    res = []
+    for wavelength,group_flux,group_ivar,group_mask,rows in groups.values():
+        res.append((wavelength,numpy.stack(group_flux),_stack_optional(group_ivar,float)
+                    ,_stack_optional(group_mask,int),numpy.asarray(rows)))
+    return res
+
+
+def _split_rows(values:numpy.ndarray,group:tuple)->numpy.ndarray:
+    # the rows of `values` (N,npix) in `group`, a single row (npix,) is shared
+    if values.ndim==1:
+        return numpy.broadcast_to(values,group[1].shape)
+    return values[group[4]]
+
+
+def _stack_optional(arrays:list,dtype)->numpy.ndarray:
+    if any(array is None for array in arrays):
+        return None
+    return numpy.stack([numpy.asarray(array,dtype=dtype) for array in arrays])
+
+
+def _compute_group(task:tuple)->tuple:
+    wavelength,flux,ivar,mask,LickLineIndex_table,error_options = task
+    plan = LickLineIndexPlan(wavelength,LickLineIndex_table)
+    if error_options is None:
+        return plan(flux,mask),None
+    return plan(flux,mask),plan.errors(flux,ivar,mask=mask,**error_options)
+
+
+def _scatter_groups(res:numpy.ndarray
+                    ,errors:numpy.ndarray
+                    ,groups:list[tuple]
+                    ,results:Iterable[tuple]):
+    for (_,_,_,_,rows),(values,sigmas) in zip(groups,results):
+        rows = slice(None) if rows is None else rows
+        res[rows] = values
+        if errors is not None:
+            errors[rows] = sigmas
+
+
 def compute_FI_lambda_FC_lambda(
         wavelength:numpy.ndarray
         ,flux:numpy.ndarray
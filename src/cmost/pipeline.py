@@ -0,0 +1,377 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+
+from __future__ import annotations
+
+import csv
+import time
+import numpy
+
+from abc import ABC,abstractmethod
+from functools import partial
+from typing import Iterable,Iterator
+
+from .io import FitsData,SpectrumBatch,resolve_paths,read_fits,_iter_map_chunks
+
+__all__ = ["Pipeline","Sink","NpySink","CSVSink","ParquetSink"]
+
+# stages are plain `(name,args,kwargs)` tuples so that a pipeline can be
+# pickled to the worker processes as it is
+_SPECTRUM_STAGES = ("minmax","align","remove_redshift","median_filter","normalize_continuum")
+
+
+class Pipeline:
+    """Processing stages declared once and run lazily over many FITS files.
+
+    ```
+    pipeline = Pipeline().remove_redshift().align(grid).median_filter(7).lick()
+    failed = pipeline.run("path/to/*.fits",sink=CSVSink("lick.csv"),workers=8)
+    ```
+
+    Files are read and processed in chunks of `chunk_size` spectra, each chunk
+    as one `SpectrumBatch`, and only a bounded number of chunks is in flight.
+    """
+    def __init__(self,stages:Iterable[tuple] = ()):
+        self.stages = tuple(stages)
+
+    def _then(self,name:str,*args,**kwargs)->Pipeline:
+        if self.stages and self.stages[-1][0]=="lick" and name!="map":
+            raise ValueError("only `map` can follow the `lick` stage")
+        return Pipeline(self.stages + ((name,args,kwargs),))
+
+    def minmax(self,range_:tuple = (0,1))->Pipeline:
+        return self._then("minmax",range_)
+
+    def align(self,aligned_wavelength:numpy.ndarray,**kwargs)->Pipeline:
+        return self._then("align",numpy.asarray(aligned_wavelength,dtype=float),**kwargs)
+
+    def remove_redshift(self,**kwargs)->Pipeline:
+        return self._then("remove_redshift",**kwargs)
+
+    def median_filter(self,size:int = 7)->Pipeline:
+        return self._then("median_filter",size)
+
+    def normalize_continuum(self,method:str = "sw5d",**params)->Pipeline:
+        # a `ContinuumCache` directory is shared between the workers, the
+        # in-memory default cache is not
+        return self._then("normalize_continuum",method,**params)
+
+    def lick(self,keys:tuple[str] = ("obsid",),**kwargs)->Pipeline:
+        # the result becomes a table: the header `keys` plus one field per index
+        return self._then("lick",tuple(keys),**kwargs)
+
+    def map(self,func:callable,*args,**kwargs)->Pipeline:
+        # `func(result,*args,**kwargs)`; it must be picklable for process workers
+        return self._then("map",func,*args,**kwargs)
+
+    def apply(self,spectra:SpectrumBatch|Iterable[FitsData]):
+        """Run the stages on spectra already in memory."""
+        if isinstance(spectra,SpectrumBatch):
+            return _apply_stages(spectra,self.stages)
+        batch,stages = _to_batch(list(spectra),self.stages)
+        return _apply_stages(batch,stages)
+
+    def iter(self,paths_or_glob:str|Iterable[str]
+             ,chunk_size:int = 256
+             ,workers:int = 1
+             ,executor:str = "process"
+             ,failed:dict = None
+             ,profile:dict = None)->Iterator:
+        """Yield the result of every chunk, in input order.
+
+        Chunks run in the calling process unless `workers>1`, which spreads
+        them over a pool (`workers=None` starts one worker per CPU).
+        Unreadable files and chunks whose processing failed are recorded in
+        `failed` (path -> exception) while the iterator is consumed. If a
+        `profile` dict is given, the seconds spent reading and in every stage
+        are added to it (summed over the workers).
+        """
+        if executor not in ("process","thread"):
+            raise ValueError("`executor` must be 'process' or 'thread'")
+        failed = dict() if failed is None else failed
+        paths = resolve_paths(paths_or_glob)
+        func = partial(_run_chunk,stages=self.stages,timed=profile is not None)
+        for _,result in _iter_map_chunks(func,paths,workers,executor,chunk_size,failed):
+            if profile is not None:
+                result,timings = result
+                for name,seconds in timings.items():
+                    profile[name] = profile.get(name,0.0) + seconds
+            yield result
+
+    def run(self,paths_or_glob:str|Iterable[str]
+            ,sink:Sink
+            ,chunk_size:int = 256
+            ,workers:int = 1
+            ,executor:str = "process"
+            ,profile:dict = None)->dict:
+        """Process every file and write the results to `sink` chunk by chunk.
+
+        Memory stays bounded by the chunks in flight. Returns `failed`.
+        `profile` also gets the time spent in `sink.write`, see `iter`.
+        """
+        failed = dict()
+        with sink:
+            for result in self.iter(paths_or_glob,chunk_size,workers,executor,failed,profile):
+                start = time.perf_counter()
+                sink.write(result)
+                if profile is not None:
+                    _timed(profile,"write",start)
+        return failed
+
+    def __repr__(self):
+        return "Pipeline(" + " -> ".join(["read"] + [name for name,_,_ in self.stages]) + ")"
+
+
+def _run_chunk(paths:list[str],stages:tuple,timed:bool = False)->list[tuple]:
+    # read and process one chunk; like the readers in `io` it returns
+    # `(path,result,error)` items, the processed chunk being a single item
+    # (`(result,timings)` if `timed`)
+    timings = dict() if timed else None
+    start = time.perf_counter()
+    spectra,ok_paths,res = [],[],[]
+    for path in paths:
+        try:
+            spectra.append(read_fits(path))
+            ok_paths.append(path)
+        except Exception as e:
+            res.append((path,None,e))
+    if timed:
+        _timed(timings,"read",start)
+    if not spectra:
+        return res
+
+    try:
+        batch,remaining = _to_batch(spectra,stages,timings)
+        result = _apply_stages(batch,remaining,timings)
+        res.append((tuple(ok_paths),(result,timings) if timed else result,None))
+    except Exception as e:
+        res.extend((path,None,e) for path in ok_paths)
+    return res
+
+
+def _to_batch(spectra:list[FitsData],stages:tuple,timings:dict = None)->tuple[SpectrumBatch,tuple]:
+    # spectra can only be stacked once they share a pixel number, so the
+    # leading stages run per spectrum until they do (typically up to `align`)
+    stages = list(stages)
+    while len({len(fits_data.flux) for fits_data in spectra})>1:
+        if not stages or stages[0][0] not in _SPECTRUM_STAGES:
+            raise ValueError("spectra have different pixel numbers, "
+                             "add an `align` stage before the other stages")
+        name,args,kwargs = stages.pop(0)
+        start = time.perf_counter()
+        spectra = [getattr(fits_data,name)(*args,**kwargs) for fits_data in spectra]
+        if timings is not None:
+            _timed(timings,name,start)
+    start = time.perf_counter()
+    batch = SpectrumBatch.from_fits_data(spectra)
+    if timings is not None:
+        _timed(timings,"stack",start)
+    return batch,tuple(stages)
+
+
+def _apply_stages(result,stages:tuple,timings:dict = None):
+    for name,args,kwargs in stages:
+        start = time.perf_counter()
+        if name=="map":
+            func,*args = args
+            result = func(result,*args,**kwargs)
+        elif name=="lick":
+            result = _lick_table(result,*args,**kwargs)
+        else:
+            result = getattr(result,name)(*args,**kwargs)
+        if timings is not None:
+            _timed(timings,name,start)
+    return result
+
+
+def _timed(timings:dict,name:str,start:float):
+    timings[name] = timings.get(name,0.0) + time.perf_counter() - start
+
+
+def _lick_table(batch:SpectrumBatch,keys:tuple[str],**kwargs)->numpy.ndarray:
+    from .lick import compute_LickLineIndices_batch # lazy load, needs scipy
+    values = compute_LickLineIndices_batch(batch,as_table=True,workers=1,**kwargs)
+    if kwargs.get("return_errors"):
+        values,errors = values
+        errors_ = numpy.empty(len(errors),dtype=[(f"{name}_err",float) for name in errors.dtype.names])
+        for name in errors.dtype.names:
+            errors_[f"{name}_err"] = errors[name]
+        values = _merge_fields(values,errors_)
+    keys = [key for key in keys if batch.header is not None and key in batch.header.dtype.names]
+    if not keys:
+        return values
+    return _merge_fields(batch.header[keys],values)
+
+
+def _merge_fields(*tables:numpy.ndarray)->numpy.ndarray:
+    dtype = [(name,table.dtype[name]) for table in tables for name in table.dtype.names]
+    res = numpy.empty(len(tables[0]),dtype=dtype)
+    for table in tables:
+        for name in table.dtype.names:
+            res[name] = table[name]
+    return res
+
+
+def _as_table(result)->numpy.ndarray:
+    # every result a sink can write, as a structured array: a `SpectrumBatch`
+    # gives its `obsid` (if any) and a `flux` sub-array field
+    if isinstance(result,SpectrumBatch):
+        flux = numpy.asarray(result.flux)
+        fields = []
+        if result.header is not None and "obsid" in result.header.dtype.names:
+            fields.append(("obsid",result.header["obsid"]))
+        fields.append(("flux",flux))
+        table = numpy.empty(len(flux),dtype=[(name,value.dtype,value.shape[1:]) for name,value in fields])
+        for name,value in fields:
+            table[name] = value
+        return table
+    result = numpy.asarray(result)
+    if result.dtype.names is None:
+        result = numpy.atleast_2d(result)
+        table = numpy.empty(len(result),dtype=[("value",result.dtype,result.shape[1:])])
+        table["value"] = result
+        return table
+    return result
+
+
+class Sink(ABC):
+    @abstractmethod
+    def write(self,result):
+        ...
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+class NpySink(Sink):
+    """Append chunks to a single `.npy` file.
+
+    A `SpectrumBatch` is written as its flux (N,npix), anything else as
+    returned by the last stage. The header reserves room for the final
+    shape and is rewritten on `close`, so rows are streamed straight to disk.
+    """
+    def __init__(self,path:str,dtype = None):
+        self.path = path
+        self.dtype = None if dtype is None else numpy.dtype(dtype)
+        self.file = None
+        self.row_shape = None
+        self.size = 0
+
+    def write(self,result):
+        array = numpy.asarray(result.flux if isinstance(result,SpectrumBatch) else result)
+        if self.dtype is not None:
+            array = array.astype(self.dtype,copy=False)
+        if self.file is None:
+            self.dtype = array.dtype
+            self.row_shape = array.shape[1:]
+            self.file = open(self.path,"wb")
+            # reserve room for the largest possible row count
+            self.header_size = len(self._header(numpy.iinfo(numpy.int64).max))
+            self.file.write(self._header(0,self.header_size))
+        if array.shape[1:]!=self.row_shape or array.dtype!=self.dtype:
+            raise ValueError(f"expected rows of shape {self.row_shape} and dtype {self.dtype}"
+                             f", got {array.shape[1:]} and {array.dtype}")
+        self.file.write(numpy.ascontiguousarray(array).tobytes())
+        self.size += len(array)
+
+    def _header(self,size:int,reserved:int = 0)->bytes:
+        header = repr({"descr":numpy.lib.format.dtype_to_descr(self.dtype)
+                       ,"fortran_order":False
+                       ,"shape":(size,) + self.row_shape})
+        # magic (6) + version (2) + length (2) + header + newline,
+        # space padded to the reserved size and to a multiple of 64 bytes
+        total = max(reserved,10 + len(header) + 1)
+        total += -total % 64
+        header = header.ljust(total - 11) + "\n"
+        return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2,"little") + header.encode("latin1")
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(self._header(self.size,self.header_size))
+        self.file.close()
+        self.file = None
+
+
+class CSVSink(Sink):
+    """Append chunks to a CSV file, one row per spectrum.
+
+    Sub-array fields (such as `flux`) are spread over `name_0,name_1,...`.
+    """
+    def __init__(self,path:str,delimiter:str = ","):
+        self.path = path
+        self.delimiter = delimiter
+        self.file = None
+        self.writer = None
+
+    def write(self,result):
+        table = _as_table(result)
+        if self.file is None:
+            self.file = open(self.path,"w",newline="",encoding="utf-8")
+            self.writer = csv.writer(self.file,delimiter=self.delimiter)
+            self.writer.writerow(_flat_names(table.dtype))
+        columns = [numpy.asarray(table[name]).reshape(len(table),-1) for name in table.dtype.names]
+        # object columns keep integers (obsid) from turning into floats
+        rows = numpy.concatenate([column.astype(object) for column in columns],axis=1)
+        self.writer.writerows(rows.tolist())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _flat_names(dtype:numpy.dtype)->list[str]:
+    names = []
+    for name in dtype.names:
+        size = int(numpy.prod(dtype[name].shape))
+        if dtype[name].shape:
+            names.extend(f"{name}_{i}" for i in range(size))
+        else:
+            names.append(name)
+    return names
+
+
+class ParquetSink(Sink):
+    """Append chunks to a Parquet file, one row group per chunk.
+
+    Requires `pyarrow`. Sub-array fields become fixed size list columns.
+    """
+    def __init__(self,path:str):
+        try:
+            import pyarrow # lazy load, optional dependency
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("`ParquetSink` requires `pyarrow`, "
+                              "install it with `pip install pyarrow`") from e
+        self.pyarrow = pyarrow
+        self.path = path
+        self.writer = None
+
+    def write(self,result):
+        pyarrow = self.pyarrow
+        table = _as_table(result)
+        arrays = []
+        for name in table.dtype.names:
+            column = numpy.ascontiguousarray(table[name])
+            if column.ndim>1:
+                flat = pyarrow.array(column.reshape(-1))
+                arrays.append(pyarrow.FixedSizeListArray.from_arrays(flat,int(numpy.prod(column.shape[1:]))))
+            else:
+                arrays.append(pyarrow.array(column))
+        arrow_table = pyarrow.Table.from_arrays(arrays,names=list(table.dtype.names))
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path,arrow_table.schema)
+        self.writer.write_table(arrow_table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
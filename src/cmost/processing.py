@@ -3,36 +3,449 @@
 
 from __future__ import annotations
 
+import re
 import numpy
-from scipy import interpolate, signal
-        
-def minmax_function(flux,range_:tuple)->numpy.ndarray:
-    flux = range_[0] + (range_[1] - range_[0]) * (flux - numpy.min(flux)) \
-        / (numpy.max(flux) - numpy.min(flux))
-    return flux
 
+from functools import cache
+from numpy.lib.stride_tricks import sliding_window_view
+from .instrument import instrumented
 
+@instrumented
+def minmax_function(flux
+                    ,range_:tuple
+                    ,mask:numpy.ndarray = None
+                    ,ivar:numpy.ndarray = None)->numpy.ndarray:
+    # works along the last axis, so a (N,npix) batch is scaled row by row.
+    # Pixels where `mask` is non-zero do not set the bounds; with `ivar`,
+    # `(flux,ivar)` is returned with the inverse variance scaled accordingly
+    flux = numpy.asarray(flux,dtype=float)
+    if mask is None:
+        flux_min = numpy.min(flux,axis=-1,keepdims=True)
+        flux_max = numpy.max(flux,axis=-1,keepdims=True)
+    else:
+        good = (numpy.asarray(mask)==0) & numpy.isfinite(flux)
+        flux_min = numpy.min(flux,axis=-1,keepdims=True,where=good,initial=numpy.inf)
+        flux_max = numpy.max(flux,axis=-1,keepdims=True,where=good,initial=-numpy.inf)
+    scale = (range_[1] - range_[0]) / (flux_max - flux_min)
+    flux = range_[0] + scale * (flux - flux_min)
+    if ivar is None:
+        return flux
+    return flux,numpy.asarray(ivar,dtype=float) / scale ** 2
+
+
+@instrumented
+def interpolate_linear(wavelength:numpy.ndarray
+                       ,flux:numpy.ndarray
+                       ,new_wavelength:numpy.ndarray)->numpy.ndarray:
+    """Linear interpolation along the last axis, clamped to the edge fluxes.
+
+    `wavelength` is either a shared grid (npix,) or one grid per row (N,npix),
+    `new_wavelength` is either (k,) or (N,k). It behaves like `interp1d` with
+    `fill_value=(flux[0],flux[-1])` but for all rows in one pass.
+    """
+    return Resampler(wavelength,new_wavelength,"linear")(flux)
+
+
+def _searchsorted_rows(wavelength:numpy.ndarray
+                       ,new_wavelength:numpy.ndarray)->numpy.ndarray:
+    # row-wise `searchsorted`: shift every row into its own disjoint range so
+    # that one flat search covers the whole batch
+    row_num,pixel_num = wavelength.shape
+    new_wavelength = numpy.broadcast_to(new_wavelength
+                                        ,(row_num,new_wavelength.shape[-1]))
+    lower = min(numpy.min(wavelength),numpy.min(new_wavelength))
+    width = max(numpy.max(wavelength),numpy.max(new_wavelength)) - lower + 1
+    offset = numpy.arange(row_num)[:,None] * width - lower
+    index = numpy.searchsorted((wavelength + offset).ravel()
+                               ,(new_wavelength + offset).ravel()
+                               ,side="right").reshape(new_wavelength.shape)
+    return index - numpy.arange(row_num)[:,None] * pixel_num
+
+
+def _take(values:numpy.ndarray,index:numpy.ndarray)->numpy.ndarray:
+    # `values[...,index]` for a shared index (k,), row by row for an index (N,k)
+    if index.ndim==1:
+        return values[...,index]
+    if values.ndim==1:
+        return values[index]
+    return numpy.take_along_axis(values,index,axis=-1)
+
+
+class Resampler:
+    """Resampling from one wavelength grid to another, planned once.
+
+    `source_wavelength` is a shared grid (npix,) or one grid per row (N,npix),
+    `target_wavelength` is (k,) or (N,k). The bin indices and weights are
+    computed at construction, so applying the plan to a spectrum or a batch
+    is a fused gather. `method="linear"` matches `interp1d` with the edge
+    fluxes as fill values, `method="flux_conserving"` averages the flux over
+    every target bin (bin edges halfway between pixels). `mask` and `ivar`
+    resample the and/or masks and the inverse variance with the same plan.
+    """
+    def __init__(self,source_wavelength:numpy.ndarray
+                 ,target_wavelength:numpy.ndarray
+                 ,method:str = "linear"):
+        if method not in ("linear","flux_conserving"):
+            raise ValueError("`method` must be 'linear' or 'flux_conserving'")
+        source_wavelength = numpy.asarray(source_wavelength,dtype=float)
+        self.target_wavelength = numpy.asarray(target_wavelength,dtype=float)
+        self.method = method
+
+        self.order = None
+        if source_wavelength.ndim==1 and numpy.any(numpy.diff(source_wavelength)<=0):
+            self.order = numpy.argsort(source_wavelength,kind="stable")
+            source_wavelength = source_wavelength[self.order]
+        self.source_wavelength = source_wavelength
+        self.band()
+
+    @instrumented
+    def band(self):
+        source = self.source_wavelength
+        target = self.target_wavelength
+        pixel_num = source.shape[-1]
+        if self.method=="linear":
+            if source.ndim==1:
+                index = numpy.searchsorted(source,target,side="right")
+            else:
+                index = _searchsorted_rows(source,target)
+            index = numpy.clip(index,1,pixel_num - 1)
+            self.lo = index - 1
+            x0 = _take(source,self.lo)
+            self.t = numpy.clip((target - x0) / (_take(source,index) - x0),0,1)
+        else:
+            source_edges = bin_edges(source)
+            target_edges = numpy.clip(bin_edges(target)
+                                      ,source_edges[...,:1],source_edges[...,-1:])
+            self.source_widths = numpy.diff(source_edges,axis=-1)
+            self.lo,self.t = _edge_positions(source_edges,target_edges)
+            self.target_widths = numpy.diff(target_edges,axis=-1)
+            # bins fully outside the source take the nearest edge pixel, like the linear mode
+            self.outside = numpy.where(self.target_widths>0,-1
+                                       ,numpy.where(target<source[...,:1],0,pixel_num - 1))
+
+    def _ordered(self,values:numpy.ndarray)->numpy.ndarray:
+        values = numpy.asarray(values)
+        if self.order is not None:
+            values = values[...,self.order]
+        return values
+
+    @instrumented
+    def __call__(self,flux:numpy.ndarray)->numpy.ndarray:
+        flux = self._ordered(flux).astype(float,copy=False)
+        if self.method=="linear":
+            y0 = _take(flux,self.lo)
+            return y0 + self.t * (_take(flux,self.lo + 1) - y0)
+        return _integrate_bins(flux,self.source_widths,self.lo,self.t
+                               ,self.target_widths,self.outside)
+
+    @instrumented
+    def mask(self,mask:numpy.ndarray)->numpy.ndarray:
+        """Bitwise OR of the masks of every source pixel used by an output pixel."""
+        mask = self._ordered(mask)
+        if self.method=="linear":
+            return numpy.where(self.t<1,_take(mask,self.lo),0) \
+                | numpy.where(self.t>0,_take(mask,self.lo + 1),0)
+
+        start = self.lo[...,:-1]
+        end = numpy.where(self.t[...,1:]>0,self.lo[...,1:] + 1,self.lo[...,1:])
+        res = _or_ranges(mask,start,numpy.maximum(end,start + 1))
+        return self._fill_outside(res,mask)
+
+    @instrumented
+    def ivar(self,ivar:numpy.ndarray)->numpy.ndarray:
+        """Inverse variance of the resampled flux, 0 wherever a source pixel with `ivar<=0` is used."""
+        ivar = self._ordered(ivar).astype(float,copy=False)
+        bad = ~(ivar>0)
+        with numpy.errstate(divide="ignore"):
+            variance = numpy.where(bad,0.0,1 / ivar)
+
+        if self.method=="linear":
+            w0,w1 = 1 - self.t,self.t
+            res_variance = w0 ** 2 * _take(variance,self.lo) + w1 ** 2 * _take(variance,self.lo + 1)
+            res_bad = ((w0>0) & _take(bad,self.lo)) | ((w1>0) & _take(bad,self.lo + 1))
+        else:
+            # the bin mean is `sum(overlap_j*flux_j)/width`: the pixels fully
+            # inside a bin come from cumulative sums, the two partial ones are added
+            a,b = self.lo[...,:-1],self.lo[...,1:]
+            ta,tb = self.t[...,:-1],self.t[...,1:]
+            same = a==b
+            overlap_a = numpy.where(same,tb - ta,1 - ta) * _take(self.source_widths,a)
+            overlap_b = numpy.where(same,0.0,tb) * _take(self.source_widths,b)
+            cumulative = _cumsum0(variance * self.source_widths ** 2)
+            cumulative_bad = _cumsum0(bad.astype(numpy.int64))
+            inner = numpy.where(same,0.0,_take(cumulative,b) - _take(cumulative,a + 1))
+            inner_bad = ~same & (_take(cumulative_bad,b)>_take(cumulative_bad,a + 1))
+            res_variance = (inner + overlap_a ** 2 * _take(variance,a)
+                            + overlap_b ** 2 * _take(variance,b))
+            with numpy.errstate(divide="ignore",invalid="ignore"):
+                res_variance = res_variance / self.target_widths ** 2
+            res_bad = inner_bad | ((overlap_a>0) & _take(bad,a)) | ((overlap_b>0) & _take(bad,b))
+            res_variance = self._fill_outside(res_variance,variance)
+            res_bad = self._fill_outside(res_bad,bad)
+
+        with numpy.errstate(divide="ignore"):
+            return numpy.where(res_bad,0.0,1 / res_variance)
+
+    def _fill_outside(self,res:numpy.ndarray,values:numpy.ndarray)->numpy.ndarray:
+        if not numpy.any(self.outside>=0):
+            return res
+        outside = numpy.broadcast_to(self.outside,res.shape)
+        edge_values = _take(values,numpy.clip(outside,0,None))
+        return numpy.where(outside>=0,edge_values,res)
+
+    def __repr__(self):
+        return (f"Resampler(method={self.method!r},source_size={self.source_wavelength.shape[-1]}"
+                f",target_size={self.target_wavelength.shape[-1]})")
+
+
+def bin_edges(wavelength:numpy.ndarray)->numpy.ndarray:
+    # pixel edges along the last axis: halfway between pixels, half a step beyond the ends
+    wavelength = numpy.asarray(wavelength,dtype=float)
+    mid = (wavelength[...,1:] + wavelength[...,:-1]) / 2
+    first = wavelength[...,:1] - (mid[...,:1] - wavelength[...,:1])
+    last = wavelength[...,-1:] + (wavelength[...,-1:] - mid[...,-1:])
+    return numpy.concatenate((first,mid,last),axis=-1)
+
+
+def _edge_positions(source_edges:numpy.ndarray,target_edges:numpy.ndarray)->tuple:
+    # source bin `lo` holding every target edge and the fraction `t` of it below the edge
+    if source_edges.ndim==1:
+        index = numpy.searchsorted(source_edges,target_edges,side="right")
+    else:
+        index = _searchsorted_rows(source_edges,target_edges)
+    lo = numpy.clip(index - 1,0,source_edges.shape[-1] - 2)
+    left,right = _take(source_edges,lo),_take(source_edges,lo + 1)
+    t = numpy.clip((target_edges - left) / (right - left),0,1)
+    return lo,t
+
+
+def _cumsum0(values:numpy.ndarray)->numpy.ndarray:
+    # cumulative sum along the last axis with a leading 0
+    zeros = numpy.zeros(values.shape[:-1] + (1,),dtype=values.dtype)
+    return numpy.concatenate((zeros,numpy.cumsum(values,axis=-1)),axis=-1)
+
+
+def _integrate_bins(flux:numpy.ndarray
+                    ,source_widths:numpy.ndarray
+                    ,lo:numpy.ndarray
+                    ,t:numpy.ndarray
+                    ,target_widths:numpy.ndarray
+                    ,outside:numpy.ndarray)->numpy.ndarray:
+    # cumulative integral of the (piecewise constant) flux at every source edge,
+    # read at the target edges; the difference over a target bin is its flux
+    area = flux * source_widths
+    at_edges = _take(_cumsum0(area),lo) + t * _take(area,lo)
+    with numpy.errstate(divide="ignore",invalid="ignore"):
+        res = numpy.diff(at_edges,axis=-1) / target_widths
+    if numpy.any(outside>=0):
+        rows = numpy.broadcast_to(outside,res.shape)
+        edge_flux = _take(flux,numpy.clip(rows,0,None))
+        res = numpy.where(rows>=0,edge_flux,res)
+    return res
+
+
+def _or_ranges(values:numpy.ndarray,start:numpy.ndarray,end:numpy.ndarray)->numpy.ndarray:
+    # bitwise OR of `values[...,start:end]` for every range along the last axis
+    pixel_num = values.shape[-1]
+    shape = numpy.broadcast_shapes(values.shape[:-1],start.shape[:-1])
+    values = numpy.broadcast_to(values,shape + (pixel_num,)).reshape(-1,pixel_num)
+    start = numpy.broadcast_to(start,shape + start.shape[-1:]).reshape(len(values),-1)
+    end = numpy.broadcast_to(end,shape + end.shape[-1:]).reshape(len(values),-1)
+    # one padding pixel per row keeps `end` a valid index; `reduceat` over the
+    # interleaved (start,end) pairs gives every range at the even positions
+    padded = numpy.concatenate((values,numpy.zeros((len(values),1),dtype=values.dtype)),axis=-1)
+    offset = numpy.arange(len(values))[:,None] * (pixel_num + 1)
+    index = numpy.stack((start + offset,end + offset),axis=-1).ravel()
+    res = numpy.bitwise_or.reduceat(padded.ravel(),index)[::2]
+    return res.reshape(shape + start.shape[-1:])
+
+
+@instrumented
 def align_wavelength(wavelength:numpy.ndarray
                      ,flux:numpy.ndarray
                      ,aligned_wavelength:numpy.ndarray
                      ,**kwargs)->tuple[numpy.ndarray]:
+    # `kind` is "linear", "flux_conserving" or any other `interp1d` kind,
+    # a prebuilt `resampler` skips the planning step entirely
     kind = kwargs.get("kind","linear")
+    resampler = kwargs.get("resampler")
+    if resampler is not None:
+        return resampler(flux)
+
+    if kind in ("linear","flux_conserving"):
+        return Resampler(wavelength,aligned_wavelength,kind)(flux)
+
+    from scipy import interpolate # lazy load
+    flux = numpy.asarray(flux)
     F = interpolate.interp1d(wavelength,flux,kind=kind
                             ,bounds_error=False
-                            ,fill_value=(flux[0],flux[-1]))
+                            ,fill_value=(flux[...,0],flux[...,-1]))
 
     return F(aligned_wavelength)
 
 
+@instrumented
+def rebin_flux_conserving(wavelength:numpy.ndarray
+                          ,flux:numpy.ndarray
+                          ,new_wavelength:numpy.ndarray)->numpy.ndarray:
+    """Flux-conserving rebinning along the last axis.
+
+    `wavelength` is (npix,) or per row (N,npix), `new_wavelength` is (k,) or
+    (N,k). Each output pixel is the mean flux over its bin.
+    """
+    return Resampler(wavelength,new_wavelength,"flux_conserving")(flux)
+
+
+@instrumented
+def redshift_resampler(wavelength_obs:numpy.ndarray
+                       ,Z:float
+                       ,wavelength_grid:numpy.ndarray = None
+                       ,kind:str = "linear")->Resampler:
+    # sampling the rest frame spectrum at `wavelength_grid` is the same as
+    # sampling the observed one at `wavelength_grid * (1 + Z)`, so a batch
+    # with a different `Z` per row is still a single plan
+    wavelength_obs = numpy.asarray(wavelength_obs,dtype=float)
+    wavelength_grid = wavelength_obs if wavelength_grid is None \
+        else numpy.asarray(wavelength_grid,dtype=float)
+    Z = numpy.asarray(Z,dtype=float)
+    if Z.ndim>0:
+        Z = numpy.reshape(Z,(-1,1))
+    return Resampler(wavelength_obs,wavelength_grid * (1 + Z),kind)
+
+
+@instrumented
 def remove_redshift(wavelength_obs:numpy.ndarray
                      ,flux_rest:numpy.ndarray
                     ,Z:float
                     ,**kwargs)->tuple[numpy.ndarray]:
+    # `kind` is "linear", "flux_conserving" or any other `interp1d` kind.
+    # The rest frame spectrum is sampled on `wavelength_grid` (default
+    # `wavelength_obs`); `Z` is a scalar or one redshift per row of a batch
     kind = kwargs.get("kind","linear")
+    wavelength_grid = kwargs.get("wavelength_grid")
+    if kind in ("linear","flux_conserving"):
+        return redshift_resampler(wavelength_obs,Z,wavelength_grid,kind)(flux_rest)
+    if numpy.ndim(flux_rest) > 1:
+        raise ValueError("only `kind='linear'` or `kind='flux_conserving'` is supported for a batch of spectra")
+
+    if wavelength_grid is None:
+        wavelength_grid = wavelength_obs
     wavelength_rest = wavelength_obs / (1 + Z)
+    from scipy import interpolate # lazy load
     F = interpolate.interp1d(wavelength_rest,flux_rest,kind=kind
                         ,bounds_error=False,fill_value=(flux_rest[0],flux_rest[-1]))
-    return F(wavelength_obs)
+    return F(wavelength_grid)
+
+@instrumented
+def median_filter(flux:numpy.ndarray
+                  ,size:int
+                  ,mask:numpy.ndarray = None)->numpy.ndarray:
+    # zero padding and odd sizes like `signal.medfilt`, see `moving_median`
+    if size<1 or size % 2==0:
+        raise ValueError(f"`size` must be a positive odd integer, got {size}")
+    return moving_median(flux,size,mode="constant",mask=mask)
+
+
+@instrumented
+def moving_median(flux:numpy.ndarray
+                  ,size:int
+                  ,mode:str = "reflect"
+                  ,cval:float = 0.0
+                  ,mask:numpy.ndarray = None)->numpy.ndarray:
+    """Median filter along the last axis of a spectrum (npix,) or a batch (N,npix).
+
+    The window of pixel `i` starts at `i - size//2` and the result is its
+    element of rank `size//2`, as in `ndimage.median_filter` (for an odd
+    `size` and `mode="constant"` it is `signal.medfilt`). `mode` is
+    "reflect" or "constant" (padding with `cval`). NaN pixels and pixels
+    where `mask` is non-zero are left out of every window, a window without
+    any valid pixel gives NaN.
+    """
+    if mode not in ("reflect","constant"):
+        raise ValueError("`mode` must be 'reflect' or 'constant'")
+    flux = numpy.asarray(flux,dtype=float)
+    shape = flux.shape
+    rows = flux.reshape(-1,shape[-1])
+    invalid = numpy.isnan(rows)
+    if mask is not None:
+        invalid |= numpy.broadcast_to(numpy.asarray(mask)!=0,shape).reshape(rows.shape)
+    has_invalid = numpy.any(invalid)
+    if has_invalid:
+        rows = numpy.where(invalid,0.0,rows)
+
+    res = numpy.empty(rows.shape)
+    if _has_rank_filter_1d():
+        # the 1-D rank filter of scipy>=1.15 keeps a running median of the
+        # window, far cheaper than any other path, so the rows go one by one
+        from scipy import ndimage # lazy load
+        for i,row in enumerate(rows):
+            res[i] = ndimage.median_filter(row,size=size,mode=mode,cval=cval)
+    else:
+        # older versions only have the N-d filter, a selection over the
+        # sliding windows is several times faster
+        _median_windows(res,rows,size,mode,cval)
+    if has_invalid:
+        # only the windows that contain an invalid pixel have to be redone
+        _median_invalid_windows(res,rows,invalid,size,mode,cval)
+    return res.reshape(shape)
+
+
+_MEDIAN_CHUNK_SIZE = 2**22
+
+
+@cache
+def _has_rank_filter_1d()->bool:
+    import scipy # lazy load
+    return tuple(int(part) for part in re.findall(r"\d+",scipy.__version__)[:2])>=(1,15)
+
+
+def _pad_windows(rows:numpy.ndarray,size:int,mode:str,cval)->numpy.ndarray:
+    # pad like `ndimage` ("reflect" is numpy's "symmetric"), so that the
+    # window of pixel `i` is `padded[i:i+size]`
+    pad_width = ((0,0),(size // 2,size - 1 - size // 2))
+    if mode=="reflect":
+        return numpy.pad(rows,pad_width,mode="symmetric")
+    return numpy.pad(rows,pad_width,mode="constant",constant_values=cval)
+
+
+def _median_windows(res:numpy.ndarray
+                    ,rows:numpy.ndarray
+                    ,size:int
+                    ,mode:str
+                    ,cval:float):
+    # element of rank `size//2` of every window, selected a bounded number
+    # of windows at a time
+    windows = sliding_window_view(_pad_windows(rows,size,mode,cval),size,axis=-1)
+    row_step = max(1,_MEDIAN_CHUNK_SIZE // (size * rows.shape[-1]))
+    column_step = max(1,_MEDIAN_CHUNK_SIZE // size)
+    for r in range(0,len(rows),row_step):
+        for c in range(0,rows.shape[-1],column_step):
+            block = windows[r:r + row_step,c:c + column_step]
+            res[r:r + row_step,c:c + column_step] = numpy.partition(block,size // 2,axis=-1)[...,size // 2]
+
+
+def _median_invalid_windows(res:numpy.ndarray
+                            ,rows:numpy.ndarray
+                            ,invalid:numpy.ndarray
+                            ,size:int
+                            ,mode:str
+                            ,cval:float):
+    padded = _pad_windows(rows,size,mode,cval)
+    padded_invalid = _pad_windows(invalid,size,mode,False)
+
+    counts = numpy.cumsum(padded_invalid,axis=-1)
+    counts = numpy.concatenate((numpy.zeros((len(rows),1),dtype=counts.dtype),counts),axis=-1)
+    invalid_num = counts[:,size:size + rows.shape[-1]] - counts[:,:rows.shape[-1]]
+    row_index,column_index = numpy.nonzero(invalid_num)
 
-def median_filter(flux:numpy.ndarray,size:int)->numpy.ndarray:
-    return signal.medfilt(flux,size)
\ No newline at end of file
+    # windows are gathered and sorted a bounded number at a time
+    step = max(1,_MEDIAN_CHUNK_SIZE // size)
+    offsets = numpy.arange(size)
+    for start in range(0,len(row_index),step):
+        r = row_index[start:start + step,None]
+        c = column_index[start:start + step,None] + offsets
+        windows = numpy.where(padded_invalid[r,c],numpy.inf,padded[r,c])
+        windows.sort(axis=-1)
+        valid_num = size - invalid_num[r[:,0],c[:,0]]
+        median = numpy.take_along_axis(windows,(valid_num // 2)[:,None],axis=-1)[:,0]
+        res[r[:,0],c[:,0]] = numpy.where(valid_num>0,median,numpy.nan)
@@ -0,0 +1,187 @@
+# !/usr/bin/env python3
+# Copyright (C) 2025 YunyuG
+
+from __future__ import annotations
+
+import json
+import numpy
+
+from pathlib import Path
+from typing import Iterable,Iterator
+
+from .io import FitsData,SpectrumBatch,Header,read_fits_many,_chunked
+
+__all__ = ["SpectrumStore"]
+
+# A store is a directory of flat binary columns plus a `meta.json` describing
+# their dtypes and shapes, so every column can be opened with `numpy.memmap`:
+#
+#   grid.npy                common wavelength grid (M,)
+#   flux.bin,ivar.bin       flux and inverse variance aligned to the common grid (N,M)
+#   andmask.bin,orimask.bin masks aligned to the common grid (N,M)
+#   offsets.npy             row `i` of the native columns is `offsets[i]:offsets[i+1]`
+#   native_*.bin            native wavelengths, fluxes, inverse variances and
+#                           masks, all rows concatenated
+#   header.npy              structured header table, one row per spectrum
+
+_STORE_VERSION = 1
+_ALIGNED = {
+    "flux":"float32"
+    ,"ivar":"float32"
+    ,"andmask":"int32"
+    ,"orimask":"int32"
+}
+_NATIVE = {
+    "native_wavelength":"float64"
+    ,"native_flux":"float32"
+    ,"native_ivar":"float32"
+    ,"native_andmask":"int32"
+    ,"native_orimask":"int32"
+}
+_COLUMNS = {**_ALIGNED,**_NATIVE}
+
+
+class SpectrumStore:
+    def __init__(self,path:str):
+        self.path = Path(path)
+        with open(self.path / "meta.json","r",encoding="utf-8") as file:
+            self.meta = json.load(file)
+        if self.meta.get("version")!=_STORE_VERSION:
+            raise ValueError(f"unsupported store version {self.meta.get('version')}")
+
+        size = self.meta["size"]
+        pixel_total = self.meta["pixel_total"]
+        self.wavelength = numpy.load(self.path / "grid.npy")
+        self.offsets = numpy.load(self.path / "offsets.npy")
+        self.header = numpy.load(self.path / "header.npy")
+        for name in _ALIGNED:
+            setattr(self,name,self._memmap(name,(size,len(self.wavelength))))
+        for name in _NATIVE:
+            setattr(self,name,self._memmap(name,(pixel_total,)))
+        self._rows = None
+
+    def _memmap(self,name:str,shape:tuple)->numpy.ndarray:
+        if 0 in shape:
+            return numpy.empty(shape,dtype=_COLUMNS[name])
+        return numpy.memmap(self.path / f"{name}.bin",dtype=_COLUMNS[name]
+                            ,mode="r",shape=shape)
+
+    @classmethod
+    def open(cls,path:str)->SpectrumStore:
+        return cls(path)
+
+    @classmethod
+    def build(cls,path:str
+              ,paths_or_glob:str|Iterable[str]
+              ,wavelength_grid:numpy.ndarray = None
+              ,workers:int = None
+              ,executor:str = "process"
+              ,chunk_size:int = 256)->tuple[SpectrumStore,dict]:
+        """Convert a set of LAMOST FITS files into a store at `path`.
+
+        Fluxes, inverse variances and masks are aligned to `wavelength_grid`
+        (default `numpy.arange(3700,9100,2)`) and the native arrays are kept
+        as well. Returns `(store,failed)`, where
+        `failed` maps every unreadable file to its exception.
+        """
+        path = Path(path)
+        path.mkdir(parents=True,exist_ok=True)
+        (path / "meta.json").unlink(missing_ok=True)
+        if wavelength_grid is None:
+            wavelength_grid = numpy.arange(3700,9100,2)
+        wavelength_grid = numpy.asarray(wavelength_grid,dtype=float)
+
+        spectra,failed = read_fits_many(paths_or_glob,workers=workers
+                                        ,executor=executor)
+        files = {name:open(path / f"{name}.bin","wb") for name in _COLUMNS}
+        offsets = [0]
+        headers = []
+        try:
+            for chunk in _chunked(spectra,chunk_size):
+                aligned = _align_chunk(chunk,wavelength_grid)
+                for name in _ALIGNED:
+                    files[name].write(_as_bytes(getattr(aligned,name),name))
+                for fits_data in chunk:
+                    for name in _NATIVE:
+                        files[name].write(_as_bytes(getattr(fits_data,name[len("native_"):]),name))
+                    offsets.append(offsets[-1] + len(fits_data.flux))
+                    headers.append(fits_data.header)
+        finally:
+            for file in files.values():
+                file.close()
+
+        numpy.save(path / "grid.npy",wavelength_grid)
+        numpy.save(path / "offsets.npy",numpy.asarray(offsets,dtype=numpy.int64))
+        header = Header.to_table(headers) if headers else numpy.empty(0,dtype=[("obsid",numpy.int64)])
+        numpy.save(path / "header.npy",header)
+        meta = {"version":_STORE_VERSION
+                ,"size":len(headers)
+                ,"pixel_total":offsets[-1]
+                ,"columns":_COLUMNS}
+        # `meta.json` is written last, a store without it is incomplete
+        with open(path / "meta.json","w",encoding="utf-8") as file:
+            json.dump(meta,file,indent=2)
+        return cls(path),failed
+
+    def __len__(self):
+        return self.meta["size"]
+
+    def __iter__(self)->Iterator[FitsData]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self,key)->FitsData|SpectrumBatch:
+        # an integer gives the native spectrum, anything else a batch on the common grid
+        if isinstance(key,(int,numpy.integer)):
+            return self._native(int(key))
+        header = self.header[key]
+        return SpectrumBatch(self.wavelength,numpy.asarray(self.flux[key],dtype=float),header
+                             ,ivar=numpy.asarray(self.ivar[key],dtype=float)
+                             ,andmask=numpy.asarray(self.andmask[key],dtype=int)
+                             ,orimask=numpy.asarray(self.orimask[key],dtype=int))
+
+    def _native(self,row:int)->FitsData:
+        if row<0:
+            row += len(self)
+        start,end = self.offsets[row],self.offsets[row+1]
+        return FitsData(numpy.asarray(self.native_wavelength[start:end],dtype=float)
+                        ,numpy.asarray(self.native_flux[start:end],dtype=float)
+                        ,Header.from_row(self.header[row])
+                        ,andmask=numpy.asarray(self.native_andmask[start:end],dtype=int)
+                        ,orimask=numpy.asarray(self.native_orimask[start:end],dtype=int)
+                        ,ivar=numpy.asarray(self.native_ivar[start:end],dtype=float))
+
+    @property
+    def obsids(self)->numpy.ndarray:
+        return self.header["obsid"]
+
+    def row_of(self,obsid:int)->int:
+        if self._rows is None:
+            self._rows = {int(value):i for i,value in enumerate(self.obsids)}
+        return self._rows[int(obsid)]
+
+    def get(self,obsid:int)->FitsData:
+        return self._native(self.row_of(obsid))
+
+    def select(self,obsids:Iterable[int])->SpectrumBatch:
+        rows = numpy.asarray([self.row_of(obsid) for obsid in obsids],dtype=numpy.int64)
+        return self[rows]
+
+    def iter_batches(self,batch_size:int = 1024)->Iterator[SpectrumBatch]:
+        for start in range(0,len(self),batch_size):
+            yield self[start:start+batch_size]
+
+    def __repr__(self):
+        return f"SpectrumStore(path={str(self.path)!r},size={len(self)})"
+
+
+def _as_bytes(array:numpy.ndarray,name:str)->bytes:
+    return numpy.asarray(array,dtype=_COLUMNS[name]).tobytes()
+
+
+def _align_chunk(chunk:list[FitsData],wavelength_grid:numpy.ndarray)->SpectrumBatch:
+    # flux, ivar and masks on the common grid
+    if len({len(fits_data.flux) for fits_data in chunk})==1:
+        # same pixel number, one batched resampling plan for the chunk
+        return SpectrumBatch.from_fits_data(chunk).align(wavelength_grid)
+    return SpectrumBatch.from_fits_data([fits_data.align(wavelength_grid) for fits_data in chunk])
@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# `mock_server` and `synthetic` live in benchmarks/
+sys.path.insert(0,str(Path(__file__).resolve().parents[1] / "benchmarks"))
@@ -0,0 +1,77 @@
+import csv
+
+import numpy
+import pytest
+
+from synthetic import write_files
+from cmost import read_fits
+from cmost.cli import main
+from cmost.lick import compute_LickLineIndices_batch
+
+
+@pytest.fixture(scope="module")
+def spectra_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("spectra")
+    write_files(str(directory),4)
+    return directory
+
+
+def _read_csv(path)->list[dict]:
+    with open(path,newline="",encoding="utf-8") as file:
+        return list(csv.DictReader(file))
+
+
+def test_headers(spectra_dir,tmp_path):
+    output = tmp_path / "headers.csv"
+    assert main(["headers",str(spectra_dir),"--keys","obsid","z","--workers","1"
+                 ,"--output",str(output)])==0
+    rows = _read_csv(output)
+    assert [int(row["obsid"]) for row in rows]==[1000,1001,1002,1003]
+    assert [float(row["z"]) for row in rows]==[0.0,0.001,0.002,0.003]
+
+
+def test_preprocess(spectra_dir,tmp_path):
+    output = tmp_path / "flux.npy"
+    assert main(["preprocess",str(spectra_dir / "*.fits*"),"--align","3800","8000","2"
+                 ,"--median-filter","7","--normalize","20","--workers","1","--output",str(output)])==0
+    flux = numpy.load(output)
+    grid = numpy.arange(3800,8000,2)
+    paths = sorted(str(path) for path in spectra_dir.iterdir())
+    for row,path in zip(flux,paths):
+        expected = read_fits(path).align(grid).median_filter(7).normalize_continuum(window_num=20)
+        assert numpy.allclose(row,expected.flux)
+
+
+def test_preprocess_checks_normalize_windows(spectra_dir,tmp_path,capsys):
+    # 1400 pixels, and the default of 10 windows is fine
+    assert main(["preprocess",str(spectra_dir),"--align","3800","8000","3","--normalize"
+                 ,"--workers","1","--output",str(tmp_path / "flux.npy")])==0
+    with pytest.raises(SystemExit,match="does not divide the 1400 pixels"):
+        main(["preprocess",str(spectra_dir),"--align","3800","8000","3","--normalize","15"
+              ,"--output",str(tmp_path / "flux.npy")])
+    with pytest.raises(SystemExit,match="odd"):
+        main(["preprocess",str(spectra_dir),"--median-filter","8","--output",str(tmp_path / "flux.npy")])
+
+
+def test_lick(spectra_dir,tmp_path):
+    output = tmp_path / "lick.csv"
+    assert main(["lick",str(spectra_dir),"--align","3800","8000","2","--errors","--workers","1"
+                 ,"--keys","obsid","z","--output",str(output)])==0
+    rows = _read_csv(output)
+    spectra = [read_fits(path).align(numpy.arange(3800,8000,2))
+               for path in sorted(str(path) for path in spectra_dir.iterdir())]
+    values,errors = compute_LickLineIndices_batch(spectra,as_table=True,return_errors=True)
+    assert [int(row["obsid"]) for row in rows]==[1000,1001,1002,1003]
+    for i,row in enumerate(rows):
+        for name in values.dtype.names:
+            assert numpy.isclose(float(row[name]),values[name][i])
+            assert numpy.isclose(float(row[f"{name}_err"]),errors[name][i])
+
+
+def test_lick_reports_failures(spectra_dir,tmp_path,capsys):
+    broken = tmp_path / "broken.fits"
+    broken.write_bytes(b"not a fits file")
+    output = tmp_path / "lick.csv"
+    assert main(["lick",str(spectra_dir),str(broken),"--workers","1","--output",str(output)])==1
+    assert "1 failed" in capsys.readouterr().err
+    assert len(_read_csv(output))==4
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+
+import numpy
+import pytest
+
+from synthetic import write_fits
+from mock_server import MockLamostServer,serve_in_thread
+from cmost import download,read_fits
+from cmost.download import AdaptiveLimiter,DownloadManifest,download_fits,iter_download_fits,iter_parse_fits
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download,"backoff_delay",lambda retry:0.0)
+
+
+def run(coroutine,timeout:float = 30):
+    # a hang fails the test instead of blocking the suite
+    return asyncio.run(asyncio.wait_for(coroutine,timeout))
+
+
+async def collect(server:MockLamostServer,obsids,save_dir,**options)->list[tuple]:
+    options.setdefault("callbacks",[])
+    return [result async for result in iter_download_fits(obsids,"9","2.0",save_dir=str(save_dir)
+                                                          ,base_url=server.base_url,**options)]
+
+
+def bad_catalog():
+    yield "1"
+    yield "2"
+    raise RuntimeError("bad catalog row")
+
+
+def test_download_all(tmp_path):
+    async def main():
+        async with MockLamostServer() as server:
+            return await collect(server,[str(i) for i in range(20)],tmp_path)
+    results = run(main())
+    assert sorted(obsid for obsid,_,_ in results)==sorted(str(i) for i in range(20))
+    assert {status for _,_,status in results}=={"done"}
+    assert len(list(tmp_path.glob("spec-*.fits")))==20
+
+
+def test_503_are_retried_and_counted(tmp_path):
+    metrics = []
+    def callback(event,info,run_metrics):
+        metrics.append(run_metrics)
+
+    async def main():
+        async with MockLamostServer(error_rate=0.3) as server:
+            results = await collect(server,[str(i) for i in range(40)],tmp_path
+                                    ,max_retrys=20,callbacks=[callback])
+            return results,server.requests
+    results,requests = run(main())
+    summary = metrics[0].summary()
+    assert {status for _,_,status in results}=={"done"}
+    assert summary["http_status"][503]>0
+    assert summary["retries"]==summary["http_status"][503]
+    assert summary["requests"]==requests==40 + summary["retries"]
+    assert summary["error_rate"]==pytest.approx(summary["http_status"][503] / requests)
+    assert summary["results"]=={"done":40}
+
+
+def test_failed_after_retries(tmp_path):
+    async def main():
+        async with MockLamostServer(error_rate=1.0) as server:
+            return await collect(server,["1","2"],tmp_path,max_retrys=2,manifest_path=str(tmp_path / "m.jsonl"))
+    assert {status for _,_,status in run(main())}=={"failed"}
+
+
+def test_limiter_backs_off_on_503(tmp_path):
+    limiter = AdaptiveLimiter(initial=8,maximum=8)
+    in_flight = []
+    def callback(event,info,metrics):
+        if event=="request":
+            in_flight.append(limiter.in_flight)
+
+    async def main():
+        async with MockLamostServer(error_rate=0.5,latency=0.005) as server:
+            return await collect(server,[str(i) for i in range(40)],tmp_path
+                                 ,max_retrys=30,limiter=limiter,callbacks=[callback])
+    results = run(main())
+    assert {status for _,_,status in results}=={"done"}
+    assert max(in_flight)<=8
+    assert limiter.limit<8
+    assert limiter.in_flight==0
+
+
+def test_limiter_aimd():
+    limiter = AdaptiveLimiter(initial=4,minimum=1,maximum=6)
+    for _ in range(100):
+        limiter.feedback(0.01,True)
+    assert limiter.limit==6
+    limiter.feedback(0.01,False)
+    assert limiter.limit==3
+    # the failures of the same round count once
+    limiter.feedback(0.01,False)
+    assert limiter.limit==3
+    for _ in range(10):
+        limiter.feedback(0.01,False)
+    assert limiter.limit==1
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(initial=10,maximum=5)
+
+
+def test_failing_obsids_raise(tmp_path):
+    async def main():
+        async with MockLamostServer() as server:
+            await collect(server,bad_catalog(),tmp_path)
+    with pytest.raises(RuntimeError,match="bad catalog row"):
+        run(main())
+
+
+def test_failing_obsids_raise_sync(tmp_path):
+    with serve_in_thread(MockLamostServer()) as base_url:
+        with pytest.raises(RuntimeError,match="bad catalog row"):
+            download_fits(bad_catalog(),"9","2.0",save_dir=str(tmp_path),base_url=base_url,callbacks=[])
+
+
+def test_failing_callback_is_logged(tmp_path,caplog):
+    def callback(event,info,metrics):
+        if event=="done":
+            raise ValueError("callback error")
+
+    async def main():
+        async with MockLamostServer() as server:
+            return await collect(server,[str(i) for i in range(10)],tmp_path,callbacks=[callback])
+    with caplog.at_level(logging.ERROR,logger="cmost.download"):
+        results = run(main())
+    assert len(results)==10
+    assert "callback error" in caplog.text
+
+
+def test_broken_responses_leave_no_part_files(tmp_path):
+    async def main():
+        async with MockLamostServer(broken_rate=1.0) as server:
+            return await collect(server,["1","2"],tmp_path,max_retrys=2)
+    assert {status for _,_,status in run(main())}=={"failed"}
+    assert list(tmp_path.iterdir())==[]
+
+
+def test_resume_from_manifest(tmp_path):
+    manifest_path = tmp_path / "manifest.jsonl"
+    (tmp_path / "spec-1.fits").write_bytes(b"already downloaded")
+    with DownloadManifest(manifest_path) as manifest:
+        manifest.mark("1","done",str(tmp_path / "spec-1.fits"))
+        manifest.mark("2","failed",error="503")
+        manifest.mark("3","pending")
+        # done, but the file is gone
+        manifest.mark("4","done",str(tmp_path / "spec-4.fits"))
+
+    async def main():
+        async with MockLamostServer() as server:
+            results = await collect(server,["1","2","3","4","5"],tmp_path,manifest_path=str(manifest_path))
+            return results,server.requests
+    results,requests = run(main())
+    assert {obsid:status for obsid,_,status in results}=={"1":"skipped","2":"done","3":"done"
+                                                          ,"4":"done","5":"done"}
+    assert requests==4
+    assert (tmp_path / "spec-1.fits").read_bytes()==b"already downloaded"
+    with DownloadManifest(manifest_path) as manifest:
+        assert manifest.obsids("done")==["1","2","3","4","5"]
+
+
+def flux_sum(fits_data)->float:
+    return float(fits_data.flux.sum())
+
+
+@pytest.mark.parametrize("executor",["thread","process"])
+def test_iter_parse(tmp_path,executor):
+    expected = read_fits(write_fits(str(tmp_path / "expected.fits"),1000))
+    obsids = [str(i) for i in range(8)]
+
+    async def main(transform,sem_number):
+        async with MockLamostServer(error_rate=0.2) as server:
+            return [result async for result in iter_parse_fits(obsids,"9","2.0",sem_number=sem_number
+                                                                ,max_retrys=20,transform=transform
+                                                                ,workers=2,executor=executor
+                                                                ,base_url=server.base_url,callbacks=[])]
+    # one download at a time: results come in input order
+    results = run(main(None,1))
+    assert [obsid for obsid,_,_ in results]==obsids
+    assert {status for _,_,status in results}=={"done"}
+    for _,fits_data,_ in results:
+        assert numpy.array_equal(fits_data.flux,expected.flux)
+        assert fits_data.header["obsid"]==1000
+
+    results = run(main(flux_sum,4))
+    assert sorted(obsid for obsid,_,_ in results)==obsids
+    assert {result for _,result,_ in results}=={flux_sum(expected)}
+    assert list(tmp_path.iterdir())==[tmp_path / "expected.fits"]
@@ -0,0 +1,117 @@
+import numpy
+import pytest
+
+from scipy.ndimage import median_filter
+
+from synthetic import write_files
+from cmost import read_fits
+from cmost.io import SpectrumBatch
+from cmost import fitting
+from cmost.fitting import (SwFitting5d,fit_SwFitting5d_batch,normalize_continuum,ContinuumCache
+                           ,compute_Ulimit,compute_Llimit,compute_SNR,_clipped_polyfit)
+
+
+@pytest.fixture(scope="module")
+def spectra(tmp_path_factory):
+    return [read_fits(path) for path in write_files(str(tmp_path_factory.mktemp("spectra")),4)]
+
+
+def _reference_clipped_polyfit(ws,fs,max_iterate_nums):
+    # the sigma-clipped `numpy.polyfit` loop of the original `SwFitting5d.band`
+    index = numpy.argsort(ws)
+    ws,fs = ws[index],fs[index]
+    for _ in range(max_iterate_nums):
+        F = numpy.polyfit(ws,fs,5)
+        fn = fs / numpy.polyval(F,ws)
+        a,b = numpy.mean(fn),numpy.std(fn)
+        index = numpy.where((fn >= a - 3 * b) & (fn <= a + 3 * b))[0]
+        ws,fs = ws[index],fs[index]
+        if index.shape[0]==0:
+            break
+    return F
+
+
+def _reference_sw5d(wavelength,flux,window_num = 10,mean_filter_size = 50,c = 5,max_iterate_nums = 10):
+    # the original per-window point selection
+    ws,fs = [],[]
+    for w,f in zip(numpy.reshape(wavelength,(window_num,-1)),numpy.reshape(flux,(window_num,-1))):
+        snr = compute_SNR(f,median_filter(f,size=mean_filter_size))
+        index = numpy.argsort(f)
+        start,end = int(compute_Llimit(snr,c) * 1e-2 * len(f)),int(compute_Ulimit(snr,c) * 1e-2 * len(f))
+        ws.append(w[index][start:end+1])
+        fs.append(f[index][start:end+1])
+    return _reference_clipped_polyfit(numpy.concatenate(ws),numpy.concatenate(fs),max_iterate_nums)
+
+
+def _assert_same_fit(coef,expected,wavelength,rtol = 1e-8):
+    # `numpy.polyfit` in raw wavelengths loses a few digits, most where the fit extrapolates
+    assert numpy.allclose(numpy.polyval(coef,wavelength),numpy.polyval(expected,wavelength),rtol=rtol)
+    assert numpy.allclose(coef,expected,rtol=100 * rtol,atol=0)
+
+
+def test_sw5d_matches_reference(spectra):
+    for fits_data in spectra:
+        expected = _reference_sw5d(fits_data.wavelength,fits_data.flux)
+        _assert_same_fit(SwFitting5d(fits_data).coef,expected,fits_data.wavelength)
+        _assert_same_fit(SwFitting5d(fits_data,window_num=20,mean_filter_size=31).coef
+                         ,_reference_sw5d(fits_data.wavelength,fits_data.flux,20,31)
+                         ,fits_data.wavelength)
+
+
+def test_batch_and_continuum_coef_match_reference(spectra):
+    batch = SpectrumBatch.from_fits_data(spectra)
+    assert batch.wavelength.ndim==2
+    coef = fit_SwFitting5d_batch(batch,chunk_size=3)
+    normalized = normalize_continuum(batch)
+    for i,fits_data in enumerate(spectra):
+        expected = _reference_sw5d(fits_data.wavelength,fits_data.flux)
+        _assert_same_fit(coef[i],expected,fits_data.wavelength)
+        _assert_same_fit(normalized.continuum_coef[i],expected,fits_data.wavelength)
+        _assert_same_fit(normalize_continuum(fits_data).continuum_coef,expected,fits_data.wavelength)
+
+
+def test_clipped_polyfit_masks_and_outliers():
+    rng = numpy.random.default_rng(0)
+    wavelength = numpy.linspace(3800,9000,1000)
+    x = (wavelength - 6400) / 2600
+    flux = 100 * (1 + 0.3 * x - 0.2 * x ** 3) + rng.normal(0,1,(3,1000))
+    flux[:,::97] += 50 # outliers the clipping removes
+    mask = rng.random((3,1000))<0.6
+    mask[2,:500] = False # a half spectrum without selected points
+
+    clipped = mask.copy()
+    coef = _clipped_polyfit(wavelength,flux,clipped,max_iterate_nums=10)
+    assert numpy.all(clipped.sum(axis=-1)<mask.sum(axis=-1))
+    assert not numpy.any(clipped[:,::97])
+    for i in range(3):
+        expected = _reference_clipped_polyfit(wavelength[mask[i]],flux[i][mask[i]],10)
+        _assert_same_fit(coef[i],expected,wavelength,rtol=1e-6)
+
+
+def test_continuum_cache(spectra,monkeypatch,tmp_path):
+    fitted = []
+    def counting(**options):
+        fitted.append(len(options["flux"]))
+        return fit_SwFitting5d_batch(**options)
+    monkeypatch.setitem(fitting._CONTINUUM_METHODS,"sw5d",counting)
+
+    batch = SpectrumBatch.from_fits_data(spectra)
+    cache = ContinuumCache(tmp_path)
+    first = normalize_continuum(batch,cache=cache)
+    second = normalize_continuum(batch,cache=cache)
+    assert fitted==[len(spectra)]
+    assert numpy.array_equal(first.continuum_coef,second.continuum_coef)
+    assert numpy.array_equal(first.flux,second.flux)
+
+    # a changed flux changes the digest, so only that spectrum is fitted again
+    batch.flux[1] *= 1.01
+    normalize_continuum(batch,cache=cache)
+    assert fitted==[len(spectra),1]
+    # so do different parameters
+    normalize_continuum(spectra[0],cache=cache,mean_filter_size=31)
+    assert fitted==[len(spectra),1,1]
+
+    # a new cache on the same directory finds the saved fits
+    normalize_continuum(batch,cache=ContinuumCache(tmp_path))
+    assert fitted==[len(spectra),1,1]
+    assert len(list(tmp_path.glob("*.npy")))==len(spectra) + 2
@@ -0,0 +1,19 @@
+import os
+
+from pathlib import Path
+
+import pytest
+
+from import_time import CHECKS,measure
+
+SRC = str(Path(__file__).resolve().parents[1] / "src")
+
+
+@pytest.mark.parametrize("statement,factor,forbidden",CHECKS)
+def test_import_time(statement,factor,forbidden,monkeypatch):
+    monkeypatch.setenv("PYTHONPATH",os.pathsep.join(filter(None,(SRC,os.environ.get("PYTHONPATH")))))
+    setup = "" if "numpy" in forbidden else "import numpy"
+    seconds,modules = measure(statement,3,setup)
+    # the benchmark budget is 0.25 s, doubled against noisy test machines
+    assert seconds<=0.5 * factor
+    assert not modules.intersection(forbidden)
@@ -0,0 +1,76 @@
+import json
+
+import numpy
+import pytest
+
+from synthetic import make_arrays,make_batch
+from cmost.index import SpectrumIndex
+
+
+@pytest.fixture(scope="module")
+def arrays():
+    return make_arrays(400,npix=800,seed=3)
+
+
+@pytest.fixture(scope="module")
+def index(arrays):
+    return SpectrumIndex.build(arrays["flux"],arrays["header"]["obsid"],dim=16,n_lists=16
+                               ,wavelength=arrays["wavelength"])
+
+
+def test_duplicates_are_found(arrays,index):
+    # an indexed spectrum is its own nearest neighbour, scaling included
+    for flux in (arrays["flux"],3 * arrays["flux"]):
+        obsids,distances = index.search(flux,k=5,n_probe=2)
+        assert numpy.array_equal(obsids[:,0],arrays["header"]["obsid"])
+        assert numpy.allclose(distances[:,0],0,atol=1e-3)
+        assert numpy.all(numpy.diff(distances,axis=1)>=0)
+
+
+def test_exhaustive_search_matches_brute_force(arrays,index):
+    queries = arrays["flux"][:50] + numpy.random.default_rng(0).normal(0,0.05,(50,arrays["flux"].shape[1]))
+    obsids,distances = index.search(queries,k=10,n_probe=index.n_lists)
+    projected = index.project(queries)
+    indexed = index.project(arrays["flux"])
+    expected = numpy.sqrt(((projected[:,None] - indexed[None]) ** 2).sum(axis=2))
+    order = numpy.argsort(expected,axis=1)[:,:10]
+    assert numpy.allclose(distances,numpy.take_along_axis(expected,order,axis=1),rtol=1e-3,atol=1e-4)
+    assert numpy.mean(obsids==arrays["header"]["obsid"][order])>0.99
+
+
+def test_single_query_and_missing_neighbours(arrays):
+    index = SpectrumIndex.build(arrays["flux"][:6],dim=4,n_lists=3)
+    obsids,distances = index.search(arrays["flux"][2],k=10,n_probe=1)
+    assert obsids.shape==(10,) and obsids[0]==2
+    missing = obsids==-1
+    assert missing.any() and numpy.all(numpy.isinf(distances[missing]))
+    with pytest.raises(ValueError,match="pixels"):
+        index.search(arrays["flux"][:,:10])
+
+
+@pytest.mark.parametrize("mmap",[True,False])
+def test_save_open(arrays,index,tmp_path,mmap):
+    index.save(tmp_path / "index")
+    opened = SpectrumIndex.open(tmp_path / "index",mmap=mmap)
+    assert isinstance(opened.vectors,numpy.memmap)==mmap
+    assert isinstance(opened.obsids,numpy.memmap)==mmap
+    assert (len(opened),opened.dim,opened.n_lists)==(len(index),index.dim,index.n_lists)
+    assert numpy.array_equal(opened.wavelength,arrays["wavelength"])
+    queries = arrays["flux"][::7]
+    for expected,result in zip(index.search(queries,k=8),opened.search(queries,k=8)):
+        assert numpy.array_equal(expected,result)
+
+
+def test_open_rejects_unknown_version(index,tmp_path):
+    index.save(tmp_path / "index")
+    meta = json.loads((tmp_path / "index" / "meta.json").read_text())
+    meta["version"] = 0
+    (tmp_path / "index" / "meta.json").write_text(json.dumps(meta))
+    with pytest.raises(ValueError,match="version"):
+        SpectrumIndex.open(tmp_path / "index")
+
+
+def test_from_batch():
+    batch = make_batch(50,npix=400)
+    index = SpectrumIndex.from_batch(batch,dim=8,projection="random")
+    assert numpy.array_equal(index.search(batch,k=1)[0][:,0],batch.header["obsid"])
@@ -0,0 +1,239 @@
+import os
+import bz2
+import gzip
+import zipfile
+import tracemalloc
+
+import numpy
+import pytest
+
+from astropy.io import fits
+
+from synthetic import write_files
+from cmost import read_fits,read_fits_many,read_header,read_headers
+from cmost.io import HEADER_SCHEMA,Header,HeaderTable,SpectrumBatch
+
+
+@pytest.fixture(scope="module")
+def paths(tmp_path_factory):
+    return write_files(str(tmp_path_factory.mktemp("spectra")),6)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"),reason="needs /proc")
+def test_lazy_closes_files(paths):
+    before = len(os.listdir("/proc/self/fd"))
+    spectra = [read_fits(path,lazy=True) for path in paths * 50]
+    for fits_data in spectra:
+        fits_data.flux
+    assert len(os.listdir("/proc/self/fd")) <= before + 1
+    assert all(fits_data.is_lazy for fits_data in spectra)
+
+
+def test_lazy_matches_eager(paths):
+    for path in paths:
+        lazy,eager = read_fits(path,lazy=True),read_fits(path)
+        assert "exists_bad_points" not in lazy.header
+        assert lazy["exists_bad_points"]==eager["exists_bad_points"]
+        for name in ("flux","ivar","wavelength","andmask","orimask"):
+            assert (getattr(lazy,name)==getattr(eager,name)).all()
+        assert not lazy.is_lazy
+
+
+def test_batch_matches_spectra(paths):
+    spectra = [read_fits(path) for path in paths]
+    batch = SpectrumBatch.from_fits_data(spectra)
+    grid = numpy.arange(3800,8000,2.0)
+    rest = numpy.arange(3700,8000,1.5)
+    methods = [lambda spectra:spectra.minmax()
+               ,lambda spectra:spectra.minmax(masked=True)
+               ,lambda spectra:spectra.align(grid)
+               ,lambda spectra:spectra.align(grid,kind="flux_conserving")
+               ,lambda spectra:spectra.remove_redshift()
+               ,lambda spectra:spectra.remove_redshift("flux_conserving",rest)]
+    for method in methods:
+        result = method(batch)
+        for i,fits_data in enumerate(spectra):
+            expected = method(fits_data)
+            row = result[i]
+            assert numpy.allclose(row.wavelength,expected.wavelength)
+            for name in ("flux","ivar","andmask","orimask"):
+                assert numpy.allclose(getattr(row,name),getattr(expected,name),equal_nan=True),name
+
+
+@pytest.mark.parametrize("workers",[1,2])
+def test_read_fits_many_all_failed(tmp_path,workers):
+    paths = [str(tmp_path / f"missing-{i}.fits") for i in range(3)]
+    batch,failed = read_fits_many(paths,workers=workers,executor="thread",as_batch=True)
+    assert len(batch)==0
+    assert sorted(failed)==paths
+
+
+def test_read_fits_many_keeps_order(paths,tmp_path):
+    missing = str(tmp_path / "missing.fits")
+    batch,failed = read_fits_many(paths[:3] + [missing] + paths[3:],workers=2,executor="thread"
+                                  ,as_batch=True,chunk_size=2)
+    assert list(failed)==[missing]
+    assert list(batch.header["obsid"])==[read_fits(path).header["obsid"] for path in paths]
+
+
+def _write_header(path):
+    header = fits.Header()
+    header["OBSID"] = 123
+    header["BIGINT"] = 2 ** 70
+    header["NEGINT"] = -5
+    header["FLT"] = 1.5e-10
+    header["QUOTE"] = "it's ''quoted''"
+    header["LEAD"] = "  spaced  "
+    header["LONGSTR"] = "it's long " * 20 + "end"
+    header["FLAG"] = False
+    header["UNDEF"] = None
+    header["EMPTY"] = ""
+    header["CPLX"] = complex(1,2)
+    header["HIERARCH ESO DET CHIP"] = "chip 1"
+    header["HIERARCH LONG KEY NAME NUM"] = 3.25
+    header["HISTORY"] = "first history"
+    header["HISTORY"] = "second history"
+    header["COMMENT"] = "a comment"
+    header.add_blank("blank")
+    for i in range(40):
+        # pushes the header into a second block
+        header[f"KEY{i}"] = i
+    fits.PrimaryHDU(header=header).writeto(path,overwrite=True)
+    return path
+
+
+def _astropy_header(path)->dict:
+    header = fits.getheader(path)
+    return {key.lower():value for key,value in header.items() if "COMMENT" not in key and key}
+
+
+@pytest.fixture(scope="module")
+def header_path(tmp_path_factory):
+    return _write_header(str(tmp_path_factory.mktemp("headers") / "header.fits"))
+
+
+def test_read_header_matches_astropy(header_path):
+    header = read_header(header_path)
+    assert header==_astropy_header(header_path)
+    assert header["longstr"].endswith("end") and header["quote"]=="it's ''quoted''"
+    assert header["undef"] is None and header["bigint"]==2 ** 70
+    assert header["eso det chip"]=="chip 1" and header["history"]=="second history"
+
+
+@pytest.mark.parametrize("suffix",[".gz",".bz2",".zip"])
+def test_read_header_compressed(header_path,tmp_path,suffix):
+    path = str(tmp_path / f"header.fits{suffix}")
+    with open(header_path,"rb") as file:
+        data = file.read()
+    if suffix==".gz":
+        with gzip.open(path,"wb") as file:
+            file.write(data)
+    elif suffix==".bz2":
+        with bz2.open(path,"wb") as file:
+            file.write(data)
+    else:
+        with zipfile.ZipFile(path,"w") as archive:
+            archive.writestr("header.fits",data)
+    assert read_header(path)==_astropy_header(path)
+
+
+def test_read_header_file_object(header_path):
+    with open(header_path,"rb") as file:
+        assert read_header(file)==_astropy_header(header_path)
+
+
+def test_read_header_rejects_urls():
+    with pytest.raises(ValueError,match="local file"):
+        read_header("https://example.org/spec.fits")
+
+
+def test_read_header_stops_at_keys(header_path,tmp_path):
+    # the second header block is cut off: only a read that stops early works
+    path = str(tmp_path / "truncated.fits")
+    with open(header_path,"rb") as file:
+        data = file.read(2880 + 100)
+    with open(path,"wb") as file:
+        file.write(data)
+    with pytest.raises(OSError):
+        read_header(path)
+    assert read_header(path,["OBSID","longstr"])=={"obsid":123,"longstr":read_header(header_path)["longstr"]}
+
+
+def test_read_headers_reports_failures(paths,tmp_path):
+    broken = tmp_path / "broken.fits"
+    broken.write_bytes(b"not a fits file")
+    missing = str(tmp_path / "missing.fits")
+    table,failed = read_headers(paths + [str(broken),missing],keys=["obsid","z"],workers=1)
+    assert sorted(failed)==sorted([str(broken),missing])
+    assert list(table["path"])==paths
+    assert list(table["obsid"])==[fits.getheader(path)["OBSID"] for path in paths]
+
+
+def _schema_header(i:int = 0)->Header:
+    values = {bool:True,numpy.int32:-i,numpy.int64:2 ** 40 + i,numpy.int8:1,float:0.5 + i}
+    header = Header([],[])
+    for key,dtype in HEADER_SCHEMA:
+        header[key] = values[dtype] if dtype in values else f"{key}-{i}"[:numpy.dtype(dtype).itemsize]
+    header["extra"] = f"not in the schema {i}"
+    return header
+
+
+def test_header_table_round_trip(paths):
+    headers = [_schema_header(i) for i in range(3)] + [read_header(path) for path in paths] + [Header([],[])]
+    table = HeaderTable.from_headers(headers)
+    assert len(table)==len(headers)
+    for header,view in zip(headers,table):
+        assert dict(view)==header
+        assert all(type(view[key]) is type(value) for key,value in header.items())
+    assert table.overflow[0]=={"extra":"not in the schema 0"}
+    assert table.overflow[-1] is None
+    assert table[-1].copy()=={} and isinstance(table[0].copy(),Header)
+
+
+@pytest.mark.parametrize("key,value",[("objname","x" * 25),("objname","näme"),("objname",b"bytes")
+                                      ,("class","trailing\x00"),("fiberid",2 ** 31),("obsid",-2 ** 63 - 1)
+                                      ,("ra",10),("ra",numpy.float64(1.5)),("simple",1),("z",None)])
+def test_header_table_overflow(key,value):
+    # values that the column would truncate or convert are kept unchanged
+    table = HeaderTable.from_headers([{key:value}])
+    assert table.overflow[0]=={key:value}
+    assert table[0][key]==value and type(table[0][key]) is type(value)
+    assert list(table[0])==[key]
+
+
+def test_header_view_writes_back():
+    table = HeaderTable.from_headers([_schema_header(0),Header(["obsid"],[1])])
+    view = table[1]
+    view["objname"] = "M31"
+    view["extra"] = 1
+    assert table.records["objname"][1]==b"M31" and table.overflow[1]=={"extra":1}
+    assert dict(table[1])=={"obsid":1,"objname":"M31","extra":1}
+    # a value that does not fit moves the card to the overflow and back
+    view["objname"] = "x" * 25
+    assert table.overflow[1]["objname"]=="x" * 25 and dict(table[1])["objname"]=="x" * 25
+    view["objname"] = "M32"
+    assert "objname" not in table.overflow[1] and table[1]["objname"]=="M32"
+    del view["objname"],view["extra"]
+    assert dict(table[1])=={"obsid":1} and len(view)==1
+    with pytest.raises(KeyError):
+        del view["objname"]
+    with pytest.raises(KeyError):
+        view["dec"]
+    # the other row is untouched
+    assert dict(table[0])==_schema_header(0)
+
+
+def test_header_table_memory():
+    def allocated(build)->int:
+        tracemalloc.start()
+        try:
+            result = build()  # kept alive while measuring
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    n = 2000
+    headers = allocated(lambda:[_schema_header(i) for i in range(n)])
+    source = [_schema_header(i) for i in range(n)]
+    table = allocated(lambda:HeaderTable.from_headers(source))
+    assert table<headers / 2
@@ -0,0 +1,66 @@
+import numpy
+import pytest
+
+from synthetic import write_files
+from cmost import read_fits
+from cmost.lick import (compute_LickLineIndices,compute_LickLineIndices_batch,LickLineIndexPlan,default_LickLineIndex_table
+                        ,compute_FI_lambda_FC_lambda,compute_EW,compute_Mag)
+
+
+@pytest.fixture(scope="module")
+def spectra(tmp_path_factory):
+    return [read_fits(path) for path in write_files(str(tmp_path_factory.mktemp("spectra")),4)]
+
+
+def _reference(wavelength,flux)->list[float]:
+    # the per-index interp1d + trapezoid path the plan replaces
+    res = []
+    for lick_line_index in default_LickLineIndex_table():
+        bands = compute_FI_lambda_FC_lambda(wavelength,flux,lick_line_index)
+        res.append(compute_EW(*bands) if lick_line_index.units==0 else compute_Mag(*bands))
+    return res
+
+
+def test_plan_matches_reference(spectra):
+    # the LAMOST log-wavelength grid, and the same grid with pixels dropped
+    for fits_data in spectra[:2]:
+        keep = numpy.ones(len(fits_data.wavelength),dtype=bool)
+        keep[::7] = False
+        for wavelength,flux in ((fits_data.wavelength,fits_data.flux)
+                                ,(fits_data.wavelength[keep],fits_data.flux[keep])):
+            values = LickLineIndexPlan(wavelength)(flux)
+            assert numpy.allclose(values,_reference(wavelength,flux),rtol=0,atol=1e-10)
+
+
+def test_analytic_errors_match_montecarlo(spectra):
+    fits_data = spectra[0]
+    plan = LickLineIndexPlan(fits_data.wavelength)
+    analytic = plan.errors(fits_data.flux,fits_data.ivar)
+    montecarlo = plan.errors(fits_data.flux,fits_data.ivar,mode="montecarlo",n_realizations=4000,seed=1)
+    assert numpy.all(analytic>0)
+    assert numpy.allclose(montecarlo,analytic,rtol=0.1)
+
+
+def test_explicit_ivar_on_grouped_spectra(tmp_path):
+    spectra = [read_fits(path) for path in write_files(str(tmp_path),4)]
+    ivar = numpy.stack([fits_data.ivar for fits_data in spectra])
+    _,own = compute_LickLineIndices_batch(spectra,return_errors=True)
+    _,same = compute_LickLineIndices_batch(spectra,return_errors=True,ivar=ivar)
+    _,scaled = compute_LickLineIndices_batch(spectra,return_errors=True,ivar=4 * ivar)
+    assert numpy.allclose(own,same,equal_nan=True)
+    assert numpy.allclose(own / 2,scaled,equal_nan=True)
+
+
+@pytest.mark.parametrize("workers,executor",[(1,"process"),(2,"thread"),(2,"process")])
+def test_batch_mixes_grids(spectra,workers,executor):
+    # rows alternate between two grids, so each group is scattered back out of order
+    grids = (numpy.arange(3800,8000,1.5),numpy.arange(3810,7990,2.0))
+    mixed = [fits_data.align(grids[i % 2]) for i,fits_data in enumerate(spectra * 2)]
+    values,errors = compute_LickLineIndices_batch(mixed,workers=workers,executor=executor
+                                                  ,as_table=True,return_errors=True,mask=True)
+    names = [lick_line_index.index_name for lick_line_index in default_LickLineIndex_table()]
+    assert values.dtype.names==tuple(names)
+    for row,fits_data in enumerate(mixed):
+        expected = compute_LickLineIndices(fits_data,return_errors=True,mask=True)
+        for name in names:
+            assert numpy.allclose([values[name][row],errors[name][row]],expected[name],equal_nan=True)
@@ -0,0 +1,68 @@
+import csv
+
+import numpy
+import pytest
+
+from synthetic import write_files
+from cmost import read_fits
+from cmost.pipeline import Pipeline,Sink,NpySink,CSVSink,ParquetSink
+
+
+GRID = numpy.arange(3800,8000,4.0)
+
+
+@pytest.fixture(scope="module")
+def paths(tmp_path_factory):
+    return write_files(str(tmp_path_factory.mktemp("spectra")),5)
+
+
+@pytest.fixture(scope="module")
+def expected(paths):
+    # one chunk holding every spectrum
+    return next(Pipeline().align(GRID).minmax().iter(paths,chunk_size=len(paths)))
+
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        Sink()
+
+
+def test_npy_sink_round_trip(paths,expected,tmp_path):
+    path = str(tmp_path / "flux.npy")
+    failed = Pipeline().align(GRID).minmax().run(paths,NpySink(path),chunk_size=2)
+    assert failed=={}
+    for mmap_mode in (None,"r"):
+        flux = numpy.load(path,mmap_mode=mmap_mode)
+        assert flux.shape==(len(paths),len(GRID))
+        assert numpy.array_equal(flux,expected.flux)
+
+
+def test_npy_sink_rejects_other_rows(tmp_path):
+    with NpySink(str(tmp_path / "rows.npy"),dtype=numpy.float32) as sink:
+        sink.write(numpy.ones((2,3)))
+        with pytest.raises(ValueError):
+            sink.write(numpy.ones((2,4)))
+    assert numpy.load(tmp_path / "rows.npy").dtype==numpy.float32
+
+
+def test_csv_sink_round_trip(paths,tmp_path):
+    path = str(tmp_path / "lick.csv")
+    pipeline = Pipeline().align(GRID).lick(keys=("obsid","z"))
+    failed = pipeline.run(paths,CSVSink(path),chunk_size=2,workers=2,executor="thread")
+    assert failed=={}
+    table = pipeline.apply(read_fits(path) for path in paths)
+    with open(path,newline="",encoding="utf-8") as file:
+        rows = list(csv.reader(file))
+    assert rows[0]==list(table.dtype.names)
+    assert [int(row[0]) for row in rows[1:]]==list(table["obsid"])
+    values = numpy.array([[float(value) for value in row[1:]] for row in rows[1:]])
+    assert numpy.allclose(values,[list(row)[1:] for row in table.tolist()],equal_nan=True)
+
+
+def test_parquet_sink_round_trip(paths,expected,tmp_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "flux.parquet")
+    Pipeline().align(GRID).minmax().run(paths,ParquetSink(path),chunk_size=2)
+    table = parquet.read_table(path)
+    assert table.column("obsid").to_pylist()==list(expected.header["obsid"])
+    assert numpy.array_equal(numpy.array(table.column("flux").to_pylist()),expected.flux)
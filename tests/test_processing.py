@@ -0,0 +1,178 @@
+import numpy
+import pytest
+
+from synthetic import make_batch
+from cmost.io import FitsData
+from cmost import processing
+from cmost.processing import Resampler,moving_median,median_filter,bin_edges,rebin_flux_conserving,redshift_resampler
+
+
+@pytest.fixture
+def batch():
+    return make_batch(3,npix=600)
+
+
+@pytest.mark.parametrize("kind",["linear","cubic"])
+def test_align_keeps_masks_and_ivar(batch,kind):
+    grid = numpy.arange(3800,4000,2.0)
+    linear = batch.align(grid)
+    for spectra in (batch,batch[0]):
+        aligned = spectra.align(grid,kind=kind)
+        for name in ("andmask","orimask","ivar"):
+            expected = getattr(linear if spectra is batch else linear[0],name)
+            assert numpy.array_equal(getattr(aligned,name),expected)
+
+
+def test_remove_redshift_keeps_masks_and_ivar(batch):
+    spectrum = batch[0]
+    linear = spectrum.remove_redshift()
+    cubic = spectrum.remove_redshift(kind="cubic")
+    assert isinstance(cubic,FitsData)
+    for name in ("andmask","orimask","ivar"):
+        assert numpy.array_equal(getattr(cubic,name),getattr(linear,name))
+
+
+def test_linear_resampler_matches_interp1d_and_clamps_edges():
+    from scipy import interpolate
+    rng = numpy.random.default_rng(0)
+    wavelength = numpy.sort(rng.uniform(4000,5000,300))
+    flux = rng.normal(10,1,(2,300))
+    target = numpy.linspace(3900,5100,500) # beyond both ends
+    res = Resampler(wavelength,target)(flux)
+    expected = interpolate.interp1d(wavelength,flux,bounds_error=False
+                                    ,fill_value=(flux[:,0],flux[:,-1]))(target)
+    assert numpy.allclose(res,expected)
+    assert numpy.all(res[:,target<wavelength[0]]==flux[:,:1])
+    assert numpy.all(res[:,target>wavelength[-1]]==flux[:,-1:])
+    # an unsorted source grid is sorted by the plan
+    order = rng.permutation(300)
+    assert numpy.allclose(Resampler(wavelength[order],target)(flux[:,order]),res)
+
+
+@pytest.mark.parametrize("method",["linear","flux_conserving"])
+def test_resampler_per_row_grids(method):
+    rng = numpy.random.default_rng(1)
+    wavelength = numpy.sort(rng.uniform(4000,5000,(3,200)),axis=-1)
+    target = numpy.sort(rng.uniform(3950,5050,(3,80)),axis=-1)
+    flux = rng.normal(10,1,(3,200))
+    ivar = rng.uniform(0.5,2,(3,200))
+    mask = rng.integers(0,2,(3,200)) << rng.integers(0,4,(3,200))
+    resampler = Resampler(wavelength,target,method)
+    for i in range(3):
+        row = Resampler(wavelength[i],target[i],method)
+        assert numpy.allclose(resampler(flux)[i],row(flux[i]))
+        assert numpy.allclose(resampler.ivar(ivar)[i],row.ivar(ivar[i]))
+        assert numpy.array_equal(resampler.mask(mask)[i],row.mask(mask[i]))
+    # a shared target grid for rows with their own source grid
+    shared = Resampler(wavelength,target[0],method)
+    assert numpy.allclose(shared(flux)[2],Resampler(wavelength[2],target[0],method)(flux[2]))
+
+
+def test_linear_masks_and_ivar():
+    wavelength = numpy.arange(10.0)
+    mask = numpy.zeros(10,dtype=int)
+    mask[4],mask[5] = 1,2
+    ivar = numpy.full(10,4.0)
+    ivar[5] = 1.0
+    ivar[8] = 0.0
+    resampler = Resampler(wavelength,numpy.array([3.5,4.0,4.5,5.25,7.5,8.0,-1.0]))
+    # pixels between 4 and 5 OR both masks, a pixel on 4 only uses pixel 4
+    assert list(resampler.mask(mask))==[1,1,3,2,0,0,0]
+    # variance (1-t)**2*var_lo + t**2*var_hi, 0 where a pixel with ivar 0 is used
+    variance = [0.25 / 4 + 0.25 / 4,1 / 4,0.25 / 4 + 0.25 / 1,0.75 ** 2 / 1 + 0.25 ** 2 / 4]
+    assert numpy.allclose(resampler.ivar(ivar),[*(1 / numpy.array(variance)),0,0,4])
+
+
+def test_rebin_conserves_flux():
+    rng = numpy.random.default_rng(2)
+    wavelength = 10 ** (3.6 + numpy.arange(1000) * 1e-4)
+    flux = rng.uniform(0,100,(2,1000))
+    edges = bin_edges(wavelength)
+    total = numpy.sum(flux * numpy.diff(edges),axis=-1)
+    # coarser grids, inside and beyond the source range
+    for new_wavelength in (numpy.linspace(wavelength[0],wavelength[-1],97)
+                           ,numpy.arange(3900,8000,7.3)):
+        res = rebin_flux_conserving(wavelength,flux,new_wavelength)
+        widths = numpy.diff(numpy.clip(bin_edges(new_wavelength),edges[0],edges[-1]))
+        assert numpy.allclose(numpy.sum(res * widths,axis=-1),total,rtol=1e-10)
+    # a constant stays constant, also in the bins past the ends
+    assert numpy.allclose(rebin_flux_conserving(wavelength,numpy.full(1000,3.0),numpy.arange(3900,8000,7.3)),3.0)
+
+
+def test_flux_conserving_masks_and_ivar():
+    wavelength = numpy.arange(10.0)
+    mask = numpy.zeros(10,dtype=int)
+    mask[2],mask[3],mask[7] = 1,2,4
+    ivar = numpy.full(10,4.0)
+    ivar[9] = 0.0
+    # bins of two pixels, and one pixel bins past the ends
+    resampler = Resampler(wavelength,numpy.array([-3.0,0.5,2.5,4.5,6.5,8.5,12.0]),"flux_conserving")
+    assert list(resampler.mask(mask))==[0,0,3,0,4,0,0]
+    # the mean of two pixels has a quarter of their summed variance
+    assert numpy.allclose(resampler.ivar(ivar)[:6],[4,8,8,8,8,0])
+    assert resampler.ivar(ivar)[6]==0
+
+
+def test_batched_remove_redshift_matches_rows(batch):
+    grid = numpy.arange(3650,4300,1.5)
+    for kind in ("linear","flux_conserving"):
+        rest = batch.remove_redshift(kind,grid)
+        for i,z in enumerate(batch.header["z"]):
+            resampler = redshift_resampler(batch.wavelength,z,grid,kind)
+            assert numpy.allclose(rest.flux[i],resampler(batch.flux[i]))
+            assert numpy.allclose(rest.ivar[i],resampler.ivar(batch.ivar[i]))
+            assert numpy.array_equal(rest.andmask[i],resampler.mask(batch.andmask[i]))
+
+
+def _reference_median(row,invalid,size,mode):
+    # rank `valid//2` of the valid pixels of every window, nan if there are none
+    pad = (size // 2,size - 1 - size // 2)
+    padded = numpy.pad(row,pad,mode="symmetric" if mode=="reflect" else "constant")
+    padded_invalid = numpy.pad(invalid,pad,mode="symmetric" if mode=="reflect" else "constant")
+    res = []
+    for i in range(len(row)):
+        window = numpy.sort(padded[i:i + size][~padded_invalid[i:i + size]])
+        res.append(window[len(window) // 2] if len(window) else numpy.nan)
+    return numpy.array(res)
+
+
+@pytest.fixture(params=[True,False],ids=["rank_filter_1d","windows"])
+def median_backend(request,monkeypatch):
+    # both the scipy>=1.15 running median and the fallback for older versions
+    monkeypatch.setattr(processing,"_has_rank_filter_1d",lambda:request.param)
+
+
+@pytest.mark.parametrize("size",[7,50])
+@pytest.mark.parametrize("mode",["reflect","constant"])
+def test_moving_median_matches_ndimage(median_backend,size,mode):
+    from scipy import ndimage
+    flux = numpy.random.default_rng(3).normal(10,1,(4,300))
+    assert numpy.array_equal(moving_median(flux,size,mode=mode)
+                             ,ndimage.median_filter(flux,size=(1,size),mode=mode))
+
+
+def test_moving_median_skips_nan_and_masked_pixels(median_backend):
+    rng = numpy.random.default_rng(4)
+    flux = rng.normal(10,1,(3,200))
+    flux[0,rng.integers(0,200,30)] = numpy.nan
+    mask = numpy.zeros((3,200),dtype=int)
+    mask[1,rng.integers(0,200,30)] = 1
+    # every window in the middle of row 2 is invalid
+    mask[2,80:120] = 4
+    for mode in ("reflect","constant"):
+        res = moving_median(flux,9,mode=mode,mask=mask)
+        invalid = numpy.isnan(flux) | (mask!=0)
+        for i in range(3):
+            expected = _reference_median(numpy.nan_to_num(flux[i]),invalid[i],9,mode)
+            assert numpy.array_equal(res[i],expected,equal_nan=True)
+        assert numpy.all(numpy.isnan(res[2,84:116]))
+        assert not numpy.any(numpy.isnan(res[2,:76]))
+
+
+def test_median_filter_is_medfilt():
+    from scipy import signal
+    flux = numpy.random.default_rng(5).normal(10,1,(2,300))
+    assert numpy.array_equal(median_filter(flux,7),signal.medfilt(flux,(1,7)))
+    for size in (0,8):
+        with pytest.raises(ValueError,match="odd"):
+            median_filter(flux,size)
@@ -0,0 +1,59 @@
+import json
+
+import numpy
+import pytest
+
+from synthetic import write_files
+from cmost import read_fits
+from cmost.io import SpectrumBatch
+from cmost.store import SpectrumStore
+
+
+GRID = numpy.arange(3800,8000,2.0)
+
+
+@pytest.fixture(scope="module")
+def paths(tmp_path_factory):
+    return write_files(str(tmp_path_factory.mktemp("spectra")),5)
+
+
+@pytest.fixture(scope="module")
+def store(paths,tmp_path_factory):
+    store,failed = SpectrumStore.build(str(tmp_path_factory.mktemp("store")),paths
+                                       ,wavelength_grid=GRID,workers=1,chunk_size=2)
+    assert failed=={}
+    return SpectrumStore.open(store.path)
+
+
+def test_native_round_trip(store,paths):
+    assert len(store)==len(paths)
+    for path in paths:
+        expected = read_fits(path)
+        fits_data = store.get(expected.header["obsid"])
+        for name in ("wavelength","flux","ivar","andmask","orimask"):
+            assert numpy.allclose(getattr(fits_data,name),getattr(expected,name),rtol=1e-6),name
+        assert fits_data.header["z"]==expected.header["z"]
+
+
+def test_slices_are_aligned_batches(store,paths):
+    expected = SpectrumBatch.from_fits_data([read_fits(path) for path in paths]).align(GRID)
+    rows = numpy.array([3,0,4])
+    for key in (slice(1,4),rows):
+        batch = store[key]
+        assert isinstance(batch,SpectrumBatch)
+        assert numpy.array_equal(batch.wavelength,GRID)
+        assert list(batch.header["obsid"])==list(expected.header["obsid"][key])
+        for name in ("flux","ivar","andmask","orimask"):
+            assert numpy.allclose(getattr(batch,name),getattr(expected,name)[key],rtol=1e-6),name
+    assert list(store.select(store.obsids[rows]).header["obsid"])==list(store.obsids[rows])
+    assert sum(len(batch) for batch in store.iter_batches(2))==len(store)
+
+
+def test_unknown_version(store,tmp_path):
+    for name in store.path.iterdir():
+        (tmp_path / name.name).write_bytes(name.read_bytes())
+    meta = json.loads((tmp_path / "meta.json").read_text())
+    meta["version"] = 99
+    (tmp_path / "meta.json").write_text(json.dumps(meta))
+    with pytest.raises(ValueError,match="version"):
+        SpectrumStore.open(tmp_path)